@@ -0,0 +1,5 @@
+"""
+Benchmarks of sr_danmaku
+
+Every benchmark can be run as a script, and all of them at once with: python -m benchmarks
+"""
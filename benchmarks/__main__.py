@@ -0,0 +1,111 @@
+"""
+Run the benchmarks at several scales, and save the results as JSON to track them over time
+
+Usage:
+    python -m benchmarks
+    python -m benchmarks --scale small medium large --output results.json
+    python -m benchmarks --suite decode layout --seed 2
+"""
+import os
+import sys
+import json
+import time
+import platform
+import datetime
+import subprocess
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sr_danmaku  # noqa: E402
+from benchmarks import bench_archive, bench_ass, bench_database, bench_decode, bench_filter, bench_layout, bench_monitor, bench_store  # noqa: E402
+
+# number of messages (or comments) of each scale
+SCALES = {'small': 10000, 'medium': 100000, 'large': 1000000}
+
+
+def run_decode(n, seed):
+    return bench_decode.bench(bench_decode.make_frames(n, seed))
+
+
+def run_filter(n, seed):
+    return [bench_filter.bench(n, seed)]
+
+
+def run_layout(n, seed):
+    return [bench_layout.bench(n, rate, slotsNum, seed) for rate in (5, 50, 500) for slotsNum in (20, 90)] + \
+        [bench_layout.bench_density(n, rate, 20, 10, seed=seed) for rate in (5, 50, 500)]
+
+
+def run_ass(n, seed):
+    return [bench_ass.bench(n, seed), bench_ass.bench_profiles(n, seed)]
+
+
+def run_store(n, seed):
+    return [bench_store.bench(n, distinct, seed) for distinct in (0.1, 1.0)]
+
+
+def run_archive(n, seed):
+    return bench_archive.bench(n, seed)
+
+
+def run_database(n, seed):
+    return [bench_database.bench(n, 10, batchRows, seed) for batchRows in (1, 500)]
+
+
+def run_monitor(n, seed):
+    return [bench_monitor.bench(n // 100, lives, 5, 20000000, seed) for lives in (2000, 5000)]
+
+
+SUITES = {'decode': run_decode, 'filter': run_filter, 'layout': run_layout, 'ass': run_ass,
+          'store': run_store, 'archive': run_archive, 'database': run_database,
+          'monitor': run_monitor}
+
+
+def git_revision():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    return out.stdout.decode('utf-8').strip() or None
+
+
+def main():
+    parser = ArgumentParser(prog='python -m benchmarks', description='Run the sr_danmaku benchmarks')
+    parser.add_argument('--suite', nargs='+', choices=list(SUITES), default=list(SUITES))
+    parser.add_argument('--scale', nargs='+', choices=list(SCALES), default=['small', 'medium'])
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-o', '--output', help='JSON file of the results (default: print to stdout)')
+    args = parser.parse_args()
+
+    results = []
+    for scale in args.scale:
+        for suite in args.suite:
+            startTime = time.perf_counter()
+            rows = SUITES[suite](SCALES[scale], args.seed)
+            print('{} {}: {:.1f} s'.format(suite, scale, time.perf_counter() - startTime), file=sys.stderr)
+            for row in rows:
+                print('  {}'.format(row), file=sys.stderr)
+                results.append(dict(suite=suite, scale=scale, **row))
+
+    report = {'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+              'git': git_revision(),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'orjson': getattr(sr_danmaku.orjson, '__version__', None),
+              'zstandard': getattr(sr_danmaku.zstandard, '__version__', None),
+              'seed': args.seed,
+              'results': results}
+    text = json.dumps(report, ensure_ascii=False, indent=1)
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as fp:
+            fp.write(text + '\n')
+        print('Saved the results to {}'.format(args.output), file=sys.stderr)
+    else:
+        print(text)
+    return report
+
+
+if __name__ == '__main__':
+    main()
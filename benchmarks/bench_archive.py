@@ -0,0 +1,99 @@
+"""
+Compare the comment log saved as JSON lines (.log) with the compressed CommentArchive (.logz)
+
+Recorded messages of the benchmarks generator are saved in each format (gzip, and zstd when zstandard
+is installed), and the file size, the time to write and to read the whole file, and the time to read
+a window of one minute in the middle of the live are measured. The messages read back are checked
+to be identical.
+
+Usage:
+    python benchmarks/bench_archive.py
+    python benchmarks/bench_archive.py --messages 100000 1000000
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sr_danmaku  # noqa: E402
+from benchmarks import generator  # noqa: E402
+
+WINDOW = 60 * 1000
+
+
+def write_log(filename, messages):
+    with open(filename, 'w', encoding='utf8') as fp:
+        for data in messages:
+            fp.write(json.dumps(data, ensure_ascii=False) + '\n')
+
+
+def write_archive(filename, messages, codec):
+    with sr_danmaku.CommentArchive(filename, {'ws_startTime': messages[0]['received_at']}, codec=codec) as archive:
+        for data in messages:
+            archive.append(data)
+
+
+def read_window(filename, start, end):
+    if filename.endswith(sr_danmaku.CommentArchive.extension):
+        return list(sr_danmaku.CommentArchiveReader(filename).messages(start, end))
+    # a log has to be read from the start
+    return [data for data in sr_danmaku.iterLog(filename) if start <= data['received_at'] < end]
+
+
+def timed(func):
+    startTime = time.perf_counter()
+    result = func()
+    return time.perf_counter() - startTime, result
+
+
+def bench(n, seed=1):
+    messages = list(generator.recorded(generator.messages(n, seed)))
+    middle = messages[len(messages) // 2]['received_at']
+    start, end = middle, middle + WINDOW
+    expected = [data for data in messages if start <= data['received_at'] < end]
+
+    results = []
+    folder = tempfile.mkdtemp(prefix='bench_archive_')
+    formats = [('log', None)] + [('logz', codec) for codec in sorted(sr_danmaku.CommentArchive.codecs)]
+    for fmt, codec in formats:
+        filename = os.path.join(folder, '{}.{}'.format(codec or 'json', fmt))
+        if codec is None:
+            write_time, _ = timed(lambda: write_log(filename, messages))
+        else:
+            write_time, _ = timed(lambda: write_archive(filename, messages, codec))
+        read_time, read = timed(lambda: list(sr_danmaku.iterLog(filename)))
+        window_time, window = timed(lambda: read_window(filename, start, end))
+        results.append({'messages': len(messages), 'format': fmt, 'codec': codec or '-',
+                        'identical': read == messages and window == expected,
+                        'size_mb': round(os.path.getsize(filename) / 1048576.0, 2),
+                        'write_s': round(write_time, 3), 'read_s': round(read_time, 3),
+                        'window_ms': round(window_time * 1000, 1)})
+        os.remove(filename)
+    os.rmdir(folder)
+    return results
+
+
+def main():
+    parser = ArgumentParser(description='Compare the JSON lines comment log with the compressed archive')
+    parser.add_argument('--messages', type=int, nargs='+', default=[100000])
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print('{:>9} {:>6} {:>6} {:>9} {:>9} {:>9} {:>9} {:>10}'.format(
+        'messages', 'format', 'codec', 'identical', 'size(MB)', 'write(s)', 'read(s)', '1 min(ms)'))
+    results = []
+    for n in args.messages:
+        for r in bench(n, args.seed):
+            results.append(r)
+            print('{:>9} {:>6} {:>6} {:>9} {:>9} {:>9} {:>9} {:>10}'.format(
+                r['messages'], r['format'], r['codec'], str(r['identical']), r['size_mb'], r['write_s'],
+                r['read_s'], r['window_ms']))
+    return results
+
+
+if __name__ == '__main__':
+    main()
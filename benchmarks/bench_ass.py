@@ -0,0 +1,268 @@
+"""
+Compare the streaming ass writer with the string-building convert_comments_to_danmaku() it replaced
+
+The time and the peak memory (tracemalloc) of rendering the comments of a stream of N messages
+from the benchmarks generator are measured,
+and the outputs are checked to be identical.
+Rendering three output profiles (profiles in danmaku_settings) one after the other is then compared
+with MultiDanmakuWriter, which renders them in one pass.
+
+Usage:
+    python benchmarks/bench_ass.py
+    python benchmarks/bench_ass.py --messages 10000 100000 1000000
+"""
+import os
+import sys
+import io
+import math
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sr_danmaku  # noqa: E402
+from benchmarks import generator  # noqa: E402
+
+
+class NullSink:
+    """ file-like object which only counts the written characters """
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, s):
+        self.size += len(s)
+
+
+def make_comments(n, seed=1):
+    """ :return the recording start time, and the messages kept by the recorder in a stream of n """
+    return generator.START_TIME, generator.recorded(generator.messages(n, seed))
+
+
+def legacy_convert_comments_to_danmaku(startTime, commentList,
+                                fontsize=18, fontname='MS PGothic', alpha='1A',
+                                width=640, height=360):
+    """
+    convert_comments_to_danmaku() before the streaming writer, kept for comparison
+
+    :param startTime: comments recording start time (timestamp in milliseconds)
+    :param commentList: list of showroom messages
+    :param fontsize = 18
+    :param fontname = 'MS PGothic'
+    :param alpha = '1A'     # transparency '00' to 'FF' (hex string)
+    :param width = 640      # video screen height
+    :param height = 360     # video screen width
+
+    :return a string of danmaku subtitles
+    """
+
+    # slotsNum: max number of comment line vertically shown on screen
+    slotsNum = math.floor(height / fontsize)
+    travelTime = 8 * 1000  # 8 sec, bullet comment flight time on screen
+
+    # ass subtitle file header
+    danmaku = "[Script Info]\n"
+    danmaku += "ScriptType: v4.00+\n"
+    danmaku += "Collisions: Normal\n"
+    danmaku += "PlayResX: " + str(width) + "\n"
+    danmaku += "PlayResY: " + str(height) + "\n\n"
+    danmaku += "[V4+ Styles]\n"
+    danmaku += "Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding\n"
+    danmaku += "Style: danmakuFont, " + fontname + ", " + str(fontsize) + \
+               ", &H00FFFFFF, &H00FFFFFF, &H00000000, &H00000000, 1, 0, 0, 0, 100, 100, 0.00, 0.00, 1, 1, 0, 2, 20, 20, 20, 0\n\n"
+    danmaku += "[Events]\n"
+    danmaku += "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n"
+
+    # each comment line on screen can be seen as a slot
+    # each slot will be filled with the time which indicates when the bullet comment will disappear on screen
+    # slot[0], slot[1], slot[2], ...: for the comment lines from top to down
+    slots = []
+    for i in range(slotsNum):
+        slots.append(0)
+
+    previousTelop = ''
+
+    for data in commentList:
+        m_type = str(data['t'])
+        comment = ''
+        if m_type == '1':  # comment
+            comment = data['cm']
+
+        elif m_type == '3':  # voting start
+            poll = data['l']
+            if len(poll) < 1:
+                continue
+            comment = 'Poll Started: 【({})'.format(poll[0]['id'] % 10000)
+            for k in range(1, len(poll)):
+                if k > 4:
+                    comment += ', ...'
+                    break
+                comment += ', ({})'.format(poll[k]['id'] % 10000)
+            comment += '】'
+
+        elif m_type == '4':  # voting result
+            poll = data['l']
+            if len(poll) < 1:
+                continue
+            comment = 'Poll: 【({}) {}%'.format(poll[0]['id'] % 10000, poll[0]['r'])
+            for k in range(1, len(poll)):
+                if k > 4:
+                    comment += ', ...'
+                    break
+                comment += ', ({}) {}%'.format(poll[k]['id'] % 10000, poll[k]['r'])
+            comment += '】'
+
+        elif m_type == '8':  # telop
+            telop = data['telop']
+            if telop is not None and telop != previousTelop:
+                previousTelop = telop
+                # show telop as a comment
+                comment = 'Telop: 【' + telop + '】'
+            else:
+                continue
+
+        else:   # not comment, telop, or voting result
+            continue
+
+        # compute current relative time
+        t = data['received_at'] - startTime
+
+        # find available slot vertically from up to down
+        selectedSlot = 0
+        isSlotFound = False
+        for j in range(slotsNum):
+            if slots[j] <= t:
+                slots[j] = t + travelTime  # replaced with the time that it will finish
+                isSlotFound = True
+                selectedSlot = j
+                break
+
+        # when all slots have larger times, find the smallest time and replace the slot
+        if not isSlotFound:
+            minIdx = 0
+            for j in range(1, slotsNum):
+                if slots[j] < slots[minIdx]:
+                    minIdx = j
+
+            slots[minIdx] = t + travelTime
+            selectedSlot = minIdx
+
+        # calculate bullet comment flight positions, from (x1,y1) to (x2,y2) on screen
+
+        # extra flight length so a comment appears and disappears outside of the screen
+        extraLen = math.ceil(len(comment) / 2.0)
+
+        x1 = width + extraLen * fontsize
+        y1 = (selectedSlot + 1) * fontsize
+        x2 = 0 - extraLen * fontsize
+        y2 = y1
+
+        def msecToAssTime(uTime):
+            """ convert milliseconds to ass subtitle format """
+            msec = uTime % 1000
+            msec = int(round(msec / 10.0))
+            uTime = math.floor(uTime / 1000.0)
+            s = int(uTime % 60)
+            uTime = math.floor(uTime / 60.0)
+            m = int(uTime % 60)
+            h = int(math.floor(uTime / 60.0))
+            msf = ("00" + str(msec))[-2:]
+            sf = ("00" + str(s))[-2:]
+            mf = ("00" + str(m))[-2:]
+            hf = ("00" + str(h))[-2:]
+            return hf + ":" + mf + ":" + sf + "." + msf
+
+        # build ass subtitle script
+        sub = "Dialogue: 3," + msecToAssTime(t) + "," + msecToAssTime(t + travelTime)
+        # alpha: 00 means fully visible, and FF (ie. 255 in decimal) is fully transparent.
+        sub += ",danmakuFont,,0000,0000,0000,,{\\alpha&H" + alpha + "&\\move("
+        sub += str(x1) + "," + str(y1) + "," + str(x2) + "," + str(y2)
+        sub += ")}" + comment + "\n"
+
+        danmaku += sub
+    # end of for
+    return danmaku
+
+
+def run(func):
+    startTime = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - startTime
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def bench(n, seed=1):
+    startTime, comments = make_comments(n, seed)
+
+    legacy = legacy_convert_comments_to_danmaku(startTime, comments)
+    streamed = io.StringIO()
+    sr_danmaku.write_danmaku(streamed, startTime, comments)
+    identical = legacy == streamed.getvalue() == sr_danmaku.convert_comments_to_danmaku(startTime, comments)
+    del legacy, streamed
+
+    legacy_time, legacy_peak = run(lambda: legacy_convert_comments_to_danmaku(startTime, comments))
+    stream_time, stream_peak = run(lambda: sr_danmaku.write_danmaku(NullSink(), startTime, comments))
+    return {'messages': n, 'comments': len(comments), 'identical': identical,
+            'legacy_s': round(legacy_time, 3), 'legacy_peak_mb': round(legacy_peak / 1048576.0, 2),
+            'stream_s': round(stream_time, 3), 'stream_peak_mb': round(stream_peak / 1048576.0, 2)}
+
+
+PROFILES = '1280x720:36, 1920x1080:54'
+
+
+def bench_profiles(n, seed=1):
+    startTime, comments = make_comments(n, seed)
+    danmaku_settings = generator.default_settings()['danmaku_settings']
+    danmaku_settings['profiles'] = PROFILES
+    profiles = sr_danmaku.danmakuProfiles(danmaku_settings)
+
+    def separately(sink):
+        return [sr_danmaku.write_danmaku(sink(), startTime, comments, **options).fp for _, options in profiles]
+
+    def onePass(sink):
+        multiWriter = sr_danmaku.MultiDanmakuWriter([sr_danmaku.DanmakuWriter(sink(), startTime, **options)
+                                                     for _, options in profiles])
+        multiWriter.writeHeader()
+        multiWriter.write(comments)
+        return [writer.fp for writer in multiWriter.writers]
+
+    identical = [fp.getvalue() for fp in separately(io.StringIO)] == [fp.getvalue() for fp in onePass(io.StringIO)]
+    separate_time, _ = run(lambda: separately(NullSink))
+    one_pass_time, _ = run(lambda: onePass(NullSink))
+    return {'messages': n, 'comments': len(comments), 'profiles': len(profiles), 'identical': identical,
+            'separate_s': round(separate_time, 3), 'one_pass_s': round(one_pass_time, 3)}
+
+
+def main():
+    parser = ArgumentParser(description='Compare the streaming ass writer with the legacy converter')
+    parser.add_argument('--messages', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print('{:>9} {:>9} {:>10} {:>15} {:>10} {:>15}'.format(
+        'comments', 'identical', 'legacy(s)', 'legacy peak(MB)', 'stream(s)', 'stream peak(MB)'))
+    results = []
+    for n in args.messages:
+        r = bench(n, args.seed)
+        results.append(r)
+        print('{:>9} {:>9} {:>10} {:>15} {:>10} {:>15}'.format(
+            r['comments'], str(r['identical']), r['legacy_s'], r['legacy_peak_mb'], r['stream_s'], r['stream_peak_mb']))
+
+    print()
+    print('{:>9} {:>9} {:>9} {:>12} {:>12}'.format('comments', 'profiles', 'identical', 'separate(s)',
+                                                   'one pass(s)'))
+    for n in args.messages:
+        r = bench_profiles(n, args.seed)
+        results.append(r)
+        print('{:>9} {:>9} {:>9} {:>12} {:>12}'.format(r['comments'], r['profiles'], str(r['identical']),
+                                                       r['separate_s'], r['one_pass_s']))
+    return results
+
+
+if __name__ == '__main__':
+    main()
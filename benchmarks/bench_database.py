@@ -0,0 +1,113 @@
+"""
+Measure the CommentDatabase sink: the time a recorder spends in append(), and the insert throughput
+of the writer thread, for several batch sizes (database_batch_rows)
+
+Recorded messages of the benchmarks generator are appended for a number of rooms in turns,
+as the recorders would, then the database is closed and the rendered ass file of one live
+is checked to be identical to the one rendered from the messages.
+For comparison, inserting every message in its own transaction on the recording thread is measured
+on up to --direct messages.
+
+Usage:
+    python benchmarks/bench_database.py
+    python benchmarks/bench_database.py --messages 1000000 --rooms 100 --batch-rows 1 50 500
+"""
+import os
+import io
+import sys
+import time
+import json
+import shutil
+import tempfile
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sr_danmaku  # noqa: E402
+from benchmarks import generator  # noqa: E402
+
+
+def bench(n, rooms, batchRows, seed=1):
+    messages = list(generator.recorded(generator.messages(n, seed)))
+    startTime = messages[0]['received_at']
+    folder = tempfile.mkdtemp(prefix='bench_database_')
+    filename = os.path.join(folder, 'comments.db')
+
+    database = sr_danmaku.CommentDatabase(filename, batchRows, flushInterval=1)
+    for room in range(rooms):
+        database.addLive(room, room, 'ROOM_{}'.format(room), 'room {}'.format(room), startTime)
+    append = database.append
+    wall_start = time.perf_counter()
+    appendTime = 0.0
+    for i, data in enumerate(messages):
+        room = i % rooms
+        t = time.perf_counter()
+        append(room, room, data)
+        appendTime += time.perf_counter() - t
+    database.close()
+    wall = time.perf_counter() - wall_start
+
+    expected = io.StringIO()
+    sr_danmaku.write_danmaku(expected, startTime, messages[::rooms])
+    rendered = io.StringIO()
+    sr_danmaku.write_danmaku(rendered, startTime, sr_danmaku.iterDatabaseLive(filename, 0, 0))
+    identical = expected.getvalue() == rendered.getvalue() and database.row_count == len(messages)
+
+    size = sum(os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder))
+    shutil.rmtree(folder)
+    return {'messages': len(messages), 'rooms': rooms, 'batch_rows': batchRows, 'identical': identical,
+            'append_us': round(appendTime * 1e6 / len(messages), 2),
+            'rows_per_s': round(len(messages) / wall), 'transactions': database.transaction_count,
+            'size_mb': round(size / 1048576.0, 2)}
+
+
+def bench_direct(n, rooms, seed=1):
+    """ every message inserted and committed by the recorder itself """
+    messages = list(generator.recorded(generator.messages(n, seed)))
+    folder = tempfile.mkdtemp(prefix='bench_database_')
+    conn = sr_danmaku.openDatabase(os.path.join(folder, 'comments.db'))
+    for statement in sr_danmaku.CommentDatabase.schema:
+        conn.execute(statement)
+    startTime = time.perf_counter()
+    for i, data in enumerate(messages):
+        room = i % rooms
+        with conn:
+            conn.execute('INSERT INTO messages VALUES (?, ?, ?, ?, ?)',
+                         (room, room, data['received_at'], data.get('t'), json.dumps(data, ensure_ascii=False)))
+    elapsed = time.perf_counter() - startTime
+    conn.close()
+    shutil.rmtree(folder)
+    return {'messages': len(messages), 'rooms': rooms, 'batch_rows': 'direct',
+            'append_us': round(elapsed * 1e6 / len(messages), 2), 'rows_per_s': round(len(messages) / elapsed),
+            'transactions': len(messages)}
+
+
+def main():
+    parser = ArgumentParser(description='Measure the SQLite comment database sink')
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--batch-rows', type=int, nargs='+', default=[1, 50, 500])
+    parser.add_argument('--direct', type=int, default=20000,
+                        help='messages for the baseline of one transaction per message, 0: skip (default: 20000)')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print('{:>9} {:>6} {:>10} {:>9} {:>14} {:>10} {:>13} {:>9}'.format(
+        'messages', 'rooms', 'batch_rows', 'identical', 'append(us/msg)', 'rows/s', 'transactions', 'size(MB)'))
+    results = []
+    for batchRows in args.batch_rows:
+        r = bench(args.messages, args.rooms, batchRows, args.seed)
+        results.append(r)
+        print('{:>9} {:>6} {:>10} {:>9} {:>14} {:>10} {:>13} {:>9}'.format(
+            r['messages'], r['rooms'], r['batch_rows'], str(r['identical']), r['append_us'], r['rows_per_s'],
+            r['transactions'], r['size_mb']))
+    if args.direct > 0:
+        r = bench_direct(args.direct, args.rooms, args.seed)
+        results.append(r)
+        print('{:>9} {:>6} {:>10} {:>9} {:>14} {:>10} {:>13} {:>9}'.format(
+            r['messages'], r['rooms'], r['batch_rows'], '-', r['append_us'], r['rows_per_s'], r['transactions'], '-'))
+    return results
+
+
+if __name__ == '__main__':
+    main()
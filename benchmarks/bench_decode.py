@@ -0,0 +1,111 @@
+"""
+Compare MessageDecoder with the decoding that ws_on_frame() and ws_on_message() did before:
+decode the frame to str, find the JSON part, json.loads() it, and retry broken messages
+
+The corpus is a stream of the benchmarks generator with a few broken (truncated) frames,
+like the frames received from a Showroom broadcast server.
+A captured corpus (one frame per line, as received) can be given with --corpus.
+
+Usage:
+    python benchmarks/bench_decode.py
+    python benchmarks/bench_decode.py --frames 200000 --corpus frames.txt
+"""
+import os
+import sys
+import json
+import time
+import logging
+from json import JSONDecodeError
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sr_danmaku  # noqa: E402
+from benchmarks import generator  # noqa: E402
+
+
+def read_corpus(filename):
+    with open(filename, 'rb') as fp:
+        return [line.rstrip(b'\r\n') for line in fp if line.strip()]
+
+
+def legacy_decode(data):
+    """ the decoding of ws_on_frame() and ws_on_message() before MessageDecoder """
+    try:
+        message = data.decode('utf-8')
+    except UnicodeDecodeError:
+        message = data.decode('latin-1')
+    idx = message.find("{")
+    if idx < 0:
+        return None
+    message = message[idx:]
+    try:
+        data = json.loads(message)
+    except JSONDecodeError:
+        message += '","t":"1"}'
+        try:
+            data = json.loads(message)
+        except JSONDecodeError:
+            return None
+    if str(data['t']) in ('2', '11'):
+        return None
+    return data
+
+
+def run(decode, frames):
+    startTime = time.perf_counter()
+    decoded = [decode(frame) for frame in frames]
+    return time.perf_counter() - startTime, decoded
+
+
+def make_frames(n, seed=1):
+    return generator.frames(generator.messages(n, seed), broken=0.002, seed=seed)
+
+
+def bench(frames, repeat=3):
+    """ :return a result for the legacy decoding and for each MessageDecoder backend """
+    logging.disable(logging.CRITICAL)
+    legacy_time, legacy = min(run(legacy_decode, frames) for _ in range(repeat))
+    results = [{'decoder': 'legacy', 'frames': len(frames), 'identical': True,
+                'us_per_frame': round(legacy_time * 1e6 / len(frames), 3), 'speedup': 1.0,
+                'skipped': None, 'broken': None}]
+
+    backends = ['json'] + (['orjson'] if sr_danmaku.orjson is not None else [])
+    for backend in backends:
+        best = None
+        for _ in range(repeat):
+            decoder = sr_danmaku.MessageDecoder(backend)
+            r = run(decoder.decode, frames)
+            if best is None or r[0] < best[0]:
+                best = r + (decoder.stats(),)
+        elapsed, decoded, stats = best
+        results.append({'decoder': backend, 'frames': len(frames), 'identical': decoded == legacy,
+                        'us_per_frame': round(elapsed * 1e6 / len(frames), 3),
+                        'speedup': round(legacy_time / elapsed, 2),
+                        'skipped': stats['skipped'], 'broken': stats['broken']})
+    logging.disable(logging.NOTSET)
+    return results
+
+
+def main():
+    parser = ArgumentParser(description='Compare MessageDecoder with the legacy message decoding')
+    parser.add_argument('--frames', type=int, default=200000)
+    parser.add_argument('--corpus', help='captured frames, one per line')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    frames = read_corpus(args.corpus) if args.corpus else make_frames(args.frames, args.seed)
+
+    print('{:>8} {:>8} {:>9} {:>12} {:>8} {:>8} {:>8}'.format(
+        'decoder', 'frames', 'identical', 'us/frame', 'speedup', 'skipped', 'broken'))
+    results = bench(frames, args.repeat)
+    for r in results:
+        print('{:>8} {:>8} {:>9} {:>12} {:>8} {:>8} {:>8}'.format(
+            r['decoder'], r['frames'], str(r['identical']), r['us_per_frame'], r['speedup'],
+            r['skipped'] if r['skipped'] is not None else '-', r['broken'] if r['broken'] is not None else '-'))
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+"""
+Compare the threaded recorder engine with the asyncio recorder engine
+
+A local WebSocket server (in its own process) simulates Showroom broadcast servers,
+and pushes a stream of the benchmarks generator to every connected room. Each engine records N rooms
+in a fresh process, and the thread count, RSS and CPU time of that process are measured.
+
+Usage:
+    python benchmarks/bench_engine.py
+    python benchmarks/bench_engine.py --rooms 100 500 1000 --duration 20 --rate 1
+"""
+import os
+import sys
+import time
+import json
+import asyncio
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from argparse import ArgumentParser, SUPPRESS
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sr_danmaku  # noqa: E402
+from benchmarks import generator  # noqa: E402
+from benchmarks.mock_showroom import ws_frame, ws_accept  # noqa: E402
+
+
+async def ws_serve_client(reader, writer, rate, stream):
+    try:
+        request = await reader.readuntil(b'\r\n\r\n')
+    except (asyncio.IncompleteReadError, ConnectionError):
+        writer.close()
+        return
+    key = ''
+    for line in request.decode('latin-1').split('\r\n'):
+        name, _, value = line.partition(':')
+        if name.strip().lower() == 'sec-websocket-key':
+            key = value.strip()
+    writer.write(('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                  'Sec-WebSocket-Accept: ' + ws_accept(key) + '\r\n\r\n').encode('utf-8'))
+
+    async def discard():
+        # client frames (SUB, pong, close) are read and dropped
+        try:
+            while await reader.read(65536):
+                pass
+        except ConnectionError:
+            pass
+
+    reading = asyncio.ensure_future(discard())
+    n = 0
+    try:
+        while not reading.done():
+            writer.write(ws_frame(stream[n % len(stream)]))
+            n += 1
+            await asyncio.sleep(1.0 / rate)
+    except ConnectionError:
+        pass
+    finally:
+        reading.cancel()
+        writer.close()
+
+
+def run_server(port, rate, ready):
+    stream = generator.frames(generator.messages(10000, end_marker=False))
+
+    async def serve():
+        server = await asyncio.start_server(lambda r, w: ws_serve_client(r, w, rate, stream), '127.0.0.1', port,
+                                            backlog=4096)
+        ready.set()
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+def read_rss_kb():
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(engine, rooms, duration, port):
+    """ record `rooms` simulated rooms with one engine, print the measurement as JSON """
+    os.chdir(tempfile.mkdtemp(prefix='bench_engine_'))
+
+    sr_danmaku.getRoomLiveInfo = lambda room_url_key, room_id: {
+        'bcsvr_key': 'bench', 'bcsvr_host': '127.0.0.1', 'bcsvr_port': port, 'live_id': room_id}
+    sr_danmaku.getRoomIsLive = lambda room_url_key, room_id: {'ok': 1}
+
+    settings = generator.default_settings(async_engine=1 if engine == 'asyncio' else 0)
+
+    async_engine = None
+    if engine == 'asyncio':
+        async_engine = sr_danmaku.AsyncRecorderEngine()
+        async_engine.start()
+
+    rss_start = read_rss_kb()
+    recorders = []
+    for i in range(rooms):
+        room = {'main_name': 'room {}'.format(i), 'room_id': i}
+        if async_engine is not None:
+            cr = sr_danmaku.AsyncCommentRecorder('ROOM_{}'.format(i), room, settings, async_engine)
+        else:
+            cr = sr_danmaku.CommentRecorder('ROOM_{}'.format(i), room, settings)
+        cr.start()
+        recorders.append(cr)
+
+    time.sleep(3)  # warm up: let every room connect
+
+    cpu_start = os.times()
+    wall_start = time.perf_counter()
+    threads_max = 0
+    rss_max = 0
+    while time.perf_counter() - wall_start < duration:
+        threads_max = max(threads_max, threading.active_count())
+        rss_max = max(rss_max, read_rss_kb())
+        time.sleep(0.5)
+    cpu_end = os.times()
+    wall = time.perf_counter() - wall_start
+    comments = sum(cr.comment_count for cr in recorders)
+
+    for cr in recorders:
+        cr.stop()
+    for cr in recorders:
+        cr.quit()
+    if async_engine is not None:
+        async_engine.stop()
+
+    cpu = (cpu_end.user - cpu_start.user) + (cpu_end.system - cpu_start.system)
+    print(json.dumps({'engine': engine, 'rooms': rooms,
+                      'recording': sum(1 for cr in recorders if cr.ws_startTime > 0),
+                      'threads': threads_max,
+                      'rss_mb': round(rss_max / 1024.0, 1),
+                      'rss_delta_mb': round((rss_max - rss_start) / 1024.0, 1),
+                      'cpu_percent': round(100.0 * cpu / wall, 1),
+                      'comments': comments}))
+
+
+def main():
+    parser = ArgumentParser(description='Compare thread count, RSS and CPU of the recorder engines')
+    parser.add_argument('--rooms', type=int, nargs='+', default=[100, 500, 1000])
+    parser.add_argument('--duration', type=float, default=10, help='seconds to measure (default: 10)')
+    parser.add_argument('--rate', type=float, default=1, help='messages per second per room (default: 1)')
+    parser.add_argument('--port', type=int, default=18765)
+    parser.add_argument('--measure', choices=['threads', 'asyncio'], help=SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.measure, args.rooms[0], args.duration, args.port)
+        return
+
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=run_server, args=(args.port, args.rate, ready), daemon=True)
+    server.start()
+    if not ready.wait(10):
+        sys.exit('Failed to start the simulated broadcast server on port {}'.format(args.port))
+
+    results = []
+    print('{:>8} {:>6} {:>8} {:>9} {:>10} {:>7} {:>9}'.format(
+        'engine', 'rooms', 'threads', 'rss(MB)', 'delta(MB)', 'cpu%', 'comments'))
+    try:
+        for rooms in args.rooms:
+            for engine in ('threads', 'asyncio'):
+                out = subprocess.run([sys.executable, os.path.abspath(__file__), '--measure', engine,
+                                      '--rooms', str(rooms), '--duration', str(args.duration),
+                                      '--port', str(args.port)],
+                                     stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+                r = json.loads(out.stdout.decode('utf-8').strip().splitlines()[-1])
+                results.append(r)
+                print('{:>8} {:>6} {:>8} {:>9} {:>10} {:>7} {:>9}'.format(
+                    r['engine'], r['rooms'], r['threads'], r['rss_mb'], r['rss_delta_mb'],
+                    r['cpu_percent'], r['comments']))
+    finally:
+        server.terminate()
+    return results
+
+
+if __name__ == '__main__':
+    main()
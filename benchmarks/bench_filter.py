@@ -0,0 +1,74 @@
+"""
+Measure CommentRecorder.ws_on_message(): decoding, filtering and storing a stream of messages
+
+Frames of the benchmarks generator are handed to a recorder which is not connected,
+with the compact comment store and with the list of whole messages. The kept messages
+are checked against the filter of the generator (no gifts, gift reports nor counting comments).
+The compact store is also measured with the comments repeated within 10 seconds collapsed ("×k").
+
+Usage:
+    python benchmarks/bench_filter.py
+    python benchmarks/bench_filter.py --frames 100000 500000
+"""
+import os
+import sys
+import time
+import logging
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sr_danmaku  # noqa: E402
+from benchmarks import generator  # noqa: E402
+
+
+def bench(n, seed=1):
+    messages = generator.messages(n, seed)
+    frames = generator.frames(messages)
+    expected = len(generator.recorded(messages))
+
+    logging.disable(logging.CRITICAL)
+    results = {}
+    for store, compact, dedup in (('compact', 1, 0), ('list', 0, 0), ('dedup', 1, 10)):
+        settings = generator.default_settings(compact_comment_store=compact, dedup_window=dedup,
+                                              dedup_count_suffix=1)
+        cr = sr_danmaku.CommentRecorder('BENCH', {'main_name': 'bench', 'room_id': 1}, settings)
+        on_message = cr.ws_on_message
+        startTime = time.perf_counter()
+        for frame in frames:
+            on_message(None, frame)
+        if cr.dedup is not None:
+            for data in cr.dedup.flush():
+                cr.appendMessage(data)
+        elapsed = time.perf_counter() - startTime
+        results[store] = (elapsed, len(cr.comment_log))
+    logging.disable(logging.NOTSET)
+
+    return {'frames': n, 'kept': expected,
+            'identical': results['compact'][1] == expected and results['list'][1] == expected,
+            'compact_us': round(results['compact'][0] * 1e6 / n, 3),
+            'list_us': round(results['list'][0] * 1e6 / n, 3),
+            'dedup_kept': results['dedup'][1],
+            'dedup_us': round(results['dedup'][0] * 1e6 / n, 3)}
+
+
+def main():
+    parser = ArgumentParser(description='Measure decoding, filtering and storing of the recorded messages')
+    parser.add_argument('--frames', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print('{:>9} {:>9} {:>9} {:>18} {:>15} {:>11} {:>16}'.format(
+        'frames', 'kept', 'identical', 'compact(us/frame)', 'list(us/frame)', 'dedup kept', 'dedup(us/frame)'))
+    results = []
+    for n in args.frames:
+        r = bench(n, args.seed)
+        results.append(r)
+        print('{:>9} {:>9} {:>9} {:>18} {:>15} {:>11} {:>16}'.format(
+            r['frames'], r['kept'], str(r['identical']), r['compact_us'], r['list_us'], r['dedup_kept'],
+            r['dedup_us']))
+    return results
+
+
+if __name__ == '__main__':
+    main()
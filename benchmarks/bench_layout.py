@@ -0,0 +1,139 @@
+"""
+Compare the heap-based DanmakuLayout slot allocator with the linear slot search it replaced
+
+Dense comment storms (many comments per second, so that most slots are busy) are laid out
+on screens with few and many slots, and the selected slots are checked to be identical.
+The same storms are then laid out with at most --max-bullets comments on screen (max_bullets),
+and the delayed and dropped comments and the most comments on screen at a time are counted.
+
+Usage:
+    python benchmarks/bench_layout.py
+    python benchmarks/bench_layout.py --comments 200000 --rates 50 500 --slots 20 90 --max-bullets 10 30
+"""
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sr_danmaku  # noqa: E402
+from benchmarks import generator  # noqa: E402
+
+TRAVEL_TIME = 8 * 1000
+
+
+def legacy_layout(times, slotsNum):
+    """ the slot search of convert_comments_to_danmaku() before DanmakuLayout """
+    slots = [0] * slotsNum
+    selected = []
+    for t in times:
+        selectedSlot = 0
+        isSlotFound = False
+        for j in range(slotsNum):
+            if slots[j] <= t:
+                slots[j] = t + TRAVEL_TIME
+                isSlotFound = True
+                selectedSlot = j
+                break
+
+        if not isSlotFound:
+            minIdx = 0
+            for j in range(1, slotsNum):
+                if slots[j] < slots[minIdx]:
+                    minIdx = j
+
+            slots[minIdx] = t + TRAVEL_TIME
+            selectedSlot = minIdx
+        selected.append(selectedSlot)
+    return selected
+
+
+def heap_layout(times, slotsNum):
+    layout = sr_danmaku.DanmakuLayout(slotsNum)
+    allocate = layout.allocate
+    return [allocate(t, TRAVEL_TIME) for t in times]
+
+
+def peak_bullets(intervals):
+    """ :return the most (start, end) intervals overlapping at a time """
+    events = sorted([(start, 1) for start, _ in intervals] + [(end, -1) for _, end in intervals])
+    n = peak = 0
+    for _, k in events:
+        n += k
+        peak = max(peak, n)
+    return peak
+
+
+def bench_density(n, rate, slotsNum, maxBullets, maxDelay=2000, seed=1):
+    times = generator.comment_times(n, rate, seed)
+    layout = sr_danmaku.DanmakuLayout(slotsNum)
+    startTime = time.perf_counter()
+    selected = [layout.allocateWithin(t, TRAVEL_TIME, maxBullets, maxDelay) for t in times]
+    elapsed = time.perf_counter() - startTime
+
+    kept = []
+    shifted = 0
+    for t, s in zip(times, selected):
+        if s is not None:
+            kept.append((s[1], s[1] + TRAVEL_TIME))
+            if s[1] > t:
+                shifted += 1
+    return {'comments': n, 'rate': rate, 'slots': slotsNum, 'max_bullets': maxBullets,
+            'kept': len(kept), 'shifted': shifted, 'dropped': n - len(kept),
+            'peak': peak_bullets(kept), 'density_us': round(elapsed * 1e6 / n, 3)}
+
+
+def bench(n, rate, slotsNum, seed=1):
+    times = generator.comment_times(n, rate, seed)
+    startTime = time.perf_counter()
+    legacy = legacy_layout(times, slotsNum)
+    legacy_time = time.perf_counter() - startTime
+
+    startTime = time.perf_counter()
+    heap = heap_layout(times, slotsNum)
+    heap_time = time.perf_counter() - startTime
+
+    unsorted = generator.comment_times(n // 10, rate, seed + 1, shuffled=0.01)
+    identical = legacy == heap and legacy_layout(unsorted, slotsNum) == heap_layout(unsorted, slotsNum)
+    return {'comments': n, 'rate': rate, 'slots': slotsNum, 'identical': identical,
+            'legacy_us': round(legacy_time * 1e6 / n, 3), 'heap_us': round(heap_time * 1e6 / n, 3)}
+
+
+def main():
+    parser = ArgumentParser(description='Compare the heap-based slot allocator with the linear slot search')
+    parser.add_argument('--comments', type=int, default=200000)
+    parser.add_argument('--rates', type=float, nargs='+', default=[5, 50, 500],
+                        help='comments per second (default: 5 50 500)')
+    parser.add_argument('--slots', type=int, nargs='+', default=[20, 60, 90],
+                        help='slots on screen, e.g. 20 = 360/18, 90 = 1080/12 (default: 20 60 90)')
+    parser.add_argument('--max-bullets', type=int, nargs='+', default=[10],
+                        help='most comments on screen for the density layout (default: 10)')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print('{:>6} {:>6} {:>9} {:>16} {:>14}'.format('rate', 'slots', 'identical', 'legacy(us/cmt)', 'heap(us/cmt)'))
+    results = []
+    for rate in args.rates:
+        for slotsNum in args.slots:
+            r = bench(args.comments, rate, slotsNum, args.seed)
+            results.append(r)
+            print('{:>6} {:>6} {:>9} {:>16} {:>14}'.format(
+                r['rate'], r['slots'], str(r['identical']), r['legacy_us'], r['heap_us']))
+
+    print()
+    print('{:>6} {:>6} {:>11} {:>8} {:>8} {:>8} {:>6} {:>16}'.format(
+        'rate', 'slots', 'max_bullets', 'kept', 'delayed', 'dropped', 'peak', 'density(us/cmt)'))
+    for rate in args.rates:
+        for slotsNum in args.slots:
+            for maxBullets in args.max_bullets:
+                r = bench_density(args.comments, rate, slotsNum, min(maxBullets, slotsNum), seed=args.seed)
+                results.append(r)
+                print('{:>6} {:>6} {:>11} {:>8} {:>8} {:>8} {:>6} {:>16}'.format(
+                    r['rate'], r['slots'], r['max_bullets'], r['kept'], r['shifted'], r['dropped'], r['peak'],
+                    r['density_us']))
+    return results
+
+
+if __name__ == '__main__':
+    main()
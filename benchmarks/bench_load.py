@@ -0,0 +1,169 @@
+"""
+End-to-end load test: the RoomMonitor records N rooms of a local mock Showroom server
+
+The mock server (benchmarks/mock_showroom.py, in its own process) serves the Showroom API and pushes
+MSG frames with their send time to every recording room. The recorder runs in a fresh process with
+api_base_url pointing to the mock, and its throughput (recorded messages per second), the latency
+from the send time to the storing of each message (queueing included), and its thread count, RSS and CPU are measured.
+The mean time from a room seen on live to its first frame (live_start_seconds) is measured over the warm up,
+with the API answering after --api-delay seconds like the real site, and with the room cache
+of an earlier run (--cached) for the speculative connections.
+
+Usage:
+    python benchmarks/bench_load.py
+    python benchmarks/bench_load.py --rooms 100 1000 --rate 5 --duration 20 --engine asyncio
+    python benchmarks/bench_load.py --rooms 100 --api-delay 0.3 --cached
+"""
+import os
+import sys
+import time
+import json
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from argparse import ArgumentParser, SUPPRESS
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sr_danmaku  # noqa: E402
+from benchmarks import generator, mock_showroom  # noqa: E402
+from benchmarks.bench_engine import read_rss_kb  # noqa: E402
+
+
+def percentile(values, p):
+    """ :param values: sorted list """
+    if not values:
+        return None
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def measure(engine, rooms, duration, port, interval, cacheFile=''):
+    """ record the rooms of the mock server with one engine, print the measurement as JSON """
+    os.chdir(tempfile.mkdtemp(prefix='bench_load_'))
+
+    # the latency of every recorded message, from its send time in the mock server
+    latencies = []
+    appendMessage = sr_danmaku.CommentRecorder.appendMessage
+
+    def timedAppendMessage(self, data):
+        sent_at = data.get('sent_at')
+        if sent_at is not None:
+            latencies.append(int(time.time() * 1000) - sent_at)
+        appendMessage(self, data)
+
+    sr_danmaku.CommentRecorder.appendMessage = timedAppendMessage
+
+    settings = generator.default_settings(async_engine=1 if engine == 'asyncio' else 0, interval=interval,
+                                          api_base_url='http://127.0.0.1:{}'.format(port), room_cache_file=cacheFile,
+                                          room_cache_ttl=86400 if cacheFile else 0)
+    sr_danmaku.sr_client.base_url = settings['program_settings']['api_base_url']
+    sr_danmaku.sr_client.setPoolSize(max(32, rooms))  # as main() does for http_pool_size = 0
+    room_url_keys = ['MOCK_{:04d}'.format(i) for i in range(1, rooms + 1)]
+    rm = sr_danmaku.RoomMonitor(room_url_keys, settings)
+
+    startTime = time.perf_counter()
+    rm.start()
+    # warm up: until every room is recording
+    recording = 0
+    while time.perf_counter() - startTime < max(30, interval * 3):
+        recording = sum(1 for cr in list(rm.cRecords.values()) if cr is not None and cr.ws_startTime > 0)
+        if recording >= rooms:
+            break
+        time.sleep(0.5)
+    warmup = time.perf_counter() - startTime
+
+    first = len(latencies)
+    cpu_start = os.times()
+    wall_start = time.perf_counter()
+    threads_max = 0
+    rss_max = 0
+    while time.perf_counter() - wall_start < duration:
+        threads_max = max(threads_max, threading.active_count())
+        rss_max = max(rss_max, read_rss_kb())
+        time.sleep(0.5)
+    cpu_end = os.times()
+    wall = time.perf_counter() - wall_start
+    window = sorted(latencies[first:])
+    http = sr_danmaku.sr_client.stats()
+    live_start = sr_danmaku.metrics.live_start_seconds.snapshot()
+
+    rm.quit()
+
+    cpu = (cpu_end.user - cpu_start.user) + (cpu_end.system - cpu_start.system)
+    print(json.dumps({'engine': engine, 'rooms': rooms, 'recording': recording, 'warmup_s': round(warmup, 1),
+                      'msgs_per_s': round(len(window) / wall, 1),
+                      'latency_p50_ms': percentile(window, 50), 'latency_p99_ms': percentile(window, 99),
+                      'latency_max_ms': window[-1] if window else None,
+                      'threads': threads_max, 'rss_mb': round(rss_max / 1024.0, 1),
+                      'cpu_percent': round(100.0 * cpu / wall, 1),
+                      'http_requests': http['requests'], 'http_errors': http['errors'],
+                      'live_start_ms': round(1000 * live_start['sum'] / live_start['count']) if live_start['count']
+                      else None}))
+
+
+def main():
+    parser = ArgumentParser(description='Record the rooms of a local mock Showroom server, end to end')
+    parser.add_argument('--rooms', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--rate', type=float, default=5, help='messages per second per room (default: 5)')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to measure (default: 10)')
+    parser.add_argument('--engine', nargs='+', choices=['threads', 'asyncio'], default=['asyncio'])
+    parser.add_argument('--interval', type=int, default=5, help='seconds between onlives polls (default: 5)')
+    parser.add_argument('--api-delay', type=float, default=0, help='seconds before the mock answers the API')
+    parser.add_argument('--cached', action='store_true',
+                        help='record once to fill the room cache, then measure with it')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--measure', choices=['threads', 'asyncio'], help=SUPPRESS)
+    parser.add_argument('--cache-file', default='', help=SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.measure, args.rooms[0], args.duration, args.port, args.interval, args.cache_file)
+        return
+
+    print('{:>8} {:>6} {:>9} {:>8} {:>9} {:>8} {:>8} {:>8} {:>8} {:>8} {:>6} {:>14}'.format(
+        'engine', 'rooms', 'recording', 'msgs/s', 'p50(ms)', 'p99(ms)', 'max(ms)', 'threads', 'rss(MB)',
+        'cpu%', 'http', 'live start(ms)'))
+    results = []
+    for rooms in args.rooms:
+        ready = multiprocessing.Event()
+        server = multiprocessing.Process(target=mock_showroom.run, daemon=True,
+                                         kwargs={'rooms': rooms, 'rate': args.rate, 'port': args.port,
+                                                 'seed': args.seed, 'ready': ready, 'api_delay': args.api_delay})
+        server.start()
+        if not ready.wait(30):
+            server.terminate()
+            sys.exit('Failed to start the mock Showroom server on port {}'.format(args.port))
+        try:
+            for engine in args.engine:
+                command = [sys.executable, os.path.abspath(__file__), '--measure', engine, '--rooms', str(rooms),
+                           '--duration', str(args.duration), '--interval', str(args.interval),
+                           '--port', str(args.port)]
+                if args.cached:
+                    # the lives of the mock never end, so the cache of the first run has other bcsvr_keys
+                    cacheFile = os.path.join(tempfile.mkdtemp(prefix='bench_load_'), 'room_cache.json')
+                    subprocess.run(command + ['--cache-file', cacheFile, '--duration', '0'],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+                    with open(cacheFile, 'r', encoding='utf8') as fp:
+                        cache = json.load(fp)
+                    for room in cache.values():
+                        room['bcsvr_key'] = ''
+                    with open(cacheFile, 'w', encoding='utf8') as fp:
+                        json.dump(cache, fp)
+                    command += ['--cache-file', cacheFile]
+                out = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+                r = json.loads(out.stdout.decode('utf-8').strip().splitlines()[-1])
+                results.append(r)
+                print('{:>8} {:>6} {:>9} {:>8} {:>9} {:>8} {:>8} {:>8} {:>8} {:>8} {:>6} {:>14}'.format(
+                    r['engine'], r['rooms'], r['recording'], r['msgs_per_s'], str(r['latency_p50_ms']),
+                    str(r['latency_p99_ms']), str(r['latency_max_ms']), r['threads'], r['rss_mb'],
+                    r['cpu_percent'], r['http_requests'], str(r['live_start_ms'])))
+        finally:
+            server.terminate()
+            server.join()
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Measure the cost of one RoomMonitor poll: matching the watched rooms with the onlives list
+
+The indexed RoomMonitor.poll() is compared with the nested loop that RoomMonitor.monitor()
+used before (every watched room against every live room).
+The answers of the liveness snapshot are checked too, e.g. that an onlives list still showing
+the previous live of a quickly restarted room does not end the new one.
+
+Usage:
+    python benchmarks/bench_monitor.py
+    python benchmarks/bench_monitor.py --watched 1500 10000 --lives 2000 5000
+"""
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sr_danmaku  # noqa: E402
+from benchmarks import generator  # noqa: E402
+
+
+class DummyRecorder:
+    isRecording = True
+    isFinished = False
+
+    def __init__(self, room_url_key, room):
+        self.room_url_key = room_url_key
+        self.room_name = room['main_name']
+
+
+class BenchRoomMonitor(sr_danmaku.RoomMonitor):
+    """ RoomMonitor which doesn't start real recorders """
+
+    def startRecorder(self, room_url_key, room):
+        return DummyRecorder(room_url_key, room)
+
+
+def legacy_poll(room_url_keys, cRecords, room_all):
+    """ the matching loop of RoomMonitor.monitor() before it was indexed """
+    for i in range(len(room_url_keys)):
+        if cRecords[i] is not None:
+            if cRecords[i].isRecording:
+                continue
+            else:
+                cRecords[i] = None
+
+        for room in room_all:
+            if room_url_keys[i] == room['room_url_key']:
+                cRecords[i] = DummyRecorder(room_url_keys[i], room)
+                continue
+
+
+def check_liveness():
+    """ :return True when LivenessSnapshot.isLive() answers as expected """
+    snapshot = sr_danmaku.LivenessSnapshot()
+    snapshot.publish([{'room_id': 1, 'room_url_key': 'room_1', 'live_id': 100},
+                      {'room_id': 2, 'room_url_key': 'room_2', 'live_id': None}])
+    cases = [((1, 100), True),  # the recorded live
+             ((1, 99), False),  # a newer live has started
+             ((1, 101), None),  # onlives still lists the previous live, ask is_live
+             ((1, None), True),
+             ((2, 100), True),
+             ((3, 100), None)]  # not on onlives
+    return all(snapshot.isLive(*args) is expected for args, expected in cases)
+
+
+def bench(watched, lives, repeat, legacy_limit, seed=1):
+    settings = generator.default_settings()
+    watched_keys = ['watched_{}'.format(i) for i in range(watched)]
+    snapshots = [generator.onlives(lives, watched_keys, 0.1, seed + k) for k in range(repeat)]
+
+    rm = BenchRoomMonitor(watched_keys, settings)
+    rm.cRecords = dict.fromkeys(watched_keys)
+    startTime = time.perf_counter()
+    for room_all in snapshots:
+        rm.liveness.publish(room_all)
+        rm.poll()
+    indexed = (time.perf_counter() - startTime) / repeat
+
+    legacy = None
+    if watched * lives <= legacy_limit:
+        cRecords = [None] * watched
+        startTime = time.perf_counter()
+        for room_all in snapshots:
+            legacy_poll(watched_keys, cRecords, room_all)
+        legacy = (time.perf_counter() - startTime) / repeat
+
+    return {'watched': watched, 'lives': lives, 'liveness_ok': check_liveness(),
+            'indexed_ms': round(indexed * 1000.0, 3),
+            'legacy_ms': round(legacy * 1000.0, 3) if legacy is not None else None}
+
+
+def main():
+    parser = ArgumentParser(description='Measure the cost of one RoomMonitor poll')
+    parser.add_argument('--watched', type=int, nargs='+', default=[100, 1500, 10000])
+    parser.add_argument('--lives', type=int, nargs='+', default=[2000, 5000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--legacy-limit', type=int, default=20000000,
+                        help='skip the legacy loop above watched x lives comparisons (default: 2e7)')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print('{:>8} {:>6} {:>11} {:>12} {:>12}'.format('watched', 'lives', 'liveness_ok', 'indexed(ms)', 'legacy(ms)'))
+    results = []
+    for watched in args.watched:
+        for lives in args.lives:
+            r = bench(watched, lives, args.repeat, args.legacy_limit, args.seed)
+            results.append(r)
+            print('{:>8} {:>6} {:>11} {:>12} {:>12}'.format(r['watched'], r['lives'], str(r['liveness_ok']),
+                                                          r['indexed_ms'],
+                                                          r['legacy_ms'] if r['legacy_ms'] is not None else '-'))
+    return results
+
+
+if __name__ == '__main__':
+    main()
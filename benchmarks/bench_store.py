@@ -0,0 +1,88 @@
+"""
+Measure the memory per recorded message of comment_log: a list of decoded message dicts,
+compared with CommentStore (with and without the raw JSON kept for the log file)
+
+Messages of the benchmarks generator are decoded from JSON, with the 'received_at' added
+by the recorder. The rendered ass files are checked to be identical.
+
+Usage:
+    python benchmarks/bench_store.py
+    python benchmarks/bench_store.py --messages 100000 --distinct 0.3
+"""
+import os
+import sys
+import io
+import json
+import tracemalloc
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sr_danmaku  # noqa: E402
+from benchmarks import generator  # noqa: E402
+
+
+def make_messages(n, distinct, seed=1):
+    """
+    :param distinct: ratio of comments with a new text, the others repeat earlier texts (888, www, ...)
+    :return list of JSON strings of the messages kept by the recorder in a stream of n
+    """
+    return [json.dumps(data, ensure_ascii=False)
+            for data in generator.recorded(generator.messages(n, seed, distinct=distinct))]
+
+
+def measure(store, messages):
+    """ :return bytes per message held by the store """
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    for message in messages:
+        store.append(json.loads(message))
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    return used / len(messages)
+
+
+def bench(n, distinct, seed=1):
+    messages = make_messages(n, distinct, seed)
+
+    dicts = []
+    dict_bytes = measure(dicts, messages)
+    compact = sr_danmaku.CommentStore()
+    compact_bytes = measure(compact, messages)
+    raw = sr_danmaku.CommentStore(keepRaw=True)
+    raw_bytes = measure(raw, messages)
+
+    ass_dicts = io.StringIO()
+    sr_danmaku.write_danmaku(ass_dicts, dicts[0]['received_at'], dicts)
+    ass_compact = io.StringIO()
+    sr_danmaku.write_danmaku(ass_compact, dicts[0]['received_at'], compact)
+    logs = [json.dumps(data, ensure_ascii=False) for data in dicts]
+    identical = ass_dicts.getvalue() == ass_compact.getvalue() and logs == list(raw.iterRaw())
+
+    return {'messages': n, 'distinct': distinct, 'identical': identical,
+            'dict_bytes': round(dict_bytes), 'compact_bytes': round(compact_bytes),
+            'compact_raw_bytes': round(raw_bytes)}
+
+
+def main():
+    parser = ArgumentParser(description='Measure the memory per message of comment_log')
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--distinct', type=float, nargs='+', default=[0.1, 0.5, 1.0],
+                        help='ratio of comments with a new text (default: 0.1 0.5 1.0)')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print('{:>9} {:>9} {:>9} {:>12} {:>15} {:>19}'.format(
+        'messages', 'distinct', 'identical', 'dict(B/msg)', 'compact(B/msg)', 'compact+raw(B/msg)'))
+    results = []
+    for distinct in args.distinct:
+        r = bench(args.messages, distinct, args.seed)
+        results.append(r)
+        print('{:>9} {:>9} {:>9} {:>12} {:>15} {:>19}'.format(
+            r['messages'], r['distinct'], str(r['identical']), r['dict_bytes'], r['compact_bytes'],
+            r['compact_raw_bytes']))
+    return results
+
+
+if __name__ == '__main__':
+    main()
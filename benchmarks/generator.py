@@ -0,0 +1,163 @@
+"""
+Seeded generator of synthetic Showroom broadcast messages, shared by the benchmarks
+
+The same seed always gives the same messages, so that results of different commits can be compared.
+A stream is a mix of comments (Japanese, English and emoji texts, many repeated), counting comments
+"1" to "50" which the recorder skips, gifts and gift reports (t = 2, 11) which it ignores,
+poll starts and results (t = 3, 4), telops (t = 8) and the end of live marker (t = 101).
+"""
+import os
+import sys
+import json
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sr_danmaku  # noqa: E402
+
+START_TIME = 1577193934000  # ms
+
+# share of each message kind in a stream
+DEFAULT_MIX = {
+    'comment': 0.55,
+    'counting': 0.10,
+    'gift': 0.28,
+    'gift_report': 0.03,
+    'telop': 0.02,
+    'poll_start': 0.005,
+    'poll_result': 0.015,
+}
+
+WORDS = ['こんばんは', 'かわいい', 'www', '888888', 'おつかれさま', 'すごい！', '歌うまい', 'hello', 'nice',
+         '🎉🎉', '😂', '❤️', '初見です', 'ありがとう', '神回', '大好き', '草', 'ｗｗｗ']
+NAMES = ['あや', 'ゆき', 'Ken', 'さくら', 'たろう', 'Mika', 'ひな']
+
+
+def default_settings(**program_settings):
+    """ :return the settings of a new sr_danmaku.ini, with some program settings changed """
+    settings = sr_danmaku.defaultSettings()
+    settings['program_settings'].update(program_settings)
+    return settings
+
+
+def messages(n, seed=1, rate=10.0, distinct=0.3, mix=None, start=START_TIME, end_marker=True):
+    """
+    :param n: number of messages
+    :param rate: messages per second, the arrival times are random (bursts included)
+    :param distinct: ratio of comments with a new text, the others repeat earlier texts
+    :param mix: share of each message kind, default: DEFAULT_MIX
+    :param end_marker: the last message is the end of live marker (t = 101)
+    :return list of messages as decoded by the recorder, with their 'received_at' (ms)
+    """
+    rnd = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    texts = list(WORDS)
+    received_at = start
+    telop = 0
+    result = []
+    for i in range(n - 1 if end_marker else n):
+        received_at += int(rnd.expovariate(rate) * 1000)
+        created_at = received_at // 1000
+        kind = rnd.choices(kinds, weights)[0]
+        if kind == 'comment':
+            if rnd.random() < distinct:
+                text = '{}さん、'.format(rnd.choice(NAMES)) + ' '.join(
+                    rnd.choice(WORDS) for _ in range(rnd.randint(1, 4))) + ' #{}'.format(i)
+                texts.append(text)
+            else:
+                text = rnd.choice(texts)
+            data = {'av': rnd.randint(1, 1100000), 'd': 0, 'ac': 'ユーザー{}'.format(rnd.randint(1, 5000)),
+                    'cm': text, 'created_at': created_at, 'u': rnd.randint(100000, 9999999), 'at': 0, 't': '1'}
+        elif kind == 'counting':
+            data = {'av': rnd.randint(1, 1100000), 'd': 0, 'ac': 'ユーザー{}'.format(rnd.randint(1, 5000)),
+                    'cm': str(rnd.randint(1, 50)), 'created_at': created_at, 'u': rnd.randint(100000, 9999999),
+                    'at': 0, 't': '1'}
+        elif kind == 'gift':
+            data = {'n': rnd.randint(1, 10), 'av': rnd.randint(1, 1100000), 'ac': 'ユーザー{}'.format(
+                rnd.randint(1, 5000)), 'created_at': created_at, 'u': rnd.randint(100000, 9999999), 'h': 0,
+                    'g': rnd.choice([1, 2, 1601, 3000032]), 'gt': 2, 'at': 0, 't': 2}
+        elif kind == 'gift_report':
+            data = {'created_at': created_at, 't': 11,
+                    'gifts': [{'g': 1601, 'n': rnd.randint(1, 100)} for _ in range(3)]}
+        elif kind == 'telop':
+            if rnd.random() < 0.2:
+                telop += 1
+            data = {'telop': 'テロップ {} 🎤'.format(telop), 'api': 'https://www.showroom-live.com/live/telop',
+                    'created_at': created_at, 't': 8}
+        elif kind == 'poll_start':
+            data = {'l': [{'id': 10001 + k} for k in range(rnd.randint(2, 7))], 'created_at': created_at, 't': 3}
+        else:  # poll_result
+            data = {'l': [{'id': 10001 + k, 'r': rnd.randint(0, 100), 'n': rnd.randint(0, 900)}
+                          for k in range(rnd.randint(2, 7))], 'created_at': created_at, 't': 4}
+        data['received_at'] = received_at
+        result.append(data)
+
+    if end_marker:
+        received_at += 1000
+        result.append({'created_at': received_at // 1000, 't': 101, 'received_at': received_at})
+    return result
+
+
+def frames(messages, key='bench', broken=0.0, seed=1):
+    """
+    :param broken: ratio of frames cut before their end, as sometimes received
+    :return list of frames 'MSG\\t<key>\\t{...}' (bytes) as sent by the broadcast server
+    """
+    rnd = random.Random(seed)
+    envelope = 'MSG\t{}\t'.format(key)
+    result = []
+    for data in messages:
+        data = {k: v for k, v in data.items() if k != 'received_at'}
+        message = envelope + json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+        if broken > 0 and data['t'] == '1' and rnd.random() < broken:
+            message = message[:message.find('","created_at"')]
+        result.append(message.encode('utf-8'))
+    return result
+
+
+def recorded(messages):
+    """ :return the messages kept by the recorder: no gifts, gift reports, nor counting comments """
+    result = []
+    for data in messages:
+        m_type = str(data['t'])
+        if m_type in ('2', '11'):
+            continue
+        if m_type == '1':
+            comment = data['cm']
+            if len(comment) < 3 and comment.isdecimal() and int(comment) <= 50:
+                continue
+        result.append(data)
+    return result
+
+
+def comment_times(n, rate, seed=1, shuffled=0.0):
+    """
+    :param rate: comments per second, a storm when high
+    :param shuffled: ratio of swapped neighbours, as when the clock goes backwards
+    :return comment times (ms) from 0
+    """
+    rnd = random.Random(seed)
+    t = 0
+    times = []
+    for i in range(n):
+        t += int(rnd.expovariate(rate) * 1000)
+        times.append(t)
+    for i in range(int(n * shuffled)):
+        j = rnd.randrange(n - 1)
+        times[j], times[j + 1] = times[j + 1], times[j]
+    return times
+
+
+def onlives(n, watched_keys, watched_ratio=0.1, seed=1):
+    """ :return a list of n rooms on live like /api/live/onlives, about watched_ratio of them watched """
+    rnd = random.Random(seed)
+    rooms = []
+    for i in range(n):
+        if rnd.random() < watched_ratio:
+            key = rnd.choice(watched_keys)
+        else:
+            key = 'room_{}'.format(i)
+        rooms.append({'room_url_key': key, 'room_id': i, 'live_id': 1000000 + i, 'main_name': key})
+    return rooms
@@ -0,0 +1,326 @@
+"""
+Local stand-in for the Showroom site and its broadcast servers, for load testing without production
+
+One port serves both:
+    /api/live/onlives             rooms on live, like the Showroom API, with an ETag (304 when unchanged)
+    /api/live/live_info?room_id=  bcsvr_key, bcsvr_host and bcsvr_port of the live, pointing to this server
+    /room/is_live?room_id=        {"ok": 1} or {"ok": 0}
+    WebSocket                     after 'SUB\\t<bcsvr_key>', MSG frames of the benchmarks generator
+                                  at a rate per room, and the end of live marker (t = 101) when the live ends
+
+Lives start and end at random: a live lasts --live-seconds and a room is off for --off-seconds on average
+(0: forever). --api-delay adds the round-trip time of the real site to every API response.
+Point the recorder to it with 'api_base_url = http://127.0.0.1:18080' in sr_danmaku.ini,
+and the rooms MOCK_0001, MOCK_0002, ... in rooms.ini (written by --rooms-file).
+
+Usage:
+    python -m benchmarks.mock_showroom --rooms 1000 --rate 5
+    python -m benchmarks.mock_showroom --rooms 100 --live-seconds 60 --off-seconds 30 --rooms-file rooms.ini
+"""
+import os
+import sys
+import time
+import json
+import base64
+import random
+import hashlib
+import asyncio
+import urllib.parse
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import generator  # noqa: E402
+
+GENRE_ID = 102  # Idol
+
+
+def ws_frame(payload, opcode=0x1):
+    """ build an unmasked server to client frame """
+    length = len(payload)
+    if length < 126:
+        header = bytes([0x80 | opcode, length])
+    elif length < 65536:
+        header = bytes([0x80 | opcode, 126]) + length.to_bytes(2, 'big')
+    else:
+        header = bytes([0x80 | opcode, 127]) + length.to_bytes(8, 'big')
+    return header + payload
+
+
+def ws_accept(key):
+    """ :return the Sec-WebSocket-Accept of a Sec-WebSocket-Key """
+    return base64.b64encode(
+        hashlib.sha1((key + '258EAFA5-E914-47DA-95CA-C5AB0DC85B11').encode('utf-8')).digest()).decode('utf-8')
+
+
+async def ws_read_frame(reader):
+    """ :return (opcode, payload) of a client frame (masked) """
+    header = await reader.readexactly(2)
+    opcode = header[0] & 0x0f
+    length = header[1] & 0x7f
+    if length == 126:
+        length = int.from_bytes(await reader.readexactly(2), 'big')
+    elif length == 127:
+        length = int.from_bytes(await reader.readexactly(8), 'big')
+    mask = await reader.readexactly(4) if header[1] & 0x80 else b'\0\0\0\0'
+    payload = await reader.readexactly(length)
+    return opcode, bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+
+
+class MockRoom:
+    def __init__(self, room_id, rnd):
+        self.room_id = room_id
+        self.room_url_key = 'MOCK_{:04d}'.format(room_id)
+        self.main_name = 'モック {}'.format(room_id)
+        self.live_id = 0
+        self.bcsvr_key = ''
+        self.started_at = 0
+        self.view_num = 0
+        self.changes_at = 0.0  # time.time() of the next start or end, 0: never
+        self.subscribers = set()  # asyncio.Event of the connections, set when the live ends
+        self.rnd = rnd
+
+    @property
+    def isLive(self):
+        return len(self.bcsvr_key) > 0
+
+    def startLive(self, live_id):
+        self.live_id = live_id
+        self.bcsvr_key = '{:x}:{}'.format(self.room_id, live_id)
+        self.started_at = int(time.time())
+        self.view_num = self.rnd.randint(10, 5000)
+
+    def endLive(self):
+        self.bcsvr_key = ''
+        for ended in self.subscribers:
+            ended.set()
+
+    def onlive(self):
+        """ :return the room as in the lives of /api/live/onlives """
+        return {'room_url_key': self.room_url_key, 'official_lv': 1, 'started_at': self.started_at,
+                'live_id': self.live_id, 'genre_id': GENRE_ID, 'main_name': self.main_name, 'cell_type': 102,
+                'view_num': self.view_num, 'bcsvr_key': self.bcsvr_key, 'room_id': self.room_id}
+
+
+class MockShowroom:
+    def __init__(self, rooms, rate, live_ratio=1.0, live_seconds=0.0, off_seconds=0.0, host='127.0.0.1',
+                 port=18080, seed=1, api_delay=0.0):
+        """
+        :param rate: messages per second per room
+        :param live_ratio: ratio of the rooms on live at start
+        :param live_seconds: average length of a live, 0: lives never end
+        :param off_seconds: average time between two lives of a room, 0: a room never starts again
+        :param api_delay: seconds before answering an API request
+        """
+        self.rnd = random.Random(seed)
+        self.rooms = {i: MockRoom(i, self.rnd) for i in range(1, rooms + 1)}
+        self.rooms_by_key = {}
+        self.rate = rate
+        self.live_seconds = live_seconds
+        self.off_seconds = off_seconds
+        self.host = host
+        self.port = port
+        self.api_delay = api_delay
+        self._next_live_id = 10000000
+        # the frames are built once, and only "sent_at" is added when sending
+        self.stream = [frame[:-1] for frame in
+                       generator.frames(generator.messages(10000, seed, end_marker=False), key='mock')]
+
+        now = time.time()
+        for room in self.rooms.values():
+            if self.rnd.random() < live_ratio:
+                self.startLive(room, now)
+            elif off_seconds > 0:
+                room.changes_at = now + self.rnd.expovariate(1.0 / off_seconds)
+
+        self.http_count = 0
+        self.ws_count = 0
+        self.frame_count = 0
+
+    def startLive(self, room, now):
+        self._next_live_id += 1
+        room.startLive(self._next_live_id)
+        self.rooms_by_key[room.bcsvr_key] = room
+        room.changes_at = now + self.rnd.expovariate(1.0 / self.live_seconds) if self.live_seconds > 0 else 0.0
+
+    def endLive(self, room, now):
+        self.rooms_by_key.pop(room.bcsvr_key, None)
+        room.endLive()
+        room.changes_at = now + self.rnd.expovariate(1.0 / self.off_seconds) if self.off_seconds > 0 else 0.0
+
+    async def schedule(self):
+        """ start and end the lives """
+        while True:
+            await asyncio.sleep(0.5)
+            now = time.time()
+            for room in self.rooms.values():
+                if 0 < room.changes_at <= now:
+                    if room.isLive:
+                        self.endLive(room, now)
+                    else:
+                        self.startLive(room, now)
+
+    def api(self, path, query):
+        """ :return (status, JSON object) of an API request """
+        if path == '/api/live/onlives':
+            lives = [room.onlive() for room in self.rooms.values() if room.isLive]
+            popular = sorted(lives, key=lambda x: x['view_num'], reverse=True)[:50]
+            return 200, {'onlives': [{'genre_id': 0, 'genre_name': 'Popularity', 'lives': popular},
+                                     {'genre_id': GENRE_ID, 'genre_name': 'Idol', 'lives': lives}]}
+
+        try:
+            room = self.rooms.get(int(query.get('room_id', [''])[0]))
+        except ValueError:
+            room = None
+        if room is None:
+            return 404, {'errors': [{'message': 'room not found'}]}
+        if path == '/api/live/live_info':
+            return 200, {'room_id': room.room_id, 'room_name': room.main_name,
+                         'live_status': 2 if room.isLive else 1, 'live_id': room.live_id if room.isLive else 0,
+                         'bcsvr_key': room.bcsvr_key, 'bcsvr_host': self.host, 'bcsvr_port': self.port}
+        if path == '/room/is_live':
+            return 200, {'ok': 1 if room.isLive else 0}
+        return 404, {'errors': [{'message': 'not found'}]}
+
+    async def serve_client(self, reader, writer):
+        try:
+            while True:
+                request = await reader.readuntil(b'\r\n\r\n')
+                lines = request.decode('latin-1').split('\r\n')
+                target = lines[0].split(' ')[1] if len(lines[0].split(' ')) > 2 else '/'
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                if headers.get('upgrade', '').lower() == 'websocket':
+                    await self.serve_websocket(reader, writer, headers.get('sec-websocket-key', ''))
+                    return
+
+                self.http_count += 1
+                if self.api_delay > 0:
+                    await asyncio.sleep(self.api_delay)
+                url = urllib.parse.urlsplit(target)
+                status, data = self.api(url.path, urllib.parse.parse_qs(url.query))
+                body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+                etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+                if status == 200 and headers.get('if-none-match') == etag:
+                    writer.write('HTTP/1.1 304 Not Modified\r\nETag: {}\r\nConnection: keep-alive\r\n\r\n'.format(
+                        etag).encode('latin-1'))
+                else:
+                    writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                                 'ETag: {}\r\nConnection: keep-alive\r\n\r\n'.format(
+                                     status, 'OK' if status == 200 else 'Not Found', len(body),
+                                     etag).encode('latin-1') + body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve_websocket(self, reader, writer, key):
+        writer.write(('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                      'Sec-WebSocket-Accept: ' + ws_accept(key) + '\r\n\r\n').encode('utf-8'))
+        self.ws_count += 1
+        subscribed = asyncio.Event()
+        ended = asyncio.Event()
+        rooms = []
+
+        async def read():
+            # SUB, pings, pongs and close from the recorder
+            try:
+                while True:
+                    opcode, payload = await ws_read_frame(reader)
+                    if opcode == 0x8:
+                        break
+                    if opcode == 0x1 and payload.startswith(b'SUB\t') and not rooms:
+                        room = self.rooms_by_key.get(payload[4:].decode('utf-8').strip())
+                        if room is None:
+                            break
+                        rooms.append(room)
+                        room.subscribers.add(ended)
+                        subscribed.set()
+            except (asyncio.IncompleteReadError, ConnectionError):
+                pass
+
+        reading = asyncio.ensure_future(read())
+        subscribing = asyncio.ensure_future(subscribed.wait())
+        try:
+            await asyncio.wait([reading, subscribing], return_when=asyncio.FIRST_COMPLETED)
+            n = self.rnd.randrange(len(self.stream))
+            interval = 1.0 / self.rate
+            nextTime = time.perf_counter()
+            while not reading.done() and not ended.is_set():
+                frame = self.stream[n % len(self.stream)] + b',"sent_at":%d}' % int(time.time() * 1000)
+                writer.write(ws_frame(frame))
+                self.frame_count += 1
+                n += 1
+                nextTime += interval
+                await asyncio.sleep(max(nextTime - time.perf_counter(), 0))
+            if ended.is_set():
+                end = {'created_at': int(time.time()), 't': 101}
+                writer.write(ws_frame(('MSG\tmock\t' + json.dumps(end)).encode('utf-8')))
+                writer.write(ws_frame(b'', 0x8))
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            for room in rooms:
+                room.subscribers.discard(ended)
+            reading.cancel()
+            subscribing.cancel()
+            writer.close()
+
+    async def serve(self, ready=None):
+        server = await asyncio.start_server(self.serve_client, self.host, self.port, backlog=4096)
+        scheduling = asyncio.ensure_future(self.schedule())
+        if ready is not None:
+            ready.set()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            scheduling.cancel()
+
+    def stats(self):
+        return {'lives': len(self.rooms_by_key), 'http_requests': self.http_count, 'ws_connections': self.ws_count,
+                'frames': self.frame_count}
+
+
+def run(rooms, rate, live_ratio=1.0, live_seconds=0.0, off_seconds=0.0, port=18080, seed=1, ready=None,
+        api_delay=0.0):
+    """ run a mock server until killed, e.g. in a multiprocessing.Process """
+    mock = MockShowroom(rooms, rate, live_ratio, live_seconds, off_seconds, port=port, seed=seed, api_delay=api_delay)
+    asyncio.run(mock.serve(ready))
+
+
+def main():
+    parser = ArgumentParser(prog='python -m benchmarks.mock_showroom',
+                            description='Local stand-in for the Showroom API and broadcast servers')
+    parser.add_argument('--rooms', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=5, help='messages per second per room (default: 5)')
+    parser.add_argument('--live-ratio', type=float, default=1.0, help='ratio of the rooms on live at start')
+    parser.add_argument('--live-seconds', type=float, default=0, help='average length of a live, 0: forever')
+    parser.add_argument('--off-seconds', type=float, default=0,
+                        help='average time between two lives of a room, 0: forever')
+    parser.add_argument('--api-delay', type=float, default=0, help='seconds before answering an API request')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--rooms-file', help='write the room url keys to this file, e.g. rooms.ini')
+    args = parser.parse_args()
+
+    mock = MockShowroom(args.rooms, args.rate, args.live_ratio, args.live_seconds, args.off_seconds,
+                        port=args.port, seed=args.seed, api_delay=args.api_delay)
+    if args.rooms_file:
+        with open(args.rooms_file, 'w', encoding='utf8') as fp:
+            fp.write('\n'.join(room.room_url_key for room in mock.rooms.values()) + '\n')
+    print('Mock Showroom on http://{}:{}, {} rooms, {} lives'.format(mock.host, mock.port, len(mock.rooms),
+                                                                     len(mock.rooms_by_key)))
+    try:
+        asyncio.run(mock.serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
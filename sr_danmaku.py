@@ -1,56 +1,194 @@
 import os
+import io
+import sys
 import time
 import datetime
 import threading
+import asyncio
+import base64
+import hashlib
+import gzip
+import struct
+import urllib.parse
 import json
 import math
+import bisect
+import heapq
 import random
 import logging
 import logging.handlers
+import http.server
+import queue
+import signal
+import sqlite3
+import multiprocessing
 
 from json import JSONDecodeError
+from array import array
+from collections import deque, OrderedDict
 from argparse import ArgumentParser
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 # requirements.txt
 import pytz
 import requests
 import websocket
 
+from requests.adapters import HTTPAdapter
 from websocket import ABNF
 from websocket import WebSocketConnectionClosedException
+from websocket import WebSocketException
+
+# optional, a faster JSON parser
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# optional, faster and smaller compression of comment archives than gzip
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 # from bs4 import BeautifulSoup
 
 
-def getOnLives():
-    # disable logging from 'requests'
-    logging.getLogger('urllib3').setLevel(logging.WARNING)
+class ShowroomClient:
+    """
+    Shared HTTP client for all Showroom API calls.
+    One requests.Session keeps the connections to www.showroom-live.com alive and pooled,
+    so the polling threads don't do a new TCP + TLS handshake on every request.
+    The connection pool of urllib3 is thread-safe, so one client is shared by all threads.
+    """
+    headers = {'User-Agent':
+                   'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.102 Safari/537.36'}
 
-    rand = int(random.random() * 1000)
-    sr_onlives_url = 'https://www.showroom-live.com/api/live/onlives' + '?' + str(rand)
-    headers = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.102 Safari/537.36'}
-    try:
-        r = requests.get(sr_onlives_url, headers=headers)
-    except requests.exceptions.ConnectionError as e:
-        logging.error('Connection error, wait for 60s...')
-        time.sleep(60)
-        return [], []
-    except Exception as e:
-        logging.error('getOnLives error, wait for 60s...: {} - {}'.format(type(e).__name__, e))
-        time.sleep(60)
-        return [], []
+    def __init__(self, timeout=10, pool_size=32, base_url='https://www.showroom-live.com'):
+        self.timeout = timeout  # seconds, for connecting and for reading
+        self.base_url = base_url  # the Showroom site, or a local mock server for load testing
+        self._session = requests.Session()
+        self._session.headers.update(self.headers)
+        self.setPoolSize(pool_size)
 
-    if r.status_code != 200:
-        logging.error('Failed to get lives info: {} - {}'.format(r.status_code, r.reason))
-        return [], []
+        self._lock = threading.Lock()
+        self.request_count = 0
+        self.error_count = 0
+        self.latency_total = 0.0  # seconds
+        self.latency_max = 0.0  # seconds
+
+    def setPoolSize(self, pool_size):
+        """
+        :param pool_size: the most connections kept open per host. More threads requesting at the same time
+            still get a connection, but it is closed afterwards
+        """
+        self._adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self._session.mount('https://', self._adapter)
+        self._session.mount('http://', self._adapter)
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        startTime = time.perf_counter()
+        isError = False
+        try:
+            return self._session.get(url, **kwargs)
+        except Exception:
+            isError = True
+            raise
+        finally:
+            latency = time.perf_counter() - startTime
+            with self._lock:
+                self.request_count += 1
+                if isError:
+                    self.error_count += 1
+                self.latency_total += latency
+                if latency > self.latency_max:
+                    self.latency_max = latency
+
+    def stats(self):
+        """
+        :return a dict of counters: requests, errors, new and reused connections, latency
+        """
+        connections = 0
+        pool_requests = 0
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                pool_requests += pool.num_requests
+
+        with self._lock:
+            n = self.request_count
+            return {'requests': n,
+                    'errors': self.error_count,
+                    'new_connections': connections,
+                    'reused_connections': max(pool_requests - connections, 0),
+                    'latency_avg_ms': round(self.latency_total * 1000.0 / n, 1) if n > 0 else 0.0,
+                    'latency_max_ms': round(self.latency_max * 1000.0, 1)}
+
+
+sr_client = ShowroomClient()
+
+
+class Histogram:
+    """
+    Cumulative histogram in the Prometheus way: counts of the observations <= each bucket bound,
+    their sum and their count. Only observed out of the per-message path (polls, finalizing)
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self._lock = threading.Lock()
+        self.sum = 0.0
+        self.count = 0
+        self.last = None
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[idx] += 1
+            self.sum += value
+            self.count += 1
+            self.last = value
+
+    def snapshot(self):
+        """ :return a dict of the cumulative bucket counts, sum, count and the last observation """
+        with self._lock:
+            counts = list(self._counts)
+            total, count, last = self.sum, self.count, self.last
+        cumulative = []
+        n = 0
+        for bound, k in zip(self.buckets + (float('inf'),), counts):
+            n += k
+            cumulative.append((bound, n))
+        return {'buckets': cumulative, 'sum': total, 'count': count, 'last': last}
+
+
+class Metrics:
+    """
+    Process-wide histograms. Per-room counters are plain attributes of the recorders,
+    only read when the metrics are collected (RoomMonitor.metrics()), so recording pays nothing for them
+    """
+
+    def __init__(self):
+        self.poll_seconds = Histogram((0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+        self.onlives_bytes = Histogram((16384, 65536, 131072, 262144, 524288, 1048576, 2097152, 4194304))
+        self.finalize_seconds = Histogram((0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60))
+        # from a room seen on live in onlives to the first frame of its broadcast server
+        self.live_start_seconds = Histogram((0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60))
+
+
+metrics = Metrics()
 
-    try:
-        data = json.loads(r.text)
-    except JSONDecodeError as e:
-        logging.error('Failed to get lives info: broken message, JSON decode error: {}'.format(e))
-        return [], []
 
+def parseOnLives(data):
+    """
+    :param data: the decoded /api/live/onlives
+    :return (room_all, pop_room), the rooms on live of all genres, and the popular ones
+    """
     room_all = []
     pop_room = []  # for Popularity
 
@@ -119,17 +257,281 @@ def getOnLives():
     return room_all, pop_room
 
 
+class OnLivesPoller:
+    """
+    Polls /api/live/onlives for RoomMonitor.
+    The request is conditional (If-None-Match, If-Modified-Since) when the API sent an ETag or Last-Modified,
+    and a payload with the same hash as the last one is not decoded again.
+    After an error the next poll is delayed with exponential backoff and jitter, instead of sleeping
+    in the monitor thread, and the wait is on an Event, so wake() (quitting) ends it at once
+    """
+
+    def __init__(self, interval, fast_interval=0, max_backoff=300):
+        """
+        :param interval: seconds between two polls
+        :param fast_interval: seconds between two polls when a watched room is expected to go on live, 0: off
+        :param max_backoff: seconds, the longest delay after errors
+        """
+        self.interval = interval
+        self.fast_interval = fast_interval
+        self.max_backoff = max(max_backoff, interval)
+        self.rooms = []  # all the rooms on live in the last onlives
+        self.delay = interval
+        self.failures = 0  # consecutive
+        self._etag = None
+        self._lastModified = None
+        self._digest = None
+        self._wakeup = threading.Event()
+
+        self.poll_count = 0
+        self.not_modified_count = 0
+        self.unchanged_count = 0
+        self.error_count = 0
+
+    def fetch(self):
+        """
+        :return (rooms, isChanged), all the rooms on live, and False when they are the same as the last poll.
+        None when the request failed
+        """
+        # disable logging from 'requests'
+        logging.getLogger('urllib3').setLevel(logging.WARNING)
+
+        self.poll_count += 1
+        headers = {}
+        if self._etag is not None:
+            headers['If-None-Match'] = self._etag
+        if self._lastModified is not None:
+            headers['If-Modified-Since'] = self._lastModified
+
+        # the same url every time, so that the conditional requests can be answered with 304 by any cache
+        sr_onlives_url = sr_client.base_url + '/api/live/onlives'
+        try:
+            r = sr_client.get(sr_onlives_url, headers=headers)
+        except requests.exceptions.ConnectionError as e:
+            logging.error('Failed to get lives info: ConnectionError - {}'.format(e))
+            self.error_count += 1
+            return None
+        except Exception as e:
+            logging.error('Failed to get lives info: {} - {}'.format(type(e).__name__, e))
+            self.error_count += 1
+            return None
+
+        if r.status_code == 304:
+            self.not_modified_count += 1
+            return self.rooms, False
+        if r.status_code != 200:
+            logging.error('Failed to get lives info: {} - {}'.format(r.status_code, r.reason))
+            self.error_count += 1
+            return None
+
+        metrics.onlives_bytes.observe(len(r.content))
+        # the validators are kept only with a valid payload, so a 304 never stands for a broken one
+        etag = r.headers.get('ETag')
+        lastModified = r.headers.get('Last-Modified')
+        digest = hashlib.md5(r.content).digest()
+        if digest == self._digest:
+            self.unchanged_count += 1
+            self._etag, self._lastModified = etag, lastModified
+            return self.rooms, False
+
+        try:
+            data = json.loads(r.text)
+            room_all, pop_room = parseOnLives(data)
+        except (JSONDecodeError, KeyError, TypeError) as e:
+            logging.error('Failed to get lives info: broken message, {} - {}'.format(type(e).__name__, e))
+            self.error_count += 1
+            return None
+        self._digest = digest
+        self._etag, self._lastModified = etag, lastModified
+        self.rooms = room_all + pop_room
+        return self.rooms, True
+
+    def nextDelay(self, isOk, isExpected=False):
+        """
+        :param isOk: the last poll succeeded
+        :param isExpected: a watched room is expected to go on live soon
+        :return seconds until the next poll
+        """
+        if isOk:
+            self.failures = 0
+            if isExpected and 0 < self.fast_interval < self.interval:
+                self.delay = self.fast_interval
+            else:
+                self.delay = self.interval
+        else:
+            self.failures += 1
+            # not more than max_backoff, and half of it random, so that clients don't retry all at once
+            backoff = min(self.max_backoff, self.interval * 2 ** min(self.failures, 16))
+            self.delay = backoff / 2.0 + random.uniform(0, backoff / 2.0)
+            logging.info('Failed to get lives info {} times, retry in {:.0f}s...'.format(self.failures, self.delay))
+        return self.delay
+
+    def wait(self, delay):
+        """ :return True when woken up before the delay """
+        return self._wakeup.wait(delay)
+
+    def wake(self):
+        self._wakeup.set()
+
+    def stats(self):
+        return {'polls': self.poll_count, 'not_modified': self.not_modified_count,
+                'unchanged': self.unchanged_count, 'errors': self.error_count,
+                'failures': self.failures, 'delay_seconds': round(self.delay, 1)}
+
+
+class LiveSchedule:
+    """
+    The usual start times of day of the watched rooms, from the started_at of their past lives.
+    Many rooms go on live at about the same time every day, around which RoomMonitor polls faster
+    """
+    DAY = 24 * 60 * 60
+
+    def __init__(self, history=10, before=300, after=600):
+        """
+        :param history: past lives kept per room
+        :param before: seconds, a room is expected from this long before one of its usual start times
+        :param after: seconds, until this long after
+        """
+        self.history = history
+        self.before = before
+        self.after = after
+        self._starts = {}  # room_url_key: start times of day (seconds), the latest last
+        self._times = []  # sorted (start time of day, room_url_key) of all rooms
+
+    def record(self, room_url_key, started_at):
+        """ :param started_at: unix time (seconds) of the start of a live """
+        if not started_at:
+            return
+        starts = self._starts.setdefault(room_url_key, [])
+        starts.append(int(started_at) % self.DAY)
+        del starts[:-self.history]
+        self._times = sorted((t, key) for key, ts in self._starts.items() for t in ts)
+
+    def forget(self, room_url_key):
+        """ remove the start times of a room which is no longer watched """
+        if self._starts.pop(room_url_key, None) is not None:
+            self._times = [item for item in self._times if item[1] != room_url_key]
+
+    def expected(self, exclude=(), now=None):
+        """
+        :param exclude: room_url_keys not to count, e.g. the rooms already on live
+        :return the room_url_keys expected to go on live around now
+        """
+        if not self._times:
+            return set()
+        t = int(time.time() if now is None else now) % self.DAY
+        # rooms started from (now - after) to (now + before), wrapping around midnight
+        low, high = t - self.after, t + self.before
+        ranges = [(max(low, 0), min(high, self.DAY))]
+        if low < 0:
+            ranges.append((low + self.DAY, self.DAY))
+        if high > self.DAY:
+            ranges.append((0, high - self.DAY))
+        rooms = set()
+        for start, end in ranges:
+            idx = bisect.bisect_left(self._times, (start,))
+            while idx < len(self._times) and self._times[idx][0] <= end:
+                room_url_key = self._times[idx][1]
+                if room_url_key not in exclude:
+                    rooms.add(room_url_key)
+                idx += 1
+        return rooms
+
+
+class RoomCache:
+    """
+    Metadata of the watched rooms by room_url_key: room_id, main_name, and bcsvr_host, bcsvr_port and bcsvr_key
+    of their last live, kept for ttl seconds and saved to a JSON file, so they are known after a restart.
+    With the broadcast server of a room known, a recorder connects with the bcsvr_key of onlives
+    straight away, while live_info confirms it
+    """
+
+    def __init__(self, filename, ttl):
+        """
+        :param filename: JSON file, '': not saved
+        :param ttl: seconds an entry is used after its update
+        """
+        self.filename = filename
+        self.ttl = ttl
+        self.hit_count = 0
+        self.miss_count = 0
+        self._lock = threading.Lock()
+        self._isDirty = False
+        self._rooms = self.load()
+
+    def load(self):
+        """ :return the fresh entries of the file """
+        if len(self.filename) == 0 or not os.path.isfile(self.filename):
+            return {}
+        try:
+            with open(self.filename, 'r', encoding='utf8') as fp:
+                rooms = json.load(fp)
+        except (OSError, JSONDecodeError) as e:
+            logging.error('Failed to read room cache {}: {}'.format(self.filename, e))
+            return {}
+        now = time.time()
+        return {key: room for key, room in rooms.items() if room.get('updated_at', 0) + self.ttl > now}
+
+    def get(self, room_url_key):
+        """ :return a dict of the metadata of a room, or None when it's not cached or expired """
+        room = self._rooms.get(room_url_key)
+        if room is None or room['updated_at'] + self.ttl <= time.time():
+            self.miss_count += 1
+            return None
+        self.hit_count += 1
+        return room
+
+    def update(self, room_url_key, **fields):
+        with self._lock:
+            self._rooms[room_url_key] = dict(self._rooms.get(room_url_key, {}), updated_at=time.time(), **fields)
+            self._isDirty = True
+
+    def save(self):
+        """
+        Save the changed entries, merged with the file, which other shard workers could have updated
+        """
+        if not self._isDirty or len(self.filename) == 0:
+            return
+        with self._lock:
+            self._isDirty = False
+            rooms = self.load()
+            for key, room in self._rooms.items():
+                if key not in rooms or rooms[key]['updated_at'] < room['updated_at']:
+                    rooms[key] = room
+            self._rooms = rooms
+        try:
+            with open(self.filename + '.tmp', 'w', encoding='utf8') as fp:
+                json.dump(rooms, fp, ensure_ascii=False)
+            os.replace(self.filename + '.tmp', self.filename)
+        except OSError as e:
+            logging.error('Failed to save room cache {}: {}'.format(self.filename, e))
+
+    def __len__(self):
+        return len(self._rooms)
+
+    def stats(self):
+        return {'rooms': len(self._rooms), 'hits': self.hit_count, 'misses': self.miss_count}
+
+
+def roomCache(settings):
+    """ :return the RoomCache of room_cache_file, or None when room_cache_ttl is 0 """
+    if settings['program_settings']['room_cache_ttl'] <= 0:
+        return None
+    return RoomCache(settings['program_settings']['room_cache_file'], settings['program_settings']['room_cache_ttl'])
+
+
 def getRoomLiveInfo(room_url_key, room_id):
 
-    live_info_url = 'https://www.showroom-live.com/api/live/live_info?room_id=' + str(room_id)
-    headers = {'User-Agent':
-                   'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.102 Safari/537.36'}
+    live_info_url = sr_client.base_url + '/api/live/live_info?room_id=' + str(room_id)
 
     try:
-        r = requests.get(live_info_url, headers=headers)
+        r = sr_client.get(live_info_url)
     except requests.exceptions.ConnectionError as e:
         logging.error('{}: Failed to get live info: ConnectionError - {}'.format(room_url_key, e))
         return {}
+    except requests.exceptions.Timeout as e:
+        logging.error('{}: Failed to get live info: Timeout - {}'.format(room_url_key, e))
+        return {}
     if r.status_code != 200:
         logging.error('{}: Failed to get live info: {} - {}'.format(room_url_key, r.status_code, r.reason))
         return {}
@@ -151,15 +553,16 @@ def getRoomLiveInfo(room_url_key, room_id):
 
 
 def getRoomIsLive(room_url_key, room_id):
-    url = 'https://www.showroom-live.com/room/is_live?room_id=' + str(room_id)
-    headers = {'User-Agent':
-                   'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.102 Safari/537.36'}
+    url = sr_client.base_url + '/room/is_live?room_id=' + str(room_id)
 
     try:
-        r = requests.get(url, headers=headers)
+        r = sr_client.get(url)
     except requests.exceptions.ConnectionError as e:
         logging.error('{}: ConnectionError - {}'.format(room_url_key, e))
         return {}
+    except requests.exceptions.Timeout as e:
+        logging.error('{}: Timeout - {}'.format(room_url_key, e))
+        return {}
     if r.status_code != 200:
         logging.error('{}: requests error: {} - {}'.format(room_url_key, r.status_code, r.reason))
         return {}
@@ -173,28 +576,371 @@ def getRoomIsLive(room_url_key, room_id):
     return data
 
 
-def convert_comments_to_danmaku(startTime, commentList,
-                                fontsize=18, fontname='MS PGothic', alpha='1A',
-                                width=640, height=360):
+class MessageDecoder:
     """
-    Convert comments to danmaku (弾幕 / bullets) subtitles
+    Decoder of the messages from the broadcast server: 'MSG\t<bcsvr_key>\t{...}'.
+    The JSON part is parsed in place, from the frame bytes, by orjson when it is installed,
+    otherwise by the json module. Gifts and gift reports, which are not recorded,
+    are recognized from their "t" key and skipped before they are parsed
+    """
+    # value of the "t" key of gifts and cumulated gifts reports, with the character after it
+    ignoredTypes = (b'2,', b'2}', b'2"', b'11,', b'11}', b'11"')
 
-    :param startTime: comments recording start time (timestamp in milliseconds)
-    :param commentList: list of showroom messages
-    :param fontsize = 18
-    :param fontname = 'MS PGothic'
-    :param alpha = '1A'     # transparency '00' to 'FF' (hex string)
-    :param width = 640      # video screen height
-    :param height = 360     # video screen width
+    def __init__(self, backend=None):
+        """
+        :param backend: 'orjson' or 'json', default: orjson if it is installed
+        """
+        if backend is None:
+            backend = 'orjson' if orjson is not None else 'json'
+        self.backend = backend
+        if backend == 'orjson':
+            self._loads = orjson.loads
+        else:
+            decode = json.JSONDecoder().decode  # json.loads() without its checks of the type and encoding
+            self._loads = lambda body: decode(str(body, 'utf-8'))
 
-    :return a string of danmaku subtitles
+        self.frame_count = 0
+        self.skipped_count = 0  # ignored message types, not parsed
+        self.broken_count = 0  # broken JSON
+        self.repaired_count = 0  # broken JSON fixed
+        self.error_count = 0  # no JSON, or broken JSON failed to be fixed
+
+    def decode(self, message):
+        """
+        :param message: bytes, bytearray or memoryview of UTF-8, or str
+        :return the message as a dict, or None if it is skipped or broken
+        """
+        self.frame_count += 1
+        if isinstance(message, str):
+            message = message.encode('utf-8', 'surrogatepass')
+        elif isinstance(message, memoryview):
+            # a view of a whole reassembled buffer is searched in place
+            obj = message.obj
+            message = obj if isinstance(obj, (bytes, bytearray)) and message.nbytes == len(obj) else message.tobytes()
+
+        # find the JSON part after the envelope
+        idx = message.find(b'{')
+        if idx < 0:
+            self.error_count += 1
+            logging.error('no JSON message - {}'.format(str(message, 'utf-8', 'replace')))
+            return None
+
+        # skip the message types which are not recorded, when "t" is the only "t" key in the message
+        pos = message.find(b'"t":', idx)
+        if pos > idx and message[pos - 1] in b'{,' and message.find(b'"t":', pos + 4) < 0:
+            if message[pos + 4:pos + 9].lstrip(b'"').startswith(self.ignoredTypes):
+                self.skipped_count += 1
+                return None
+
+        body = memoryview(message)[idx:]  # not copied
+
+        try:
+            return self._parse(body)
+        except (JSONDecodeError, UnicodeDecodeError):
+            self.broken_count += 1
+
+        # try to fix
+        text = self._text(body) + '","t":"1"}'
+        try:
+            data = json.loads(text)
+        except JSONDecodeError:
+            self.error_count += 1
+            logging.error('JSONDecodeError, failed to fix broken message: {}'.format(text))
+            return None
+        self.repaired_count += 1
+        logging.debug('broken message, JSONDecodeError is fixed: {}'.format(text))
+        return data
+
+    def _parse(self, body):
+        try:
+            return self._loads(body)
+        except (JSONDecodeError, UnicodeDecodeError):
+            try:
+                str(body, 'utf-8')
+            except UnicodeDecodeError:
+                # invalid UTF-8, decoded as latin-1
+                return json.loads(self._text(body))
+            raise
+
+    @staticmethod
+    def _text(body):
+        try:
+            return str(body, 'utf-8')
+        except UnicodeDecodeError:
+            text = str(body, 'latin-1')
+            logging.debug('ws_start: UnicodeDecodeError, decoded as latin-1: {}'.format(text))
+            return text
+
+    def stats(self):
+        return {'frames': self.frame_count, 'skipped': self.skipped_count, 'broken': self.broken_count,
+                'repaired': self.repaired_count, 'errors': self.error_count}
+
+
+class FrameAssembler:
+    """
+    Reassembly of fragmented WebSocket messages, shared by the threaded and the asyncio engines
+
+    Fragmented frame example: For a text message sent as three fragments,
+    the 1st fragment: opcode = 0x1 (OPCODE_TEXT) and FIN bit = 0,
+    the 2nd fragment: opcode = 0x0 (OPCODE_CONT) and FIN bit = 0,
+    the last fragment: opcode = 0x0 (OPCODE_CONT) and FIN bit = 1.
+
+    The fragments are kept in a list, and copied once into a buffer of the message size
+    when the last one arrives. A message which is not fragmented is passed through as it is
+    """
+
+    def __init__(self, maxSize=0):
+        """
+        :param maxSize: bytes, larger messages are dropped, 0: no limit
+        """
+        self.maxSize = maxSize
+        self._chunks = []
+        self._size = 0
+        self._opcode = ABNF.OPCODE_TEXT
+        self._isDropping = False
+
+        self.message_count = 0
+        self.fragmented_count = 0  # messages received in more than one frame
+        self.fragment_count = 0  # frames of the fragmented messages
+        self.reassembled_bytes = 0  # bytes of the fragmented messages
+        self.dropped_count = 0  # messages larger than maxSize
+
+    def feed(self, frame):
+        """
+        :param frame: ABNF frame of opcode OPCODE_TEXT, OPCODE_BINARY or OPCODE_CONT
+        :return (opcode, data) when the message is complete, data is bytes or a memoryview, otherwise None
+        """
+        if frame.opcode != ABNF.OPCODE_CONT:
+            if self._chunks or self._isDropping:
+                logging.debug('ws_start: fragmented message is not finished, dropped')
+                self._reset()
+            self._opcode = frame.opcode
+            if frame.fin:
+                # a single frame message, most of them
+                self.message_count += 1
+                if 0 < self.maxSize < len(frame.data):
+                    self._drop(len(frame.data))
+                    return None
+                return self._opcode, frame.data
+
+        if not self._isDropping:
+            self._chunks.append(frame.data)
+            self._size += len(frame.data)
+            if 0 < self.maxSize < self._size:
+                self._drop(self._size)
+                self._chunks = []
+                self._isDropping = True
+
+        if not frame.fin:
+            return None
+
+        # the last fragment
+        self.message_count += 1
+        if self._isDropping:
+            self._reset()
+            return None
+        chunks = self._chunks
+        size = self._size
+        self._reset()
+
+        self.fragmented_count += 1
+        self.fragment_count += len(chunks)
+        self.reassembled_bytes += size
+        logging.debug('ws_start: fragmented message: {} frames, {} bytes'.format(len(chunks), size))
+
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        offset = 0
+        for chunk in chunks:
+            view[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+        return self._opcode, view
+
+    def _drop(self, size):
+        self.dropped_count += 1
+        logging.warning('ws_start: message larger than {} bytes ({} bytes so far), dropped'.format(
+            self.maxSize, size))
+
+    def _reset(self):
+        self._chunks = []
+        self._size = 0
+        self._isDropping = False
+
+    def stats(self):
+        return {'messages': self.message_count, 'fragmented': self.fragmented_count,
+                'fragments': self.fragment_count, 'reassembled_bytes': self.reassembled_bytes,
+                'dropped': self.dropped_count}
+
+
+class MessageQueue:
     """
+    Bounded queue of the raw messages of a recorder, between the socket reader and their processing
+    (decoding, filtering, storing), so that slow processing (show_comments, comment_output_func, GC pauses)
+    does not delay reading the socket. When it is full:
+        BLOCK        the reader waits for room, as when the messages were processed while reading
+        DROP_OLDEST  the oldest message is dropped
+        SAMPLE       every second queued message is dropped, so the kept ones still spread over the whole time
+    """
+    BLOCK = 0
+    DROP_OLDEST = 1
+    SAMPLE = 2
+
+    def __init__(self, maxSize, policy=BLOCK):
+        self.maxSize = maxSize
+        self.policy = policy
+        self._items = deque()
+        self._cond = threading.Condition()
+        self.isClosed = False
+        self.put_count = 0
+        self.dropped_count = 0
+        self.max_depth = 0
+
+    def isFull(self):
+        return len(self._items) >= self.maxSize
+
+    def put(self, item, block=True):
+        """
+        :param block: False for a reader which waits for room itself (asyncio), the queue then never waits
+        :return False when the queue is closed
+        """
+        with self._cond:
+            if len(self._items) >= self.maxSize:
+                if self.policy == MessageQueue.DROP_OLDEST:
+                    self._items.popleft()
+                    self.dropped_count += 1
+                elif self.policy == MessageQueue.SAMPLE:
+                    n = len(self._items)
+                    self._items = deque(list(self._items)[1::2])
+                    self.dropped_count += n - len(self._items)
+                elif block:
+                    while len(self._items) >= self.maxSize and not self.isClosed:
+                        self._cond.wait()
+            if self.isClosed:
+                return False
+            self._items.append(item)
+            self.put_count += 1
+            if len(self._items) > self.max_depth:
+                self.max_depth = len(self._items)
+            self._cond.notify_all()
+        return True
 
-    # slotsNum: max number of comment line vertically shown on screen
-    slotsNum = math.floor(height / fontsize)
-    travelTime = 8 * 1000  # 8 sec, bullet comment flight time on screen
+    def get(self, timeout=None):
+        """
+        :return all the queued messages, [] after the timeout, None when the queue is closed and empty
+        """
+        with self._cond:
+            while len(self._items) == 0:
+                if self.isClosed:
+                    return None
+                if not self._cond.wait(timeout):
+                    return []
+            return self.drain()
+
+    def drain(self):
+        """ :return all the queued messages, without waiting """
+        with self._cond:
+            items = list(self._items)
+            self._items.clear()
+            self._cond.notify_all()
+        return items
+
+    def close(self):
+        """ no more messages: get() returns what is left, then None """
+        with self._cond:
+            self.isClosed = True
+            self._cond.notify_all()
+
+    def reopen(self):
+        """ take messages again, for a new connection of the same recorder """
+        with self._cond:
+            self.isClosed = False
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        return {'depth': len(self._items), 'max_depth': self.max_depth, 'messages': self.put_count,
+                'dropped': self.dropped_count}
+
+
+class LivenessSnapshot:
+    """
+    The latest onlives list published by RoomMonitor, shared by all recorders.
+    A recorder looks up its room here to know whether its live has ended,
+    and only requests /room/is_live when the room is not in the snapshot.
+    RoomMonitor matches the watched rooms with the room_url_key index.
+    """
 
-    # ass subtitle file header
+    def __init__(self, max_age=60):
+        self.max_age = max_age  # seconds, an older snapshot is not used
+        self.updated_at = 0
+        self._lives = {}  # room_id: live_id
+        self.rooms = {}  # room_url_key: room data from onlives
+        self.hit_count = 0
+        self.miss_count = 0
+
+    def publish(self, rooms):
+        lives = {}
+        roomsByKey = {}
+        for room in rooms:
+            lives[room['room_id']] = room.get('live_id')
+            # a room could be listed in several genres, keep the first one
+            roomsByKey.setdefault(room['room_url_key'], room)
+        # the dicts are replaced as a whole, so readers never see a half-built snapshot
+        self._lives = lives
+        self.rooms = roomsByKey
+        self.updated_at = time.time()
+
+    def touch(self):
+        """ the onlives have not changed since the last publish """
+        self.updated_at = time.time()
+
+    def isLive(self, room_id, live_id=None):
+        """
+        :return True or False when the snapshot knows the room, None when it doesn't
+        """
+        lives = self._lives
+        if len(lives) == 0 or time.time() - self.updated_at > self.max_age or room_id not in lives:
+            self.miss_count += 1
+            return None
+        listed = lives[room_id]
+        if live_id is None or listed is None or listed == live_id:
+            self.hit_count += 1
+            return True
+        # only a newer live_id means the recorded live has ended and a new one has started,
+        # onlives can still list the previous live for about 30 seconds after a quick restart
+        try:
+            isNewer = int(listed) > int(live_id)
+        except (TypeError, ValueError):
+            isNewer = False
+        if not isNewer:
+            self.miss_count += 1
+            return None
+        self.hit_count += 1
+        return False
+
+    def __len__(self):
+        return len(self._lives)
+
+
+def msecToAssTime(uTime):
+    """ convert milliseconds to ass subtitle format """
+    msec = uTime % 1000
+    msec = int(round(msec / 10.0))
+    uTime = math.floor(uTime / 1000.0)
+    s = int(uTime % 60)
+    uTime = math.floor(uTime / 60.0)
+    m = int(uTime % 60)
+    h = int(math.floor(uTime / 60.0))
+    msf = ("00" + str(msec))[-2:]
+    sf = ("00" + str(s))[-2:]
+    mf = ("00" + str(m))[-2:]
+    hf = ("00" + str(h))[-2:]
+    return hf + ":" + mf + ":" + sf + "." + msf
+
+
+def assHeader(fontsize=18, fontname='MS PGothic', width=640, height=360):
+    """ ass subtitle file header """
     danmaku = "[Script Info]\n"
     danmaku += "ScriptType: v4.00+\n"
     danmaku += "Collisions: Normal\n"
@@ -206,26 +952,158 @@ def convert_comments_to_danmaku(startTime, commentList,
                ", &H00FFFFFF, &H00FFFFFF, &H00000000, &H00000000, 1, 0, 0, 0, 100, 100, 0.00, 0.00, 1, 1, 0, 2, 20, 20, 20, 0\n\n"
     danmaku += "[Events]\n"
     danmaku += "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n"
+    return danmaku
+
+
+class DanmakuLayout:
+    """
+    Slot allocator of the danmaku layout.
+    Each comment line on screen can be seen as a slot, which is busy until its bullet comment disappears.
+    Free slots are kept in a min-heap of slot numbers, so the top-most free slot is taken first,
+    and busy slots in a min-heap of (release time, slot number), so the slot released first is taken
+    when no slot is free. Each allocation costs O(log slotsNum), instead of scanning all slots
+    """
 
-    # each comment line on screen can be seen as a slot
-    # each slot will be filled with the time which indicates when the bullet comment will disappear on screen
-    # slot[0], slot[1], slot[2], ...: for the comment lines from top to down
-    slots = []
-    for i in range(slotsNum):
-        slots.append(0)
+    def __init__(self, slotsNum):
+        # slot[0], slot[1], slot[2], ...: for the comment lines from top to down
+        # each slot is filled with the time which indicates when the bullet comment will disappear on screen
+        self.slots = [0] * slotsNum
+        self._free = []
+        self._busy = [(0, j) for j in range(slotsNum)]  # a sorted list is a heap
+        self._lastTime = None
+
+    def allocate(self, t, duration):
+        """
+        Select the slot for a bullet comment shown from time t
+
+        :param t: time when the comment appears (milliseconds)
+        :param duration: milliseconds of the comment flight on screen
+        :return the selected slot number, 0 is the top line
+        """
+        if self._lastTime is not None and t < self._lastTime:
+            self._rebuild(t)
+        self._lastTime = t
+
+        free = self._free
+        busy = self._busy
+        # release the slots whose comments have disappeared
+        while busy and busy[0][0] <= t:
+            heapq.heappush(free, heapq.heappop(busy)[1])
+
+        if free:
+            # available slot from up to down
+            slot = heapq.heappop(free)
+        else:
+            # when all slots have larger times, replace the slot with the smallest time
+            slot = heapq.heappop(busy)[1]
+
+        self.slots[slot] = t + duration  # replaced with the time that it will finish
+        heapq.heappush(busy, (t + duration, slot))
+        return slot
+
+    def allocateWithin(self, t, duration, maxBusy, maxDelay):
+        """
+        Select the slot for a bullet comment, with at most maxBusy comments on screen at the same time.
+        When they are, the comment is delayed until the first of them disappears, instead of overlapping it
+
+        :param t: time when the comment is received (milliseconds)
+        :param duration: milliseconds of the comment flight on screen
+        :param maxBusy: most comments on screen, not more than the slots
+        :param maxDelay: milliseconds, the longest delay
+        :return (selected slot number, time when the comment appears), or None when it would be delayed longer
+        """
+        if self._lastTime is not None and t < self._lastTime:
+            self._rebuild(t)
+        self._lastTime = t
+
+        free = self._free
+        busy = self._busy
+        while busy and busy[0][0] <= t:
+            heapq.heappush(free, heapq.heappop(busy)[1])
+
+        start = t
+        if free and len(busy) < maxBusy:
+            slot = heapq.heappop(free)
+        else:
+            start = busy[0][0]
+            if start - t > maxDelay:
+                return None
+            slot = heapq.heappop(busy)[1]
+            if free and free[0] < slot:
+                # from up to down, among the free slots when the comment appears
+                slot = heapq.heapreplace(free, slot)
+
+        self.slots[slot] = start + duration
+        heapq.heappush(busy, (start + duration, slot))
+        return slot, start
+
+    def _rebuild(self, t):
+        # time went backwards (unsorted comments): slots released after t are busy again
+        self._free = [j for j in range(len(self.slots)) if self.slots[j] <= t]
+        self._busy = [(self.slots[j], j) for j in range(len(self.slots)) if self.slots[j] > t]
+        heapq.heapify(self._busy)
+
+
+class DanmakuWriter:
+    """
+    Convert comments to danmaku (弾幕 / bullets) subtitles, and write them to a file-like object.
+    The layout slots and the previous telop are kept between write() calls,
+    so comments can be rendered piece by piece, e.g. while a live is still being recorded.
 
-    previousTelop = ''
+    With maxBullets, at most that many comments are on screen at the same time: a comment is delayed
+    until one disappears, or dropped when it would be delayed longer than maxDelay.
+    Telops and polls are always shown
+    """
 
-    for data in commentList:
+    def __init__(self, fp, startTime,
+                 fontsize=18, fontname='MS PGothic', alpha='1A',
+                 width=640, height=360, chunkSize=1000, maxBullets=0, maxDelay=2000):
+        """
+        :param fp: file-like object with a write() method, opened in text mode
+        :param startTime: comments recording start time (timestamp in milliseconds)
+        :param fontsize = 18
+        :param fontname = 'MS PGothic'
+        :param alpha = '1A'     # transparency '00' to 'FF' (hex string)
+        :param width = 640      # video screen height
+        :param height = 360     # video screen width
+        :param chunkSize = 1000 # number of subtitle lines per write
+        :param maxBullets = 0   # most comments on screen at the same time, 0: no limit (they overlap)
+        :param maxDelay = 2000  # milliseconds, the longest delay of a comment when maxBullets are on screen
+        """
+        self.fp = fp
+        self.startTime = startTime
+        self.fontsize = fontsize
+        self.fontname = fontname
+        self.alpha = alpha
+        self.width = width
+        self.height = height
+        self.chunkSize = chunkSize
+
+        # slotsNum: max number of comment line vertically shown on screen
+        self.slotsNum = math.floor(height / fontsize)
+        self.travelTime = 8 * 1000  # 8 sec, bullet comment flight time on screen
+        self.layout = DanmakuLayout(self.slotsNum)
+        self.previousTelop = ''
+        self.maxBullets = min(maxBullets, self.slotsNum)
+        self.maxDelay = maxDelay
+        self.shifted_count = 0  # comments delayed for maxBullets
+        self.dropped_count = 0  # comments dropped for maxBullets
+
+    def writeHeader(self):
+        self.fp.write(assHeader(self.fontsize, self.fontname, self.width, self.height))
+
+    def text(self, data):
+        """
+        :return (the text shown for a message, True when it is a comment), or None when it is not shown
+        """
         m_type = str(data['t'])
-        comment = ''
         if m_type == '1':  # comment
-            comment = data['cm']
+            return data['cm'], True
 
         elif m_type == '3':  # voting start
             poll = data['l']
             if len(poll) < 1:
-                continue
+                return None
             comment = 'Poll Started: 【({})'.format(poll[0]['id'] % 10000)
             for k in range(1, len(poll)):
                 if k > 4:
@@ -237,7 +1115,7 @@ def convert_comments_to_danmaku(startTime, commentList,
         elif m_type == '4':  # voting result
             poll = data['l']
             if len(poll) < 1:
-                continue
+                return None
             comment = 'Poll: 【({}) {}%'.format(poll[0]['id'] % 10000, poll[0]['r'])
             for k in range(1, len(poll)):
                 if k > 4:
@@ -248,548 +1126,3094 @@ def convert_comments_to_danmaku(startTime, commentList,
 
         elif m_type == '8':  # telop
             telop = data['telop']
-            if telop is not None and telop != previousTelop:
-                previousTelop = telop
+            if telop is not None and telop != self.previousTelop:
+                self.previousTelop = telop
                 # show telop as a comment
                 comment = 'Telop: 【' + telop + '】'
             else:
-                continue
+                return None
 
         else:   # not comment, telop, or voting result
-            continue
+            return None
+        return comment, False
+
+    def dialogue(self, t, comment, isComment, assTimes=None):
+        """
+        Lay out a bullet comment and build its ass subtitle line
 
-        # compute current relative time
-        t = data['received_at'] - startTime
+        :param t: time when the comment is received, relative to startTime (milliseconds)
+        :param assTimes: (msecToAssTime(t), msecToAssTime(t + travelTime)), when they are already computed
+        :return the ass line, or None when the comment is dropped for maxBullets
+        """
+        fontsize = self.fontsize
 
         # find available slot vertically from up to down
-        selectedSlot = 0
-        isSlotFound = False
-        for j in range(slotsNum):
-            if slots[j] <= t:
-                slots[j] = t + travelTime  # replaced with the time that it will finish
-                isSlotFound = True
-                selectedSlot = j
+        if self.maxBullets > 0 and isComment:
+            selected = self.layout.allocateWithin(t, self.travelTime, self.maxBullets, self.maxDelay)
+            if selected is None:
+                self.dropped_count += 1
+                return None
+            selectedSlot, start = selected
+            if start > t:
+                self.shifted_count += 1
+                t = start
+                assTimes = None
+        else:
+            selectedSlot = self.layout.allocate(t, self.travelTime)
+        if assTimes is None:
+            assTimes = (msecToAssTime(t), msecToAssTime(t + self.travelTime))
+
+        # calculate bullet comment flight positions, from (x1,y1) to (x2,y2) on screen
+
+        # extra flight length so a comment appears and disappears outside of the screen
+        extraLen = math.ceil(len(comment) / 2.0)
+
+        x1 = self.width + extraLen * fontsize
+        y1 = (selectedSlot + 1) * fontsize
+        x2 = 0 - extraLen * fontsize
+        y2 = y1
+
+        # build ass subtitle script
+        # alpha: 00 means fully visible, and FF (ie. 255 in decimal) is fully transparent.
+        return ("Dialogue: 3," + assTimes[0] + "," + assTimes[1] +
+                ",danmakuFont,,0000,0000,0000,,{\\alpha&H" + self.alpha + "&\\move(" +
+                str(x1) + "," + str(y1) + "," + str(x2) + "," + str(y2) +
+                ")}" + comment + "\n")
+
+    def write(self, commentList):
+        """
+        :param commentList: iterable of showroom messages, sorted by 'received_at'
+        """
+        startTime = self.startTime
+        chunk = []
+
+        for data in commentList:
+            shown = self.text(data)
+            if shown is None:
+                continue
+            line = self.dialogue(data['received_at'] - startTime, shown[0], shown[1])
+            if line is None:
+                continue
+            chunk.append(line)
+            if len(chunk) >= self.chunkSize:
+                self.fp.write(''.join(chunk))
+                chunk = []
+        # end of for
+        if len(chunk) > 0:
+            self.fp.write(''.join(chunk))
+
+    def densityText(self):
+        """ :return the comments delayed and dropped for maxBullets, for the log, '' when none """
+        if self.shifted_count == 0 and self.dropped_count == 0:
+            return ''
+        return '{}x{}, at most {} comments on screen: {} delayed, {} dropped'.format(
+            self.width, self.height, self.maxBullets, self.shifted_count, self.dropped_count)
+
+
+class MultiDanmakuWriter:
+    """
+    Render the same comments with several DanmakuWriters (output profiles) in one pass:
+    the messages are dispatched, their texts built and their times converted once,
+    only the layout and the ass line are done for each profile
+    """
+
+    def __init__(self, writers):
+        """
+        :param writers: DanmakuWriters with the same startTime, the first one keeps the previous telop
+        """
+        self.writers = writers
+
+    def writeHeader(self):
+        for writer in self.writers:
+            writer.writeHeader()
+
+    def write(self, commentList):
+        """
+        :param commentList: iterable of showroom messages, sorted by 'received_at'
+        """
+        writers = self.writers
+        first = writers[0]
+        startTime = first.startTime
+        travelTime = first.travelTime
+        chunks = [[] for _ in writers]
+
+        for data in commentList:
+            shown = first.text(data)
+            if shown is None:
+                continue
+            comment, isComment = shown
+            t = data['received_at'] - startTime
+            assTimes = (msecToAssTime(t), msecToAssTime(t + travelTime))
+            for writer, chunk in zip(writers, chunks):
+                line = writer.dialogue(t, comment, isComment, assTimes)
+                if line is None:
+                    continue
+                chunk.append(line)
+                if len(chunk) >= writer.chunkSize:
+                    writer.fp.write(''.join(chunk))
+                    chunk.clear()
+        # end of for
+        for writer, chunk in zip(writers, chunks):
+            if len(chunk) > 0:
+                writer.fp.write(''.join(chunk))
+
+
+def write_danmaku(fp, startTime, commentList,
+                  fontsize=18, fontname='MS PGothic', alpha='1A',
+                  width=640, height=360, chunkSize=1000, maxBullets=0, maxDelay=2000):
+    """
+    Convert comments to danmaku (弾幕 / bullets) subtitles, and write them to a file-like object.
+    The subtitles are written in chunks of lines, so the whole subtitle is never built in memory
+
+    :param fp: file-like object with a write() method, opened in text mode
+    :param startTime: comments recording start time (timestamp in milliseconds)
+    :param commentList: iterable of showroom messages, sorted by 'received_at'
+    :param fontsize = 18
+    :param fontname = 'MS PGothic'
+    :param alpha = '1A'     # transparency '00' to 'FF' (hex string)
+    :param width = 640      # video screen height
+    :param height = 360     # video screen width
+    :param chunkSize = 1000 # number of subtitle lines per write
+    :param maxBullets = 0   # most comments on screen at the same time, 0: no limit (they overlap)
+    :param maxDelay = 2000  # milliseconds, the longest delay of a comment when maxBullets are on screen
+
+    :return the DanmakuWriter, with the numbers of delayed and dropped comments
+    """
+    writer = DanmakuWriter(fp, startTime, fontsize=fontsize, fontname=fontname, alpha=alpha,
+                           width=width, height=height, chunkSize=chunkSize, maxBullets=maxBullets,
+                           maxDelay=maxDelay)
+    writer.writeHeader()
+    writer.write(commentList)
+    return writer
+
+
+def danmakuOptions(danmaku_settings):
+    """
+    :return keyword arguments of write_danmaku() from danmaku_settings
+    """
+    alpha = danmaku_settings['alpha']
+    alpha = int(round(alpha * 255.0 / 100.0))
+    if alpha > 255:
+        alpha = 255
+    elif alpha < 0:
+        alpha = 0
+    alphaHex = '00' + hex(alpha).upper()[2:]
+    alphaHex = alphaHex[-2:]
+
+    return {'fontsize': danmaku_settings['font_size'],
+            'fontname': danmaku_settings['font_name'],
+            'alpha': alphaHex,
+            'width': danmaku_settings['width'],
+            'height': danmaku_settings['height'],
+            'maxBullets': danmaku_settings['max_bullets'],
+            'maxDelay': danmaku_settings['max_delay'] * 1000}
+
+
+def danmakuProfiles(danmaku_settings):
+    """
+    The output profiles: the main ass file with the width, height and font_size of danmaku_settings,
+    and one for each WIDTHxHEIGHT:FONT_SIZE of 'profiles', e.g. 'profiles = 1280x720:36, 1920x1080:54'
+
+    :return list of (file name suffix, keyword arguments of DanmakuWriter), the main one first with suffix ''
+    """
+    options = danmakuOptions(danmaku_settings)
+    profiles = [('', options)]
+    for spec in danmaku_settings['profiles'].split(','):
+        spec = spec.strip()
+        if len(spec) == 0:
+            continue
+        size, _, fontsize = spec.partition(':')
+        try:
+            width, height = (int(x) for x in size.lower().split('x'))
+            fontsize = int(fontsize) if fontsize.strip() else options['fontsize']
+        except ValueError:
+            logging.error('Invalid danmaku profile "{}", expected WIDTHxHEIGHT:FONT_SIZE'.format(spec))
+            continue
+        profiles.append((' {}x{}'.format(width, height), dict(options, width=width, height=height,
+                                                               fontsize=fontsize)))
+    return profiles
+
+
+def openDanmakuWriter(filename, startTime, danmaku_settings, tmpSuffix=''):
+    """
+    Open the ass files of all output profiles: filename + '.ass', filename + ' 1280x720.ass', ...
+
+    :param tmpSuffix: added to the file names, e.g. to write to temporary files first
+    :return (MultiDanmakuWriter, list of the ass file names without tmpSuffix)
+    """
+    profiles = danmakuProfiles(danmaku_settings)
+    assfiles = []
+    writers = []
+    try:
+        for suffix, options in profiles:
+            fp = open(filename + suffix + '.ass' + tmpSuffix, 'w', encoding='utf8')
+            assfiles.append(filename + suffix + '.ass')
+            writers.append(DanmakuWriter(fp, startTime, **options))
+    except OSError:
+        for writer in writers:
+            writer.fp.close()
+        raise
+    return MultiDanmakuWriter(writers), assfiles
+
+
+def convert_comments_to_danmaku(startTime, commentList,
+                                fontsize=18, fontname='MS PGothic', alpha='1A',
+                                width=640, height=360):
+    """
+    Convert comments to danmaku (弾幕 / bullets) subtitles
+
+    :param startTime: comments recording start time (timestamp in milliseconds)
+    :param commentList: list of showroom messages
+    :param fontsize = 18
+    :param fontname = 'MS PGothic'
+    :param alpha = '1A'     # transparency '00' to 'FF' (hex string)
+    :param width = 640      # video screen height
+    :param height = 360     # video screen width
+
+    :return a string of danmaku subtitles
+    """
+    danmaku = io.StringIO()
+    write_danmaku(danmaku, startTime, commentList,
+                  fontsize=fontsize, fontname=fontname, alpha=alpha, width=width, height=height)
+    return danmaku.getvalue()
+
+
+class CommentDeduplicator:
+    """
+    Collapses the same comment text repeated within a time window, by the same or different users.
+    Only a fingerprint (hash) of each text is kept, for at most maxEntries texts, the oldest forgotten first.
+    With countSuffix, the recorded messages are held until the window of the comments before them has ended,
+    so that a comment repeated k times is recorded once as "text ×k", still in the order of reception
+    """
+
+    def __init__(self, window, maxEntries=5000, countSuffix=False):
+        """
+        :param window: seconds, from the first time a text is received
+        """
+        self.window = window * 1000  # milliseconds
+        self.maxEntries = maxEntries
+        self.countSuffix = countSuffix
+        self._entries = OrderedDict()  # fingerprint: [window end (ms), repeat count], oldest first
+        self._held = deque()  # (message, entry or None) in the order of reception
+        self.suppressed_count = 0
+
+    def isRepeat(self, comment, now):
+        """
+        :return True when the comment is a repeat within the window, it is then counted and not recorded
+        """
+        entry = self._entries.get(hash(comment))
+        if entry is None or entry[0] <= now:
+            return False
+        entry[1] += 1
+        self.suppressed_count += 1
+        return True
+
+    def push(self, data, now, comment=None):
+        """
+        :param data: a message to record, with its comment text when it is a comment
+        :return the messages to record now, in the order of reception
+        """
+        entries = self._entries
+        # forget the texts whose window has ended, and the oldest ones beyond maxEntries
+        while entries:
+            entry = entries[next(iter(entries))]
+            if entry[0] > now and len(entries) < self.maxEntries:
                 break
+            entries.popitem(last=False)
+            entry[0] = 0  # ended
+
+        entry = None
+        if comment is not None:
+            entry = [now + self.window, 1]
+            old = entries.pop(hash(comment), None)
+            if old is not None:
+                old[0] = 0
+            entries[hash(comment)] = entry
+
+        if not self.countSuffix:
+            return [data]
+        self._held.append((data, entry))
+        return self._release()
+
+    def flush(self):
+        """ :return all the held messages, at the end of the live """
+        for entry in self._entries.values():
+            entry[0] = 0
+        self._entries.clear()
+        return self._release()
+
+    def _release(self):
+        ready = []
+        held = self._held
+        while held and (held[0][1] is None or held[0][1][0] == 0):
+            data, entry = held.popleft()
+            if entry is not None and entry[1] > 1:
+                data['cm'] = '{} ×{}'.format(data['cm'], entry[1])
+            ready.append(data)
+        return ready
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CommentStore:
+    """
+    Compact in-memory store of the recorded messages, used as comment_log instead of a list of dicts.
+    Only what the danmaku needs is kept: 'received_at' and the message type in arrays,
+    and the comment, telop or poll of each message, with the texts interned so repeated comments share memory.
+    The full message is kept as a JSON string only when keepRaw is True (save_comments_debug_log is on)
+    """
+
+    # the key holding the text of each message type, see DanmakuWriter.write()
+    textKeys = {'1': 'cm', '3': 'l', '4': 'l', '8': 'telop'}
+
+    def __init__(self, keepRaw=False):
+        self.received_at = array('q')
+        self.types = array('H')  # index in self._typeNames
+        self.texts = []
+        self.raw = [] if keepRaw else None
+        self.isSorted = True
+        self._typeIds = {}  # message type: index
+        self._typeNames = []  # the original 't' values, could be integer or string
+
+    def append(self, data):
+        t = data['t']
+        typeId = self._typeIds.get(t)
+        if typeId is None:
+            typeId = len(self._typeNames)
+            self._typeIds[t] = typeId
+            self._typeNames.append(t)
+
+        received_at = data['received_at']
+        if len(self.received_at) > 0 and received_at < self.received_at[-1]:
+            self.isSorted = False
+        self.received_at.append(received_at)
+        self.types.append(typeId)
+
+        key = self.textKeys.get(str(t))
+        text = data.get(key) if key is not None else None
+        if isinstance(text, str):
+            text = sys.intern(text)
+        elif isinstance(text, list):
+            # poll: only the ids and the rates are shown
+            text = tuple((item.get('id'), item.get('r')) for item in text)
+        self.texts.append(text)
+
+        if self.raw is not None:
+            self.raw.append(json.dumps(data, ensure_ascii=False))
+
+    def __len__(self):
+        return len(self.received_at)
+
+    def __iter__(self):
+        """
+        Iterate the messages as small dicts, with only the keys the danmaku needs
+        """
+        typeNames = self._typeNames
+        textKeys = self.textKeys
+        for received_at, typeId, text in zip(self.received_at, self.types, self.texts):
+            t = typeNames[typeId]
+            data = {'t': t, 'received_at': received_at}
+            key = textKeys.get(str(t))
+            if key == 'l':
+                data['l'] = [{'id': pollId, 'r': rate} for pollId, rate in text] if text is not None else []
+            elif key is not None:
+                data[key] = text
+            yield data
+
+    def iterRaw(self):
+        """
+        :return an iterator of the full messages as JSON strings, if they are kept
+        """
+        return iter(self.raw)
+
+    def sort(self):
+        """ sort the messages by 'received_at' """
+        if self.isSorted:
+            return
+        order = sorted(range(len(self.received_at)), key=self.received_at.__getitem__)
+        self.received_at = array('q', (self.received_at[i] for i in order))
+        self.types = array('H', (self.types[i] for i in order))
+        self.texts = [self.texts[i] for i in order]
+        if self.raw is not None:
+            self.raw = [self.raw[i] for i in order]
+        self.isSorted = True
+
+
+class CommentJournal:
+    """
+    Append-only write-ahead journal of the messages of one live, in JSON lines.
+    Messages go to disk as they are received instead of being kept in memory until the live ends.
+    The first line is a header with what is needed to convert the journal to danmaku,
+    so a journal left behind by a crash can be converted by recoverJournals().
+    append() is only a buffered write, the recorder's interval thread (or task) syncs the file with tick()
+    """
+    extension = '.journal'
 
-        # when all slots have larger times, find the smallest time and replace the slot
-        if not isSlotFound:
-            minIdx = 0
-            for j in range(1, slotsNum):
-                if slots[j] < slots[minIdx]:
-                    minIdx = j
+    def __init__(self, filename, header, fsync_interval=10):
+        """
+        :param filename
+        :param header: dict of room_url_key, room_name, room_id, live_id, ws_startTime
+        :param fsync_interval: seconds between flush and fsync of the file, 0: only when the journal is closed
+        """
+        self.filename = filename
+        self.fsync_interval = fsync_interval * 1000
+        self.count = 0
+        self.isSorted = True
+        self._lastTime = 0
+        self._lastSync = 0
+        self._lock = threading.Lock()  # between append() and the flush of sync()
+        self._fp = open(filename, 'w', encoding='utf8', buffering=64 * 1024)
+        self._fp.write(json.dumps(dict(header, journal=1), ensure_ascii=False) + '\n')
+        # synced with the first tick()
+
+    def append(self, data):
+        line = json.dumps(data, ensure_ascii=False) + '\n'
+        with self._lock:
+            self._fp.write(line)
+        self.count += 1
+
+        now = data['received_at']
+        if now < self._lastTime:
+            self.isSorted = False
+        self._lastTime = now
+
+    def isDue(self, now):
+        """
+        :param now: timestamp in milliseconds
+        """
+        return 0 < self.fsync_interval <= now - self._lastSync
+
+    def tick(self, now):
+        """
+        Sync the file when fsync_interval has passed
+
+        :param now: timestamp in milliseconds
+        """
+        if self.isDue(now):
+            self.sync()
+
+    def sync(self):
+        with self._lock:
+            if self._fp.closed:
+                return
+            self._fp.flush()
+            fd = self._fp.fileno()
+        # the slow part, without holding up append()
+        os.fsync(fd)
+        self._lastSync = int(time.time() * 1000)
+
+    def close(self):
+        if not self._fp.closed:
+            self.sync()
+            self._fp.close()
+
+    def messages(self):
+        """
+        :return an iterator of the journaled messages
+        """
+        return iterJournal(self.filename)[1]
+
+    def remove(self):
+        self.close()
+        try:
+            os.remove(self.filename)
+        except OSError as e:
+            logging.error('Failed to remove journal {}: {}'.format(self.filename, e))
+
+
+def iterJournal(filename):
+    """
+    :return (header, iterator of messages) of a journal file.
+        A broken line, which could be the last line cut by a crash, is skipped
+    """
+    fp = open(filename, 'r', encoding='utf8')
+    try:
+        header = json.loads(fp.readline())
+    except JSONDecodeError:
+        fp.close()
+        raise
+
+    def messages():
+        with fp:
+            for line in fp:
+                try:
+                    yield json.loads(line)
+                except JSONDecodeError:
+                    logging.debug('{}: skipped broken journal line: {}'.format(filename, line))
+
+    return header, messages()
+
+
+def recoverJournals(settings):
+    """
+    Convert the journals left in the folder 'comments' by a crashed or killed program to danmaku ass files
+    """
+    path = commentsFolder()
+    journals = sorted(f for f in os.listdir(path) if f.endswith(CommentJournal.extension))
+    if len(journals) == 0:
+        logging.info('No journals to recover')
+        return
+
+    for f in journals:
+        filename = os.path.join(path, f)
+        try:
+            header, messages = iterJournal(filename)
+        except (OSError, JSONDecodeError) as e:
+            logging.error('Failed to read journal {}: {}'.format(filename, e))
+            continue
+
+        # one pass to count the messages and check the order, so the messages don't need to be kept in memory
+        count = 0
+        isSorted = True
+        lastTime = 0
+        for data in messages:
+            count += 1
+            if data['received_at'] < lastTime:
+                isSorted = False
+            lastTime = data['received_at']
+
+        if isSorted:
+            getMessages = lambda: iterJournal(filename)[1]
+        else:
+            sortedMessages = sorted(iterJournal(filename)[1], key=lambda x: x['received_at'])
+            getMessages = lambda: sortedMessages
+
+        logging.info('{}: recovering {} messages from {}'.format(header['room_url_key'], count, filename))
+        saveDanmaku(header['room_url_key'], header['room_name'], header['ws_startTime'], getMessages, count, settings)
+        os.remove(filename)
+
+
+class CommentArchive:
+    """
+    Compressed comment log, an alternative to the JSON lines of the .log file for long-term storage.
+    The messages are written in chunks of JSON lines, each compressed alone (gzip, or zstd when zstandard
+    is installed), and a footer index of the chunks with their first and last 'received_at',
+    so CommentArchiveReader can read a time range without decompressing the whole file.
+
+    File layout:
+        b'SRLZ1 <codec>\n'
+        chunks: struct '<IIqq' (compressed size, messages, first and last received_at), compressed JSON lines
+        footer: JSON of meta, codec, count and chunks [[offset, messages, first, last], ...]
+        trailer: struct '<Q4s' (footer offset, b'SRLZ')
+    """
+    extension = '.logz'
+    magic = b'SRLZ'
+    chunkHeader = struct.Struct('<IIqq')
+    trailer = struct.Struct('<Q4s')
+    codecs = {
+        'gzip': (lambda data: gzip.compress(data, compresslevel=6, mtime=0), gzip.decompress),
+    }
+    if zstandard is not None:
+        codecs['zstd'] = (zstandard.ZstdCompressor(level=9).compress, zstandard.ZstdDecompressor().decompress)
+
+    def __init__(self, filename, meta, chunkSize=2000, codec=None):
+        """
+        :param filename
+        :param meta: dict saved in the footer: room_url_key, room_name, ws_startTime
+        :param chunkSize: messages per compressed chunk
+        :param codec: 'gzip' or 'zstd', default: zstd if zstandard is installed
+        """
+        if codec is None:
+            codec = 'zstd' if 'zstd' in self.codecs else 'gzip'
+        self.filename = filename
+        self.meta = meta
+        self.codec = codec
+        self.chunkSize = chunkSize
+        self.count = 0
+        self.chunks = []
+        self._compress = self.codecs[codec][0]
+        self._lines = []
+        self._first = None
+        self._last = None
+        self._fp = open(filename, 'wb')
+        self._fp.write(self.magic + '1 {}\n'.format(codec).encode('ascii'))
+
+    def append(self, data, line=None):
+        """
+        :param data: message dict
+        :param line: the message as a JSON string, default: data dumped to JSON
+        """
+        if line is None:
+            line = json.dumps(data, ensure_ascii=False)
+        self._lines.append(line)
+        received_at = data['received_at']
+        if self._first is None:
+            self._first = self._last = received_at
+        else:
+            # the clock can go backwards, so the range of the chunk is its earliest and latest message
+            self._first = min(self._first, received_at)
+            self._last = max(self._last, received_at)
+        if len(self._lines) >= self.chunkSize:
+            self.flush()
+
+    def flush(self):
+        """ compress and write the buffered messages as one chunk """
+        if len(self._lines) == 0:
+            return
+        data = self._compress(('\n'.join(self._lines) + '\n').encode('utf-8'))
+        offset = self._fp.tell()
+        self._fp.write(self.chunkHeader.pack(len(data), len(self._lines), self._first, self._last))
+        self._fp.write(data)
+        self.chunks.append([offset, len(self._lines), self._first, self._last])
+        self.count += len(self._lines)
+        self._lines = []
+        self._first = self._last = None
+
+    def close(self):
+        if self._fp.closed:
+            return
+        self.flush()
+        footer = json.dumps({'meta': self.meta, 'codec': self.codec, 'count': self.count, 'chunks': self.chunks},
+                            ensure_ascii=False).encode('utf-8')
+        offset = self._fp.tell()
+        self._fp.write(footer)
+        self._fp.write(self.trailer.pack(offset, self.magic))
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CommentArchiveReader:
+    """
+    Reader of a CommentArchive file. The footer index is read when the archive is opened;
+    an archive without one (cut by a crash) is indexed from the headers of its chunks instead
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.meta = {}
+        self.chunks = []
+        with open(filename, 'rb') as fp:
+            header = fp.readline()
+            if not header.startswith(CommentArchive.magic):
+                raise ValueError('{} is not a comment archive'.format(filename))
+            self.codec = header[len(CommentArchive.magic) + 1:].strip().decode('ascii')
+            if self.codec not in CommentArchive.codecs:
+                raise ValueError('{}: the {} codec is not available, install zstandard'.format(filename, self.codec))
+            self._decompress = CommentArchive.codecs[self.codec][1]
+            if not self._readFooter(fp):
+                logging.debug('{}: no footer index, scanning the chunks'.format(filename))
+                self._scanChunks(fp, len(header))
+        self.count = sum(chunk[1] for chunk in self.chunks)
+
+    def _readFooter(self, fp):
+        size = fp.seek(0, os.SEEK_END)
+        if size < CommentArchive.trailer.size:
+            return False
+        fp.seek(size - CommentArchive.trailer.size)
+        offset, magic = CommentArchive.trailer.unpack(fp.read(CommentArchive.trailer.size))
+        if magic != CommentArchive.magic or offset >= size:
+            return False
+        fp.seek(offset)
+        try:
+            footer = json.loads(fp.read(size - CommentArchive.trailer.size - offset).decode('utf-8'))
+        except (UnicodeDecodeError, JSONDecodeError):
+            return False
+        self.meta = footer['meta']
+        self.chunks = footer['chunks']
+        return True
+
+    def _scanChunks(self, fp, offset):
+        size = fp.seek(0, os.SEEK_END)
+        while offset + CommentArchive.chunkHeader.size <= size:
+            fp.seek(offset)
+            length, count, first, last = CommentArchive.chunkHeader.unpack(fp.read(CommentArchive.chunkHeader.size))
+            end = offset + CommentArchive.chunkHeader.size + length
+            if end > size:
+                # the last chunk was cut
+                break
+            self.chunks.append([offset, count, first, last])
+            offset = end
+
+    def messages(self, start=None, end=None):
+        """
+        :param start: timestamp in milliseconds, only messages received at or after it
+        :param end: timestamp in milliseconds, only messages received before it
+        :return an iterator of the messages, in the order they were written.
+            Only the chunks overlapping [start, end) are read and decompressed
+        """
+        with open(self.filename, 'rb') as fp:
+            for offset, count, first, last in self.chunks:
+                if (start is not None and last < start) or (end is not None and first >= end):
+                    continue
+                fp.seek(offset)
+                length = CommentArchive.chunkHeader.unpack(fp.read(CommentArchive.chunkHeader.size))[0]
+                lines = self._decompress(fp.read(length)).decode('utf-8').split('\n')
+                isInside = (start is None or first >= start) and (end is None or last < end)
+                for line in lines:
+                    if len(line) == 0:
+                        continue
+                    data = json.loads(line)
+                    if isInside or ((start is None or data['received_at'] >= start)
+                                    and (end is None or data['received_at'] < end)):
+                        yield data
+
+    def __iter__(self):
+        return self.messages()
+
+    def __len__(self):
+        return self.count
+
+
+class CommentDatabase:
+    """
+    SQLite database of the recorded messages of all rooms and lives, in WAL mode,
+    so the lives can be queried together and rendered by batchConvertDatabase().
+
+    append() only adds the message to the pending rows of its live; a writer thread inserts them
+    in one transaction when batchRows are pending, or every flushInterval seconds,
+    so the recorders never wait for the disk.
+    A live without a live_id is stored with -ws_startTime instead, so that its messages can be told apart
+    from the other lives of the room and read back
+    """
+    schema = [
+        'CREATE TABLE IF NOT EXISTS lives (room_id INTEGER, live_id INTEGER, room_url_key TEXT, room_name TEXT, '
+        'ws_startTime INTEGER, PRIMARY KEY (room_id, live_id))',
+        'CREATE TABLE IF NOT EXISTS messages (room_id INTEGER, live_id INTEGER, received_at INTEGER, t TEXT, '
+        'data TEXT)',
+        'CREATE INDEX IF NOT EXISTS messages_live ON messages (room_id, live_id, received_at)',
+    ]
+
+    def __init__(self, filename, batchRows=500, flushInterval=2):
+        """
+        :param filename
+        :param batchRows: pending rows of a live which are inserted at once
+        :param flushInterval: seconds, the longest time a message is pending
+        """
+        self.filename = filename
+        self.batchRows = batchRows
+        self.flushInterval = flushInterval
+        self.row_count = 0
+        self.transaction_count = 0
+        self.error_count = 0
+        self._pending = {}  # (room_id, live_id): list of rows
+        self._lock = threading.Lock()
+        self._batches = queue.Queue()  # lists of rows, or None to close
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        self._conn = openDatabase(filename)
+        try:
+            with self._conn:
+                for statement in self.schema:
+                    self._conn.execute(statement)
+        except sqlite3.Error:
+            self._conn.close()
+            raise
+        self._thread = threading.Thread(target=self._write, name='database', daemon=True)
+        self._thread.start()
+
+    def addLive(self, room_id, live_id, room_url_key, room_name, ws_startTime):
+        """ record a live, kept with its first ws_startTime when the recorder reconnects """
+        self._batches.put([('lives', (room_id, live_id, room_url_key, room_name, ws_startTime))])
+
+    def append(self, room_id, live_id, data, line=None):
+        """
+        :param data: message dict
+        :param line: the message as a JSON string, default: data dumped to JSON
+        """
+        if line is None:
+            line = json.dumps(data, ensure_ascii=False)
+        row = ('messages', (room_id, live_id, data['received_at'], data.get('t'), line))
+        with self._lock:
+            rows = self._pending.setdefault((room_id, live_id), [])
+            rows.append(row)
+            if len(rows) >= self.batchRows:
+                self._batches.put(self._pending.pop((room_id, live_id)))
+
+    def pendingCount(self):
+        with self._lock:
+            pending = sum(len(rows) for rows in self._pending.values())
+        return pending + sum(len(rows) for rows in list(self._batches.queue) if rows is not None)
+
+    def _takePending(self):
+        with self._lock:
+            batches = list(self._pending.values())
+            self._pending = {}
+        return batches
+
+    def _write(self):
+        nextFlush = time.monotonic() + self.flushInterval
+        isClosing = False
+        while not isClosing:
+            try:
+                batches = [self._batches.get(timeout=max(nextFlush - time.monotonic(), 0))]
+            except queue.Empty:
+                batches = []
+            # everything already queued goes in the same transaction
+            while True:
+                try:
+                    batches.append(self._batches.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batches:
+                isClosing = True
+                batches = [rows for rows in batches if rows is not None]
+            if isClosing or time.monotonic() >= nextFlush:
+                batches.extend(self._takePending())
+                nextFlush = time.monotonic() + self.flushInterval
+            if batches:
+                self._insert(batches)
+
+    def _insert(self, batches):
+        lives = [row for rows in batches for table, row in rows if table == 'lives']
+        messages = [row for rows in batches for table, row in rows if table == 'messages']
+        try:
+            with self._conn:
+                self._conn.executemany('INSERT OR IGNORE INTO lives VALUES (?, ?, ?, ?, ?)', lives)
+                self._conn.executemany('INSERT INTO messages VALUES (?, ?, ?, ?, ?)', messages)
+        except sqlite3.Error as e:
+            self.error_count += 1
+            logging.error('Failed to insert {} messages into {}: {}'.format(len(messages), self.filename, e))
+            return
+        self.row_count += len(messages)
+        self.transaction_count += 1
+
+    def close(self):
+        """ insert the pending messages, and close the database """
+        if self._thread.is_alive():
+            self._batches.put(None)
+            self._thread.join()
+        self._conn.close()
+
+    def stats(self):
+        return {'rows': self.row_count, 'transactions': self.transaction_count, 'pending': self.pendingCount(),
+                'errors': self.error_count}
+
+
+def commentDatabase(settings):
+    """
+    :return the CommentDatabase of database_file, or None when it is not set or can't be opened
+    """
+    filename = settings['program_settings']['database_file']
+    if len(filename) == 0:
+        return None
+    try:
+        database = CommentDatabase(filename, settings['program_settings']['database_batch_rows'],
+                                   settings['program_settings']['database_flush_interval'])
+    except (sqlite3.Error, OSError) as e:
+        logging.error('Failed to open database {}, messages are not saved to it: {}'.format(filename, e))
+        return None
+    logging.info('Saving messages to database {}'.format(filename))
+    return database
+
+
+def openDatabase(filename, readOnly=False):
+    """
+    :param readOnly: open an existing database only to read it, instead of creating it when missing
+    :return a connection to the SQLite database of CommentDatabase, in WAL mode so that it can be read
+        (and written by the other shard workers) while recording
+    """
+    if readOnly:
+        uri = 'file:{}?mode=ro'.format(urllib.parse.quote(os.path.abspath(filename)))
+        return sqlite3.connect(uri, timeout=30, check_same_thread=False, uri=True)
+    conn = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def databaseLives(filename, room_url_key=None):
+    """
+    :return a list of the lives in a CommentDatabase file, dicts of room_id, live_id, room_url_key, room_name,
+        ws_startTime and the number of messages
+    """
+    conn = openDatabase(filename, readOnly=True)
+    try:
+        query = 'SELECT room_id, live_id, room_url_key, room_name, ws_startTime, ' \
+                '(SELECT count(*) FROM messages m WHERE m.room_id = l.room_id AND m.live_id IS l.live_id) ' \
+                'FROM lives l'
+        params = ()
+        if room_url_key is not None:
+            query += ' WHERE room_url_key = ?'
+            params = (room_url_key,)
+        keys = ('room_id', 'live_id', 'room_url_key', 'room_name', 'ws_startTime', 'count')
+        return [dict(zip(keys, row)) for row in conn.execute(query + ' ORDER BY ws_startTime', params)]
+    finally:
+        conn.close()
+
+
+def iterDatabaseLive(filename, room_id, live_id):
+    """
+    :return an iterator of the messages of one live in a CommentDatabase file, sorted by 'received_at'
+    """
+    conn = openDatabase(filename, readOnly=True)
+    try:
+        # IS also matches the lives without a live_id saved by older versions
+        for (line,) in conn.execute('SELECT data FROM messages WHERE room_id = ? AND live_id IS ? '
+                                    'ORDER BY received_at', (room_id, live_id)):
+            yield json.loads(line)
+    finally:
+        conn.close()
+
+
+def timeString(startTime):
+    """
+    :param startTime: timestamp in milliseconds
+    :return the time in Tokyo as 'yymmdd HHMMSS', used in the file names
+    """
+    # change time zone to Tokyo time
+    tokyo_timezone = pytz.timezone('Asia/Tokyo')
+    dt = datetime.datetime.fromtimestamp(startTime / 1000.0)
+    dt_tokyo = dt.astimezone(tokyo_timezone)
+    return dt_tokyo.strftime('%y%m%d %H%M%S')
+
+
+def commentsFolder():
+    """
+    :return the subfolder 'comments' (created if not present), or the current folder if it can't be created
+    """
+    path = os.getcwd()
+    path = os.path.join(path, "comments")
+    if not os.path.isdir(path):
+        try:
+            os.mkdir(path)
+        except OSError:
+            path = os.getcwd()
+    return path
+
+
+def danmakuFilenames(room_url_key, room_name, startTime, path=None):
+    """
+    :param path: folder of the files, default: the folder 'comments'
+    :return (filename, fallback filename) without extension, under the folder 'comments'.
+        The fallback filename has no room_name, in case that room_name is still invalid
+    """
+    time_string = timeString(startTime)
+
+    # create subfolder 'comments'
+    if path is None:
+        path = commentsFolder()
+
+    # remove invalid file name characters \ / : * ? " < > |
+    invalidChar = ['\\', '/', ':', '*', '?', '"', '<', '>', '|']
+    for c in invalidChar:
+        room_name = room_name.replace(c, '_')
+
+    filename = os.path.join(path, room_url_key + ' ' + time_string + ' ' + room_name)
+
+    # in case that room_name is still invalid
+    filename2 = os.path.join(path, room_url_key + ' ' + time_string)
+    return filename, filename2
+
+
+class RollingDanmaku:
+    """
+    Rolling ass output of a live which is still being recorded.
+    Every N minutes the comments of the completed window are rendered and appended to the ass file.
+    The DanmakuWriter keeps the layout slots across windows, so the file is always current
+    and is never re-rendered from the start
+    """
+
+    def __init__(self, room_url_key, room_name, startTime, danmaku_settings, windowMinutes):
+        self.room_url_key = room_url_key
+        self.room_name = room_name
+        self.startTime = startTime
+        self.danmaku_settings = danmaku_settings
+        self.window = windowMinutes * 60 * 1000  # milliseconds
+        self.windowEnd = startTime + self.window
+        self.assfile = None
+        self.assfiles = []  # of all output profiles, the main one first
+        self.count = 0  # rendered messages
+        self._pending = []
+        self._lock = threading.Lock()
+        self._writer = None  # MultiDanmakuWriter
+
+    def append(self, data):
+        with self._lock:
+            self._pending.append(data)
+
+    def isDue(self, now):
+        """
+        :param now: timestamp in milliseconds
+        """
+        return now >= self.windowEnd
+
+    def tick(self, now):
+        """
+        Render the completed windows
+
+        :param now: timestamp in milliseconds
+        """
+        if not self.isDue(now):
+            return
+        while self.windowEnd <= now:
+            self.windowEnd += self.window
+        self.flush(self.windowEnd - self.window)
+
+    def flush(self, until=None):
+        """
+        Render the pending comments received before `until` (timestamp in milliseconds), or all of them
+        """
+        with self._lock:
+            if until is None:
+                window = self._pending
+                self._pending = []
+            else:
+                window = [data for data in self._pending if data['received_at'] < until]
+                self._pending = [data for data in self._pending if data['received_at'] >= until]
+        if len(window) == 0:
+            return
+
+        window.sort(key=lambda x: x['received_at'])
+        try:
+            if self._writer is None:
+                self._open()
+            self._writer.write(window)
+            for writer in self._writer.writers:
+                writer.fp.flush()
+            self.count += len(window)
+        except OSError as e:
+            logging.error('{}: Failed to write rolling ass file: {}'.format(self.room_url_key, e))
+
+    def _open(self):
+        filename, filename2 = danmakuFilenames(self.room_url_key, self.room_name, self.startTime)
+        try:
+            self._writer, self.assfiles = openDanmakuWriter(filename, self.startTime, self.danmaku_settings)
+        except OSError as e:
+            logging.error('OSError: {}'.format(e))
+            logging.error('--> try to use {} as filename'.format(self.room_url_key))
+            self._writer, self.assfiles = openDanmakuWriter(filename2, self.startTime, self.danmaku_settings)
+        self.assfile = self.assfiles[0]
+        self._writer.writeHeader()
+        logging.info('{}: writing rolling ass file {}'.format(self.room_url_key, self.assfile))
+
+    def close(self):
+        self.flush()
+        if self._writer is not None:
+            for writer, assfile in zip(self._writer.writers, self.assfiles):
+                writer.fp.close()
+                if writer.densityText():
+                    logging.info('{}: {}'.format(self.room_url_key, writer.densityText()))
+                logging.info(self.room_url_key + ': recording finished, saved to ' + assfile)
+
+
+def saveDanmaku(room_url_key, room_name, startTime, messages, count, settings, saveAssFile=True, logLines=None):
+    """
+    Convert recorded messages to danmaku, and save the ass file (and the log file, JSON lines or CommentArchive
+    by log_format) under the folder 'comments'
+
+    :param room_url_key
+    :param room_name
+    :param startTime: comments recording start time (timestamp in milliseconds)
+    :param messages: function returning an iterable of recorded messages sorted by 'received_at'
+    :param count: number of recorded messages
+    :param settings
+    :param saveAssFile: False when the ass file is already written, e.g. by RollingDanmaku
+    :param logLines: function returning an iterable of the messages as JSON strings for the log file,
+        default: the messages dumped to JSON
+    """
+    if count == 0:
+        logging.info('{}: no comments to save'.format(room_url_key))
+    if not saveAssFile:
+        count = 0
+
+    filename, filename2 = danmakuFilenames(room_url_key, room_name, startTime)
+    isArchive = settings['program_settings']['log_format'] == 1
+    extension = CommentArchive.extension if isArchive else '.log'
+    logfile = filename + extension
+    logfile2 = filename2 + extension
+
+    def saveLog(_logfile):
+        if isArchive:
+            meta = {'room_url_key': room_url_key, 'room_name': room_name, 'ws_startTime': startTime}
+            with CommentArchive(_logfile, meta) as archive:
+                if logLines is not None:
+                    # the messages and their JSON lines are in the same order
+                    for item, line in zip(messages(), logLines()):
+                        archive.append(item, line)
+                else:
+                    for item in messages():
+                        archive.append(item)
+        else:
+            with open(_logfile, 'w', encoding='utf8') as logfp:
+                if logLines is not None:
+                    for line in logLines():
+                        logfp.write(line + '\n')
+                else:
+                    for item in messages():
+                        logfp.write('{}{}'.format(json.dumps(item, ensure_ascii=False), '\n'))
+        logging.info(room_url_key + ': recording finished, saved to ' + _logfile)
+
+    def saveAss(_filename):
+        # convert comments to danmaku, straight to the files of all output profiles in one pass
+        multiWriter, assfiles = openDanmakuWriter(_filename, startTime, settings['danmaku_settings'])
+        try:
+            multiWriter.writeHeader()
+            multiWriter.write(messages())
+        finally:
+            for writer in multiWriter.writers:
+                writer.fp.close()
+        for writer, assfile in zip(multiWriter.writers, assfiles):
+            if writer.densityText():
+                logging.info('{}: {}'.format(room_url_key, writer.densityText()))
+            logging.info(room_url_key + ': recording finished, saved to ' + assfile)
+
+    try:
+        if settings['program_settings']['save_comments_debug_log'] > 0:
+            saveLog(logfile)
+        if count > 0:
+            saveAss(filename)
+    except FileNotFoundError as e:
+        logging.error('FileNotFoundError: {}'.format(e))
+        logging.error('--> try to use {} as filename'.format(room_url_key))
+        if settings['program_settings']['save_comments_debug_log'] > 0:
+            saveLog(logfile2)
+        if count > 0:
+            saveAss(filename2)
+    except OSError as e:
+        logging.error('OSError: {}'.format(e))
+        logging.error('--> try to use {} as filename'.format(room_url_key))
+        if settings['program_settings']['save_comments_debug_log'] > 0:
+            saveLog(logfile2)
+        if count > 0:
+            saveAss(filename2)
+
+
+class CommentRecorder:
+    def __init__(self, room_url_key, room_data, settings, comment_output_func = None, liveness = None,
+                 database = None, roomCache = None):
+        self.settings = settings
+        self.show_debug_message = settings['program_settings']['show_debug_message']  # 1: enable, 0: disable
+        self.save_comments_debug_log = settings['program_settings']['save_comments_debug_log']  # 1: enable, 0: disable
+
+        self.room_data = room_data
+        self.room_url_key = room_url_key
+        self.room_name = self.room_data['main_name']
+        self.room_id = self.room_data['room_id']
+        self.live_id = self.room_data.get('live_id')
+
+        if settings['program_settings']['compact_comment_store'] > 0:
+            self.comment_log = CommentStore(keepRaw=self.save_comments_debug_log > 0)
+        else:
+            self.comment_log = []
+        self.journal = None  # CommentJournal when journal_mode is enabled
+        self.rolling = None  # RollingDanmaku when rolling_output_minutes is set
+        self._thread_main = None
+        self.comment_count = 0
+        self.ws = None
+        self.ws_startTime = 0
+        self.ws_send_txt = ''
+        self._thread_interval = None
+        self._isQuit = False
+        self._isRecording = False
+        self.assembler = FrameAssembler(settings['program_settings']['ws_max_message_size'])
+        self.decoder = MessageDecoder()
+        self.inbox = None  # MessageQueue between the reader and the processing, None: processed while reading
+        if settings['program_settings']['message_queue_size'] > 0:
+            self.inbox = MessageQueue(settings['program_settings']['message_queue_size'],
+                                      settings['program_settings']['message_queue_policy'])
+        self._thread_process = None
+        self.dedup = None  # CommentDeduplicator when dedup_window is set
+        if settings['program_settings']['dedup_window'] > 0:
+            self.dedup = CommentDeduplicator(settings['program_settings']['dedup_window'],
+                                             settings['program_settings']['dedup_max_entries'],
+                                             settings['program_settings']['dedup_count_suffix'] > 0)
+        self.bytes_received = 0  # payload bytes of the frames
+        self.last_frame_at = 0.0  # time.time() of the last frame
+        self.finalize_seconds = None
+
+        self.comment_output_func = comment_output_func
+        self.liveness = liveness  # LivenessSnapshot
+        self.database = database  # CommentDatabase when database_file is set
+        self.databaseLiveId = None  # live_id of the live in the database
+        self.roomCache = roomCache  # RoomCache when room_cache_ttl is set
+        self._liveInfo = None  # Future of live_info, confirming a speculative connection
+        self._speculativeServer = None  # (bcsvr_host, bcsvr_port) of a speculative connection
+        self._reconnectUri = None  # broadcast server of live_info, when the speculative connection was not to it
+        self._isStopped = False  # stop() was called, the recorder doesn't reconnect
+        self.isSpeculative = False  # connected with the cached broadcast server and the bcsvr_key of onlives
+        self.seen_at = time.time()  # when the room was seen on live
+        self.connect_seconds = None  # from seen_at to the WebSocket connected
+        self.first_frame_seconds = None  # from seen_at to the first frame
+
+    @property
+    def isRecording(self):
+        return self._isRecording
+
+    @property
+    def isFinished(self):
+        """ True when record() has returned, whether the room was on live or not """
+        return self._thread_main is not None and not self._thread_main.is_alive()
+
+    def start(self):
+        self._thread_main = threading.Thread(target=self.record, name=self.room_url_key)
+        self._thread_main.start()
+
+    def record(self):
+        """
+        Record comments and save as niconico danmaku (弾幕 / bullets) subtitle ass file
+        """
+        ws_uri = self.prepare()
+        if ws_uri is None:
+            return False
+
+        self.ws_start(ws_uri)
+        if self.ws_startTime == 0 and self._liveInfo is not None:
+            ws_uri = self.retryLiveInfo()
+            if ws_uri is not None:
+                self.ws_start(ws_uri)
+        if self._reconnectUri is not None:
+            self._thread_interval.join()
+            ws_uri = self.reconnect()
+            if ws_uri is not None:
+                self.ws_start(ws_uri)
+
+        if self._thread_interval is not None:
+            self._thread_interval.join()
+
+        self.finalize()
+        return True
+
+    def openOutputs(self):
+        """
+        Open the journal and the rolling ass output when they are enabled, once ws_startTime is known
+        """
+        if self.database is not None:
+            # kept for the whole recording, live_info can still update live_id, or the live has none
+            self.databaseLiveId = self.live_id if self.live_id is not None else -self.ws_startTime
+            self.database.addLive(self.room_id, self.databaseLiveId, self.room_url_key, self.room_name,
+                                  self.ws_startTime)
+
+        if self.settings['program_settings']['rolling_output_minutes'] > 0:
+            self.rolling = RollingDanmaku(self.room_url_key, self.room_name, self.ws_startTime,
+                                          self.settings['danmaku_settings'],
+                                          self.settings['program_settings']['rolling_output_minutes'])
+
+        if self.settings['program_settings']['journal_mode'] > 0:
+            header = {'room_url_key': self.room_url_key, 'room_name': self.room_name, 'room_id': self.room_id,
+                      'live_id': self.live_id, 'ws_startTime': self.ws_startTime}
+            filename = os.path.join(commentsFolder(), '{} {}{}'.format(
+                self.room_url_key, timeString(self.ws_startTime), CommentJournal.extension))
+            try:
+                self.journal = CommentJournal(filename, header,
+                                              self.settings['program_settings']['journal_fsync_interval'])
+            except OSError as e:
+                logging.error('{}: Failed to create journal, keep comments in memory: {}'.format(self.room_url_key, e))
+
+    def appendMessage(self, data):
+        if self.journal is not None:
+            self.journal.append(data)
+        else:
+            self.comment_log.append(data)
+        if self.rolling is not None:
+            self.rolling.append(data)
+        if self.database is not None:
+            self.database.append(self.room_id, self.databaseLiveId, data)
+
+    def recordMessage(self, data, comment=None):
+        """ record a decoded message, through the deduplicator when there is one """
+        if self.dedup is None:
+            self.appendMessage(data)
+        else:
+            for ready in self.dedup.push(data, data['received_at'], comment):
+                self.appendMessage(ready)
+
+    def receiveMessage(self, ws, message):
+        """ a whole text message from the reader, queued for processing when there is an inbox """
+        if self.inbox is None:
+            self.processMessage(ws, message)
+        else:
+            self.inbox.put((int(time.time() * 1000), message))
+
+    def process_messages(self, ws):
+        """
+        processing thread of the inbox, until the reader closes it
+        """
+        try:
+            while True:
+                messages = self.inbox.get()
+                if messages is None:
+                    break
+                for received_at, message in messages:
+                    self.processMessage(ws, message, received_at)
+        finally:
+            # the reader must not wait for room in a queue which is no longer read
+            self.inbox.close()
+
+    def processMessage(self, ws, message, received_at=None):
+        """
+        ws_on_message() for one message: an error is logged and the recording goes on with the next message,
+        as websocket-client does for its callbacks
+        """
+        try:
+            self.ws_on_message(ws, message, received_at)
+        except Exception as e:
+            logging.error('{}: failed to process a message: {} - {}'.format(self.room_url_key, type(e).__name__, e))
+            logging.debug('{}: the message was: {}'.format(self.room_url_key, message))
+
+    def ws_on_message(self, ws, message, received_at=None):
+        """ WebSocket callback """
+        # "created at" has no millisecond part, so we record the precise time here, or when it was read
+        now = received_at if received_at is not None else int(time.time() * 1000)
+
+        data = self.decoder.decode(message)
+        if data is None:  # broken, or a gift which is not recorded
+            return
+
+        # add current time
+        data['received_at'] = now
+
+        # Some useful info in the message:
+        # ['t']  message type, determine the message is comment, telop, or gift
+        # ['cm'] comment
+        # ['ac'] name
+        # ['u']  user_id
+        # ['av'] avatar_id
+        # ['g'] gift_id
+        # ['n'] gift_num
+
+        # type of the message
+        m_type = str(data['t'])  # could be integer or string
+
+        if m_type == '1':  # comment
+            comment = data['cm']
+
+            # skip counting for 50
+            if len(comment) < 3 and comment.isdecimal() and int(comment) <= 50:
+                # s1 = '⑷'; s2 = u'²'; s3 = '❹'
+                # print(s1.isdigit())  # True
+                # print(s2.isdigit())  # True
+                # print(s1.isdecimal())  # False
+                # print(s2.isdecimal())  # False
+                # int(s1)  # ValueError
+                # int(s2)  # ValueError
+                pass
+            else:
+                comment = comment.replace('\n', ' ')  # replace line break to a space
+                # copy-paste spam, counted by the deduplicator
+                if self.dedup is not None and self.dedup.isRepeat(comment, now):
+                    return
+
+                if self.settings['program_settings']['show_comments'] > 0:
+                    logging.info('{}: {}'.format(self.room_url_key, comment))
+
+                if self.comment_output_func is not None:
+                    self.comment_output_func(comment)
+
+                data['cm'] = comment
+                self.recordMessage(data, comment)
+                self.comment_count += 1
+
+        elif m_type == '2':  # gift
+            pass
+
+        elif m_type == '3':  # voting start
+            self.recordMessage(data)
+
+        elif m_type == '4':  # voting result
+            self.recordMessage(data)
+            logging.debug('{}: has voting result'.format(self.room_url_key))
+
+        elif m_type == '8':  # telop
+            self.recordMessage(data)
+            if data['telop'] is not None:  # could be null
+                # logging.info('{}: telop = {}'.format(self.room_url_key, data['telop']))
+                pass
+
+        elif m_type == '11':  # cumulated gifts report
+            pass
+
+        elif m_type == '101':  # indicating live finished
+            self.recordMessage(data)
+            self._isQuit = True
+
+        else:
+            self.recordMessage(data)
+
+    def ws_on_error(self, ws, error):
+        """ WebSocket callback """
+        logging.error('websocket on error: {} - {}'.format(type(error).__name__, error))
+
+    def ws_on_close(self, ws):
+        """ WebSocket callback """
+        # logging.debug('websocket closed')
+        self._isQuit = True
+
+    def startLive(self):
+        """ the WebSocket is open: start recording the live, unless it was reconnected within the same live """
+        if self.ws_startTime > 0:
+            return
+        self.ws_startTime = int(time.time() * 1000)
+        self.connect_seconds = self.ws_startTime / 1000.0 - self.seen_at
+        self.openOutputs()
+
+    def ws_on_open(self, ws):
+        """ WebSocket callback """
+        self.startLive()
+        # logging.debug('websocket on open')
+
+        # keep sending bcsvr_key to the server to prevent disconnection
+        self._thread_interval = threading.Thread(target=self.interval_send,
+                                                 name='{} interval'.format(self.room_url_key), args=(ws,))
+        self._thread_interval.start()
+
+    def ws_on_frame(self, ws, frame):
+        """
+        WebSocket frame handler, shared by the threaded and the asyncio engines
+
+        :return False when the server closed the connection
+        """
+        self.bytes_received += len(frame.data)
+        self.last_frame_at = time.time()
+        if self.first_frame_seconds is None:
+            self.first_frame_seconds = self.last_frame_at - self.seen_at
+            metrics.live_start_seconds.observe(self.first_frame_seconds)
+        if frame.opcode in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY, ABNF.OPCODE_CONT):
+            # a whole message, after either a non-fragmented single message frame or a last fragmented frame
+            message = self.assembler.feed(frame)
+            if message is not None:
+                opcode, data = message
+                if opcode == ABNF.OPCODE_TEXT:
+                    # decoded by MessageDecoder, straight from the bytes
+                    self.receiveMessage(ws, data)
+
+                elif opcode == ABNF.OPCODE_BINARY:
+                    logging.debug('ws_start: received unknown binary data: {} bytes'.format(len(data)))
+
+        elif frame.opcode == ABNF.OPCODE_CLOSE:
+            # logging.debug('ws_start: received close opcode')
+            # ws.close() will try to send close frame, so we skip sending close frame here
+            return False
+
+        elif frame.opcode == ABNF.OPCODE_PING:
+            logging.debug('ws_start: received ping, sending pong')
+            if len(frame.data) < 126:
+                ws.pong(frame.data)
+            else:
+                logging.debug('ws_start: ping message too big to send')
+
+        elif frame.opcode == ABNF.OPCODE_PONG:
+            logging.debug('ws_start: received pong')
+
+        else:
+            logging.error('ws_start: unknown frame opcode = {}'.format(frame.opcode))
+
+        return True
+
+    def checkIsLive(self):
+        """
+        Check if the room is still on live, from the liveness snapshot when it has the room,
+        otherwise from /room/is_live
+
+        :return False when the live is finished, or the check failed
+        """
+        if self.liveness is not None:
+            isLive = self.liveness.isLive(self.room_id, self.live_id)
+            if isLive is not None:
+                if not isLive:
+                    logging.debug('{} live {} not on onlives, terminating interval thread and websocket...'.format(
+                        self.room_url_key, self.live_id))
+                return isLive
+
+        data = getRoomIsLive(self.room_url_key, self.room_id)
+        if len(data) == 0:
+            return False
+        if data["ok"] == 0:
+            logging.debug('{} not on live, terminating interval thread and websocket...'.format(self.room_url_key))
+            return False
+        # logging.debug('{} still on live, "ok" = {}'.format(self.room_url_key, data["ok"]))
+        return True
+
+    def interval_send(self, ws):
+        """
+        interval thread to send message and to close WebSocket
+        """
+        count = 60
+        while True:
+            # check whether to quit every sec
+            if self._isQuit:
+                break
+
+            # send bcsvr_key every 60 secs
+            if count >= 60:
+                count = 0
+
+                try:
+                    # logging.debug('sending {}'.format(self.ws_send_txt))
+                    ws.send(self.ws_send_txt)
+                except WebSocketConnectionClosedException as e:
+                    logging.debug(
+                        'WebSocket closed before sending message. {} Closing interval thread now...'.format(e))
+                    break
+
+                # also check if the room is still on live
+                if not self.checkIsLive():
+                    break
+
+            if not self.confirmLiveInfo(ws):
+                break
+
+            now = int(time.time() * 1000)
+            if self.journal is not None:
+                self.journal.tick(now)
+            if self.rolling is not None:
+                self.rolling.tick(now)
+
+            time.sleep(1)
+            count += 1
+
+        # close WebSocket
+        if ws is not None:
+            ws.close()
+            ws = None
+        # logging.debug('interval thread finished')
+
+    def ws_start(self, ws_uri):
+        """ WebSocket main loop """
+        self.ws = websocket.WebSocket()
+        # connect
+        try:
+            self.ws.connect(ws_uri)
+        except Exception as e:
+            self.ws_on_error(self.ws, e)
+            return
+
+        self.ws_on_open(self.ws)
+        if self.inbox is not None:
+            self._thread_process = threading.Thread(target=self.process_messages,
+                                                    name='{} process'.format(self.room_url_key), args=(self.ws,))
+            self._thread_process.start()
+
+        while not self._isQuit:
+            try:
+                frame = self.ws.recv_frame()
+            except WebSocketConnectionClosedException as e:
+                logging.debug('ws_start: WebSocket Closed')
+                break
+            except Exception as e:
+                self.ws_on_error(self.ws, e)
+                break
+
+            if not self.ws_on_frame(self.ws, frame):
+                break
+
+        self.ws_on_close(self.ws)
+        self.ws.close()
+
+        # the messages already read are still recorded
+        if self._thread_process is not None:
+            self.inbox.close()
+            self._thread_process.join()
+
+    def prepare(self):
+        """
+        Get live info from https://www.showroom-live.com/api/live/live_info?room_id=xxx
+        If a room closes and then reopen on live within 30 seconds (approximately),
+        the broadcast_key from https://www.showroom-live.com/api/live/onlives
+        will not be updated with the new key. It's the same situation that when a
+        room live is finished, /api/live/onlives will not update its onlives list within
+        about 30 seconds. So here it's better to get accurate broadcast_key
+        from /api/live/live_info
+
+        When the broadcast server of the room is cached, and onlives has a new bcsvr_key (not the one of
+        the last recorded live, which could be outdated as above), the recorder connects straight away
+        and live_info is fetched in parallel, to be checked by confirmLiveInfo()
+
+        :return the WebSocket uri of the broadcast server, or None if the room is not on live
+        """
+        cached = self.roomCache.get(self.room_url_key) if self.roomCache is not None else None
+        bcsvr_key = self.room_data.get('bcsvr_key') or ''
+        if cached is not None and cached.get('bcsvr_host') and len(bcsvr_key) > 0 \
+                and bcsvr_key != cached.get('bcsvr_key'):
+            self.isSpeculative = True
+            self._speculativeServer = (cached['bcsvr_host'], str(cached['bcsvr_port']))
+            self._liveInfo = self.fetchLiveInfo()
+            info = {'bcsvr_key': bcsvr_key, 'bcsvr_host': cached['bcsvr_host'], 'bcsvr_port': cached['bcsvr_port']}
+        else:
+            info = getRoomLiveInfo(self.room_url_key, self.room_id)
+            if len(info) == 0:
+                return None
+            if len(info['bcsvr_key']) == 0:
+                # logging.debug('not on live, no bcsvr_key.')
+                return None
+            self.updateRoomCache(info)
+
+        if self._isQuit:
+            # stopped while getting the live info, e.g. the room was removed from rooms.ini
+            return None
+
+        logging.info('{}: is on live, start recording comments'.format(self.room_url_key))
+
+        # logging.debug(json.dumps(self.room_data, indent=2, ensure_ascii=False))
+
+        self._isRecording = True
+        return self.useLiveInfo(info)
+
+    def useLiveInfo(self, info):
+        """ :return the WebSocket uri of the broadcast server of the live info """
+        self.live_id = info.get('live_id', self.live_id)
+        self.ws_send_txt = 'SUB\t' + info['bcsvr_key']
+        if self.settings['program_settings']['show_debug_message'] > 0:
+            # websocket.enableTrace(True)  # False: disable trace outputs
+            websocket.enableTrace(False)
+        else:
+            websocket.enableTrace(False)
+
+        return 'ws://' + info['bcsvr_host'] + ':' + str(info['bcsvr_port'])
+
+    def retryLiveInfo(self):
+        """
+        The speculative connection failed: wait for live_info, which updates the cached broadcast server
+
+        :return the WebSocket uri of live_info, or None if the room is not on live
+        """
+        future, self._liveInfo = self._liveInfo, None
+        try:
+            info = future.result()
+        except Exception as e:
+            logging.error('{}: Failed to get live info: {} - {}'.format(self.room_url_key, type(e).__name__, e))
+            return None
+        if len(info) == 0 or len(info['bcsvr_key']) == 0:
+            return None
+        self.updateRoomCache(info)
+        logging.info('{}: failed to connect to the cached broadcast server, connecting to the one of live_info'.format(
+            self.room_url_key))
+        return self.useLiveInfo(info)
+
+    def fetchLiveInfo(self):
+        """ :return a Future of the live info, fetched on a thread """
+        future = Future()
+
+        def fetch():
+            try:
+                future.set_result(getRoomLiveInfo(self.room_url_key, self.room_id))
+            except Exception as e:
+                future.set_exception(e)
+
+        threading.Thread(target=fetch, name='{} live_info'.format(self.room_url_key), daemon=True).start()
+        return future
+
+    def updateRoomCache(self, info):
+        if self.roomCache is not None:
+            self.roomCache.update(self.room_url_key, room_id=self.room_id, main_name=self.room_name,
+                                  bcsvr_host=info['bcsvr_host'], bcsvr_port=info['bcsvr_port'],
+                                  bcsvr_key=info['bcsvr_key'])
+
+    def confirmLiveInfo(self, ws):
+        """
+        Check a speculative connection with live_info, once it has arrived. The room is subscribed again
+        when live_info has another bcsvr_key than onlives
+
+        :return False when the room is not on live, or its broadcast server is not the cached one
+        """
+        if self._liveInfo is None or not self._liveInfo.done():
+            return True
+        future, self._liveInfo = self._liveInfo, None
+        try:
+            info = future.result()
+        except Exception as e:
+            info = {}
+            logging.error('{}: Failed to get live info: {} - {}'.format(self.room_url_key, type(e).__name__, e))
+        if len(info) == 0:
+            # keep the connection, the liveness checks still end it with the live
+            return True
+        if len(info['bcsvr_key']) == 0:
+            logging.info('{}: not on live by live_info, closing the connection'.format(self.room_url_key))
+            return False
+
+        self.updateRoomCache(info)
+        if self._speculativeServer != (info['bcsvr_host'], str(info['bcsvr_port'])):
+            logging.info('{}: the broadcast server has changed, reconnecting to the one of live_info'.format(
+                self.room_url_key))
+            self._speculativeServer = (info['bcsvr_host'], str(info['bcsvr_port']))
+            self._reconnectUri = self.useLiveInfo(info)
+            return False
+
+        self.live_id = info.get('live_id', self.live_id)
+        ws_send_txt = 'SUB\t' + info['bcsvr_key']
+        if ws_send_txt != self.ws_send_txt:
+            logging.info('{}: bcsvr_key of onlives is outdated, subscribing again'.format(self.room_url_key))
+            self.ws_send_txt = ws_send_txt
+            try:
+                ws.send(self.ws_send_txt)
+            except WebSocketConnectionClosedException:
+                return False
+        return True
+
+    def reconnect(self):
+        """
+        Connect again to the broadcast server of live_info, after the speculative connection was closed.
+        The live goes on in the same output files
+
+        :return the WebSocket uri, or None when the recorder was stopped in the meantime
+        """
+        ws_uri, self._reconnectUri = self._reconnectUri, None
+        if self._isStopped:
+            return None
+        self._isQuit = False
+        if self.inbox is not None:
+            self.inbox.reopen()
+        return ws_uri
+
+    def finalize(self):
+        """
+        Convert the recorded comments to danmaku, and save the ass file (and the log file)
+        """
+        logging.debug('{}: decoded messages {}, frames {}, queue {}'.format(
+            self.room_url_key, self.decoder.stats(), self.assembler.stats(),
+            self.inbox.stats() if self.inbox is not None else None))
+        startTime = time.perf_counter()
+        if self.dedup is not None:
+            for data in self.dedup.flush():
+                self.appendMessage(data)
+            if self.dedup.suppressed_count > 0:
+                logging.info('{}: {} repeated comments suppressed'.format(self.room_url_key,
+                                                                        self.dedup.suppressed_count))
+        logLines = None
+        if self.journal is not None:
+            self.journal.close()
+            count = self.journal.count
+            if self.journal.isSorted:
+                messages = self.journal.messages
+            else:
+                # the clock went backwards during the live, so the messages need sorting
+                sortedMessages = sorted(self.journal.messages(), key=lambda x: x['received_at'])
+                messages = lambda: sortedMessages
+        elif isinstance(self.comment_log, CommentStore):
+            self.comment_log.sort()
+            count = len(self.comment_log)
+            messages = lambda: iter(self.comment_log)
+            if self.comment_log.raw is not None:
+                logLines = self.comment_log.iterRaw
+        else:
+            # sorting
+            self.comment_log = sorted(self.comment_log, key=lambda x: x['received_at'])
+            count = len(self.comment_log)
+            messages = lambda: self.comment_log
+
+        if self.rolling is not None:
+            self.rolling.close()
+
+        saveDanmaku(self.room_url_key, self.room_name, self.ws_startTime, messages, count, self.settings,
+                    saveAssFile=self.rolling is None, logLines=logLines)
+
+        # the files are saved, so the journal is no longer needed
+        if self.journal is not None:
+            self.journal.remove()
+
+        self.finalize_seconds = time.perf_counter() - startTime
+        metrics.finalize_seconds.observe(self.finalize_seconds)
+        self._isRecording = False
+
+    def metrics(self):
+        """ :return a dict of the counters of this recorder, read without locking """
+        now = time.time()
+        seconds = now - self.ws_startTime / 1000.0 if self.ws_startTime > 0 else 0.0
+        messages = self.decoder.frame_count
+        if self.journal is not None:
+            stored = self.journal.count
+        else:
+            stored = len(self.comment_log)
+        return {'live_id': self.live_id,
+                'recording': self.isRecording,
+                'recording_seconds': round(seconds, 1),
+                'messages': messages,
+                'messages_per_second': round(messages / seconds, 2) if seconds > 0 else 0.0,
+                'comments': self.comment_count,
+                'decode_errors': self.decoder.error_count,
+                'broken_messages': self.decoder.broken_count,
+                'bytes_received': self.bytes_received,
+                'seconds_since_last_frame': round(now - self.last_frame_at, 1) if self.last_frame_at > 0 else None,
+                'comment_log_size': stored,
+                'queue_depth': len(self.inbox) if self.inbox is not None else 0,
+                'queue_dropped': self.inbox.dropped_count if self.inbox is not None else 0,
+                'repeats_suppressed': self.dedup.suppressed_count if self.dedup is not None else 0,
+                'speculative': self.isSpeculative,
+                'connect_seconds': round(self.connect_seconds, 3) if self.connect_seconds is not None else None,
+                'first_frame_seconds': round(self.first_frame_seconds, 3) if self.first_frame_seconds is not None
+                else None,
+                'finalize_seconds': round(self.finalize_seconds, 3) if self.finalize_seconds is not None else None}
+
+    def stop(self):
+        """
+        Tell the comment logger to quit, without waiting for it
+        """
+        self._isStopped = True
+        self._isQuit = True
+
+    def quit(self):
+        """
+        To quit comment logger anytime (to close WebSocket, save file and finish job)
+        """
+        self.stop()
+        self._thread_main.join()
+        if self._thread_interval is not None:
+            self._thread_interval.join()
+
+
+class AsyncWebSocket:
+    """
+    Minimal WebSocket client (RFC 6455) on asyncio streams, used by the asyncio recorder engine.
+    Frames are built by websocket-client's ABNF, and received frames are returned as ABNF objects,
+    so CommentRecorder.ws_on_frame() handles them the same way as frames from websocket.WebSocket
+    """
+
+    def __init__(self):
+        self.reader = None
+        self.writer = None
+        self.connected = False
+
+    async def connect(self, ws_uri, timeout=10):
+        url = urllib.parse.urlsplit(ws_uri)
+        host = url.hostname
+        port = url.port or 80
+        resource = url.path or '/'
+        if url.query:
+            resource += '?' + url.query
+
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+
+        key = base64.b64encode(os.urandom(16)).decode('utf-8')
+        header = 'GET ' + resource + ' HTTP/1.1\r\n'
+        header += 'Upgrade: websocket\r\n'
+        header += 'Connection: Upgrade\r\n'
+        header += 'Host: {}:{}\r\n'.format(host, port)
+        header += 'Origin: http://{}:{}\r\n'.format(host, port)
+        header += 'Sec-WebSocket-Key: ' + key + '\r\n'
+        header += 'Sec-WebSocket-Version: 13\r\n\r\n'
+        self.writer.write(header.encode('utf-8'))
+
+        try:
+            response = await asyncio.wait_for(self.reader.readuntil(b'\r\n\r\n'), timeout)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            self.writer.close()
+            raise WebSocketException('Handshake failed: no response')
+
+        lines = response.decode('latin-1').split('\r\n')
+        status = lines[0].split(' ', 2)
+        if len(status) < 2 or status[1] != '101':
+            self.writer.close()
+            raise WebSocketException('Handshake status {}'.format(lines[0]))
+
+        accept = base64.b64encode(
+            hashlib.sha1((key + '258EAFA5-E914-47DA-95CA-C5AB0DC85B11').encode('utf-8')).digest()).decode('utf-8')
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            if name.strip().lower() == 'sec-websocket-accept':
+                if value.strip() == accept:
+                    break
+                self.writer.close()
+                raise WebSocketException('Invalid WebSocket Header: sec-websocket-accept')
+        else:
+            self.writer.close()
+            raise WebSocketException('Invalid WebSocket Header: no sec-websocket-accept')
+
+        self.connected = True
+
+    async def recv_frame(self):
+        try:
+            b1, b2 = await self.reader.readexactly(2)
+            length = b2 & 0x7f
+            if length == 126:
+                length = struct.unpack('!H', await self.reader.readexactly(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', await self.reader.readexactly(8))[0]
+            has_mask = b2 >> 7
+            mask_key = await self.reader.readexactly(4) if has_mask else None
+            payload = await self.reader.readexactly(length)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            self.connected = False
+            raise WebSocketConnectionClosedException('Connection to remote host was lost. {}'.format(e))
+
+        if mask_key is not None:
+            payload = ABNF.mask(mask_key, payload)
+        return ABNF(b1 >> 7 & 1, b1 >> 6 & 1, b1 >> 5 & 1, b1 >> 4 & 1, b1 & 0x0f, has_mask, payload)
+
+    def send(self, payload, opcode=ABNF.OPCODE_TEXT):
+        # writing to an asyncio transport never blocks, the data is buffered by the event loop
+        if not self.connected or self.writer.is_closing():
+            raise WebSocketConnectionClosedException('socket is already closed.')
+        self.writer.write(ABNF.create_frame(payload, opcode).format())
+
+    def pong(self, payload):
+        self.send(payload, ABNF.OPCODE_PONG)
+
+    def close(self):
+        if self.writer is None:
+            return
+        if self.connected and not self.writer.is_closing():
+            self.writer.write(ABNF.create_frame(struct.pack('!H', 1000), ABNF.OPCODE_CLOSE).format())
+        self.connected = False
+        self.writer.close()
+
+
+class AsyncRecorderEngine:
+    """
+    One asyncio event loop, running on its own thread, which multiplexes
+    the WebSockets, keepalive messages and is_live checks of all AsyncCommentRecorder
+    """
+
+    def __init__(self, max_workers=8):
+        self.loop = None
+        self._thread = None
+        # blocking HTTP requests and the finalizing step run on this small thread pool
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='engine')
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(self._executor)
+        self._thread = threading.Thread(target=self.loop.run_forever, name='async engine')
+        self._thread.start()
+
+    def submit(self, coro):
+        """ Run a coroutine on the engine loop from another thread, return a concurrent.futures.Future """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+        self._executor.shutdown()
+
+
+class AsyncCommentRecorder(CommentRecorder):
+    """
+    CommentRecorder that runs on an AsyncRecorderEngine instead of two threads per room.
+    Messages are handled by the same callbacks, so the recorded output is the same.
+    """
+
+    def __init__(self, room_url_key, room_data, settings, engine, comment_output_func = None, liveness = None,
+                 database = None, roomCache = None):
+        super().__init__(room_url_key, room_data, settings, comment_output_func, liveness, database, roomCache)
+        self.engine = engine
+        self._future = None
+        self._task_interval = None
+        self._task_process = None
+        self._inboxReady = None  # asyncio.Event, set when messages are queued
+        self._inboxDrained = None  # asyncio.Event, set when the queued messages are processed
+
+    @property
+    def isFinished(self):
+        return self._future is not None and self._future.done()
+
+    def start(self):
+        self._future = self.engine.submit(self.arecord())
+        self._future.add_done_callback(self._on_done)
+
+    def _on_done(self, future):
+        # a thread prints its exception, but a future keeps it silently
+        if not future.cancelled() and future.exception() is not None:
+            e = future.exception()
+            logging.error('{}: recorder error: {} - {}'.format(self.room_url_key, type(e).__name__, e))
+            self._isRecording = False
+
+    async def arecord(self):
+        """
+        Coroutine version of record()
+        """
+        loop = asyncio.get_running_loop()
+        ws_uri = await loop.run_in_executor(None, self.prepare)
+        if ws_uri is None:
+            return False
+
+        await self.aws_start(ws_uri)
+        if self.ws_startTime == 0 and self._liveInfo is not None:
+            ws_uri = await loop.run_in_executor(None, self.retryLiveInfo)
+            if ws_uri is not None:
+                await self.aws_start(ws_uri)
+        if self._reconnectUri is not None:
+            await self._task_interval
+            ws_uri = self.reconnect()
+            if ws_uri is not None:
+                await self.aws_start(ws_uri)
+
+        if self._task_interval is not None:
+            await self._task_interval
+
+        await loop.run_in_executor(None, self.finalize)
+        return True
+
+    def ws_on_open(self, ws):
+        """ WebSocket callback """
+        self.startLive()
+
+        # keep sending bcsvr_key to the server to prevent disconnection
+        self._task_interval = asyncio.get_running_loop().create_task(self.ainterval_send(ws))
+
+    async def ainterval_send(self, ws):
+        """
+        interval task to send message and to close WebSocket
+        """
+        loop = asyncio.get_running_loop()
+        count = 60
+        while True:
+            # check whether to quit every sec
+            if self._isQuit:
+                break
+
+            # send bcsvr_key every 60 secs
+            if count >= 60:
+                count = 0
+
+                try:
+                    ws.send(self.ws_send_txt)
+                except WebSocketConnectionClosedException as e:
+                    logging.debug(
+                        'WebSocket closed before sending message. {} Closing interval task now...'.format(e))
+                    break
+
+                # also check if the room is still on live
+                if not await loop.run_in_executor(None, self.checkIsLive):
+                    break
+
+            if not self.confirmLiveInfo(ws):
+                break
+
+            # sync the journal and render the completed window off the event loop
+            now = int(time.time() * 1000)
+            if self.journal is not None and self.journal.isDue(now):
+                await loop.run_in_executor(None, self.journal.sync)
+            if self.rolling is not None and self.rolling.isDue(now):
+                await loop.run_in_executor(None, self.rolling.tick, now)
+
+            await asyncio.sleep(1)
+            count += 1
+
+        # close WebSocket
+        ws.close()
+
+    def receiveMessage(self, ws, message):
+        if self.inbox is None:
+            self.processMessage(ws, message)
+        else:
+            # the reader waits for room before reading (aws_start), never here on the event loop
+            self.inbox.put((int(time.time() * 1000), message), block=False)
+            self._inboxReady.set()
+
+    async def aprocess_messages(self, ws):
+        """
+        processing task of the inbox, until the reader closes it
+        """
+        try:
+            while True:
+                await self._inboxReady.wait()
+                self._inboxReady.clear()
+                messages = self.inbox.drain()
+                for i, (received_at, message) in enumerate(messages):
+                    self.processMessage(ws, message, received_at)
+                    if i % 100 == 99:
+                        await asyncio.sleep(0)  # let the readers run
+                self._inboxDrained.set()
+                if self.inbox.isClosed and len(self.inbox) == 0:
+                    break
+        finally:
+            # the reader must not wait for room in a queue which is no longer read
+            self.inbox.close()
+            self._inboxDrained.set()
+
+    async def aws_start(self, ws_uri):
+        """ WebSocket main loop """
+        self.ws = AsyncWebSocket()
+        # connect
+        try:
+            await self.ws.connect(ws_uri)
+        except Exception as e:
+            self.ws_on_error(self.ws, e)
+            return
+
+        self.ws_on_open(self.ws)
+        if self.inbox is not None:
+            self._inboxReady = asyncio.Event()
+            self._inboxDrained = asyncio.Event()
+            self._task_process = asyncio.get_running_loop().create_task(self.aprocess_messages(self.ws))
+
+        while not self._isQuit:
+            if self.inbox is not None and self.inbox.policy == MessageQueue.BLOCK and self.inbox.isFull() \
+                    and not self.inbox.isClosed:
+                self._inboxDrained.clear()
+                await self._inboxDrained.wait()
+                continue
+            try:
+                frame = await self.ws.recv_frame()
+            except WebSocketConnectionClosedException as e:
+                logging.debug('ws_start: WebSocket Closed')
+                break
+            except Exception as e:
+                self.ws_on_error(self.ws, e)
+                break
+
+            if not self.ws_on_frame(self.ws, frame):
+                break
+
+        self.ws_on_close(self.ws)
+        self.ws.close()
+
+        # the messages already read are still recorded
+        if self._task_process is not None:
+            self.inbox.close()
+            self._inboxReady.set()
+            await self._task_process
+
+    def quit(self):
+        """
+        To quit comment logger anytime (to close WebSocket, save file and finish job)
+        """
+        self.stop()
+        try:
+            self._future.result()
+        except Exception:
+            pass  # already logged by _on_done()
+
+
+class RoomMonitor:
+    def __init__(self, room_url_keys, settings, roomsFile=None):
+        """
+        :param roomsFile: rooms.ini, reloaded when it changes, None: the rooms are fixed
+        """
+        self.room_url_keys = room_url_keys
+        self.nRooms = 0
+        self.cRecords = {}  # room_url_key: CommentRecorder, or None if the room has not been on live
+        self._stopping = {}  # room_url_key: recorder of a room removed from rooms.ini, until it has finished
+        self.roomsWatcher = RoomsFileWatcher(roomsFile) if roomsFile is not None else None
+        self._liveKeys = set()  # watched rooms which were on onlives in the last poll
+        self._isQuit = False
+        self.t = None
+        self.settings = settings
+        self.interval = settings['program_settings']['interval']
+        self.liveness = LivenessSnapshot(max_age=max(3 * self.interval, 60))
+        self.poller = OnLivesPoller(self.interval, settings['program_settings']['onlives_fast_interval'],
+                                    settings['program_settings']['onlives_max_backoff'])
+        self.schedule = LiveSchedule()
+        self.engine = None
+        if settings['program_settings']['async_engine'] > 0:
+            self.engine = AsyncRecorderEngine()
+        self.database = None  # CommentDatabase while monitoring, when database_file is set
+        self.roomCache = roomCache(settings)
+
+    def quit(self):
+        self._isQuit = True
+        self.poller.wake()
+        self.t.join()
+
+    def start(self):
+        self.t = threading.Thread(target=self.monitor)
+        self.t.start()
+        return self.t
+
+    def openDatabase(self):
+        return commentDatabase(self.settings)
+
+    def updateRooms(self, room_url_keys):
+        """
+        Watch the rooms of an edited rooms.ini: the new rooms are added and the removed ones stop recording,
+        the recorders of the other rooms go on untouched
+
+        :return (added, removed), lists of room_url_key
+        """
+        watched = dict.fromkeys(room_url_keys)
+        added = [room_url_key for room_url_key in watched if room_url_key not in self.cRecords]
+        removed = [room_url_key for room_url_key in self.cRecords if room_url_key not in watched]
+        for room_url_key in added:
+            self.cRecords[room_url_key] = None
+        for room_url_key in removed:
+            cr = self.cRecords.pop(room_url_key)
+            self._liveKeys.discard(room_url_key)
+            self.schedule.forget(room_url_key)
+            if cr is not None and not cr.isFinished:
+                # also a recorder still getting the live info
+                logging.info('{}: removed from rooms.ini, stop recording'.format(room_url_key))
+                self.stopRecorder(cr)
+                self._stopping[room_url_key] = cr
+        self.room_url_keys = list(watched)
+        self.nRooms = len(self.room_url_keys)
+        return added, removed
+
+    def stopRecorder(self, cr):
+        cr.stop()
+
+    def reloadRooms(self):
+        """ apply the changes of rooms.ini, if it has changed since the last check """
+        for room_url_key, cr in list(self._stopping.items()):
+            if cr.isFinished:
+                del self._stopping[room_url_key]
+        if self.roomsWatcher is None:
+            return
+        room_url_keys = self.roomsWatcher.check()
+        if room_url_keys is None:
+            return
+        added, removed = self.updateRooms(room_url_keys)
+        if added or removed:
+            logging.info('rooms.ini changed: {} rooms added, {} removed, monitoring {} rooms'.format(
+                len(added), len(removed), self.nRooms))
+        if added:
+            self.poll()  # the added rooms which are on live in the last snapshot
+
+    def startRecorder(self, room_url_key, room):
+        if self.engine is not None:
+            cr = AsyncCommentRecorder(room_url_key, room, self.settings, self.engine, liveness=self.liveness,
+                                      database=self.database, roomCache=self.roomCache)
+        else:
+            cr = CommentRecorder(room_url_key, room, self.settings, liveness=self.liveness, database=self.database,
+                                 roomCache=self.roomCache)
+        cr.start()
+        return cr
+
+    def poll(self):
+        """
+        Match the watched rooms with the published onlives snapshot, and start recording newly on live rooms.
+        Both are hash indexed, so a poll costs O(number of lives), not O(watched rooms x lives)
+
+        :return (newly_live, newly_ended), lists of room_url_key of watched rooms
+        """
+        newly_live = []
+        liveKeys = set()
+        for room_url_key, room in self.liveness.rooms.items():
+            if room_url_key not in self.cRecords:
+                continue
+            liveKeys.add(room_url_key)
+
+            cr = self.cRecords[room_url_key]
+            if cr is not None and not cr.isFinished:
+                # logging.debug('already recording, or getting the live info...')
+                continue
+
+            # logging.debug('{}: is on main site live list.'.format(room_url_key))
+            self.cRecords[room_url_key] = self.startRecorder(room_url_key, room)
+            newly_live.append(room_url_key)
+            if room_url_key not in self._liveKeys:
+                self.schedule.record(room_url_key, room.get('started_at'))
+
+        newly_ended = []
+        for room_url_key in self._liveKeys - liveKeys:
+            newly_ended.append(room_url_key)
+            cr = self.cRecords[room_url_key]
+            if cr is not None and cr.isFinished:
+                self.cRecords[room_url_key] = None
+        self._liveKeys = liveKeys
+
+        return newly_live, newly_ended
+
+    def monitor(self):
+
+        self.nRooms = len(self.room_url_keys)
+
+        self.cRecords = dict.fromkeys(self.room_url_keys)
+
+        if self.engine is not None:
+            self.engine.start()
+        self.database = self.openDatabase()
+
+        # logging.debug('interval = {}, {} rooms = {}'.format(self.interval, self.nRooms, self.room_url_keys))
+        while not self._isQuit:
+            startTime = time.perf_counter()
+            result = self.poller.fetch()
+            if result is not None:
+                rooms, isChanged = result
+                if isChanged:
+                    self.liveness.publish(rooms)
+                else:
+                    self.liveness.touch()
+                self.poll()
+                metrics.poll_seconds.observe(time.perf_counter() - startTime)
+            if self.roomCache is not None:
+                self.roomCache.save()
+
+            self.reloadRooms()
+
+            delay = self.poller.nextDelay(result is not None, len(self.schedule.expected(self._liveKeys)) > 0)
+            self.poller.wait(max(delay - (time.perf_counter() - startTime), 0))
+            # end while
 
-            slots[minIdx] = t + travelTime
-            selectedSlot = minIdx
+        # quitting, tell all recorders to quit first, so that they finish in parallel
+        for cr in self.cRecords.values():
+            if cr is not None:
+                cr.stop()
+        for room_url_key, cr in self.cRecords.items():
+            if cr is not None and not cr.isFinished:
+                if cr.isRecording:
+                    logging.info('quitting ' + room_url_key + '... ')
+                cr.quit()
+                self.cRecords[room_url_key] = None
+        # the removed rooms which are still saving their files
+        for cr in self._stopping.values():
+            cr.quit()
+        self._stopping = {}
+
+        if self.engine is not None:
+            self.engine.stop()
+        if self.database is not None:
+            self.database.close()
+        if self.roomCache is not None:
+            self.roomCache.save()
+
+    def recorderMetrics(self):
+        """
+        :return the metrics of every recorder {room_url_key: dict},
+            and the finalize_seconds and live_start_seconds histograms
+        """
+        rooms = {}
+        for room_url_key, cr in list(self.cRecords.items()):
+            if cr is not None:
+                rooms[room_url_key] = cr.metrics()
+        return rooms, {'finalize_seconds': metrics.finalize_seconds.snapshot(),
+                       'live_start_seconds': metrics.live_start_seconds.snapshot()}
+
+    def metrics(self):
+        """ :return a dict of the metrics of the monitor, the HTTP client and every recorder """
+        rooms, histograms = self.recorderMetrics()
+        return {'monitor': {'watched_rooms': self.nRooms,
+                            'active_recorders': sum(1 for room in rooms.values() if room['recording']),
+                            'lives': len(self.liveness),
+                            'onlives': self.poller.stats(),
+                            'database': self.database.stats() if self.database is not None else None,
+                            'room_cache': self.roomCache.stats() if self.roomCache is not None else None,
+                            'poll_seconds': metrics.poll_seconds.snapshot(),
+                            'onlives_bytes': metrics.onlives_bytes.snapshot(),
+                            'finalize_seconds': histograms['finalize_seconds'],
+                            'live_start_seconds': histograms['live_start_seconds']},
+                'http': sr_client.stats(),
+                'rooms': rooms}
+
+    def view_metrics(self):
+        logging.info(json.dumps(self.metrics(), indent=2, ensure_ascii=False))
 
-        # calculate bullet comment flight positions, from (x1,y1) to (x2,y2) on screen
+    def view_status(self):
+        logging.info('Monitoring rooms: {}'.format(self.nRooms))
+        k = 0
+        s = ''
+        frames = dict.fromkeys(('messages', 'fragmented', 'fragments', 'reassembled_bytes', 'dropped'), 0)
+        queued = dict.fromkeys(('depth', 'longest', 'dropped'), 0)
+        for cr in list(self.cRecords.values()):
+            if cr is not None:
+                if cr.isRecording:
+                    k += 1
+                    s += '  {}) {}: {}{}\n'.format(k, cr.room_url_key, cr.room_name, repeatsText(
+                        cr.dedup.suppressed_count if cr.dedup is not None else 0))
+                    for key, value in cr.assembler.stats().items():
+                        frames[key] += value
+                    if cr.inbox is not None:
+                        stats = cr.inbox.stats()
+                        queued['depth'] += stats['depth']
+                        queued['longest'] = max(queued['longest'], stats['depth'])
+                        queued['dropped'] += stats['dropped']
+        s = 'Recording rooms: {}\n'.format(k) + s
+        s += 'WebSocket messages: {}, fragmented: {} ({} frames, {} bytes), dropped as too large: {}\n'.format(
+            frames['messages'], frames['fragmented'], frames['fragments'], frames['reassembled_bytes'],
+            frames['dropped'])
+        s += 'Message queues: {} waiting (longest queue: {}), dropped when full: {}\n'.format(
+            queued['depth'], queued['longest'], queued['dropped'])
+        stats = sr_client.stats()
+        s += 'HTTP requests: {} (errors: {}), connections: {} new, {} reused, latency: {} ms avg, {} ms max\n'.format(
+            stats['requests'], stats['errors'], stats['new_connections'], stats['reused_connections'],
+            stats['latency_avg_ms'], stats['latency_max_ms'])
+        s += 'Liveness snapshot: {} lives, {} checks from snapshot, {} checks from is_live\n'.format(
+            len(self.liveness), self.liveness.hit_count, self.liveness.miss_count)
+        stats = self.poller.stats()
+        s += 'Onlives polls: {} (not modified: {}, unchanged: {}, errors: {}), next poll in {}s\n'.format(
+            stats['polls'], stats['not_modified'], stats['unchanged'], stats['errors'], stats['delay_seconds'])
+        logging.info(s)
+        return
 
-        # extra flight length so a comment appears and disappears outside of the screen
-        extraLen = math.ceil(len(comment) / 2.0)
 
-        x1 = width + extraLen * fontsize
-        y1 = (selectedSlot + 1) * fontsize
-        x2 = 0 - extraLen * fontsize
-        y2 = y1
+def repeatsText(count):
+    """ :return the repeated comments suppressed in a live, for the status """
+    return ' ({} repeated comments suppressed)'.format(count) if count > 0 else ''
 
-        def msecToAssTime(uTime):
-            """ convert milliseconds to ass subtitle format """
-            msec = uTime % 1000
-            msec = int(round(msec / 10.0))
-            uTime = math.floor(uTime / 1000.0)
-            s = int(uTime % 60)
-            uTime = math.floor(uTime / 60.0)
-            m = int(uTime % 60)
-            h = int(math.floor(uTime / 60.0))
-            msf = ("00" + str(msec))[-2:]
-            sf = ("00" + str(s))[-2:]
-            mf = ("00" + str(m))[-2:]
-            hf = ("00" + str(h))[-2:]
-            return hf + ":" + mf + ":" + sf + "." + msf
 
-        # build ass subtitle script
-        sub = "Dialogue: 3," + msecToAssTime(t) + "," + msecToAssTime(t + travelTime)
-        # alpha: 00 means fully visible, and FF (ie. 255 in decimal) is fully transparent.
-        sub += ",danmakuFont,,0000,0000,0000,,{\\alpha&H" + alpha + "&\\move("
-        sub += str(x1) + "," + str(y1) + "," + str(x2) + "," + str(y2)
-        sub += ")}" + comment + "\n"
+class HashRing:
+    """
+    Consistent hash of room_url_keys to shards. Each shard has many points on a ring of md5 hashes,
+    and a room belongs to the shard of the next point, so rooms are spread evenly,
+    and changing the number of shards only moves about 1/N of the rooms
+    """
 
-        danmaku += sub
-    # end of for
-    return danmaku
+    def __init__(self, shards, replicas=100):
+        points = sorted((self.hash('{}#{}'.format(shard, i)), shard)
+                        for shard in range(shards) for i in range(replicas))
+        self._hashes = [h for h, _ in points]
+        self._shards = [shard for _, shard in points]
 
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
 
-class CommentRecorder:
-    def __init__(self, room_url_key, room_data, settings, comment_output_func = None):
-        self.settings = settings
-        self.show_debug_message = settings['program_settings']['show_debug_message']  # 1: enable, 0: disable
-        self.save_comments_debug_log = settings['program_settings']['save_comments_debug_log']  # 1: enable, 0: disable
+    def shard(self, room_url_key):
+        idx = bisect.bisect(self._hashes, self.hash(room_url_key))
+        return self._shards[idx % len(self._shards)]
 
-        self.room_data = room_data
-        self.room_url_key = room_url_key
-        self.room_name = self.room_data['main_name']
-        self.room_id = self.room_data['room_id']
 
-        self.comment_log = []
-        self._thread_main = None
-        self.comment_count = 0
-        self.ws = None
-        self.ws_startTime = 0
-        self.ws_send_txt = ''
-        self._thread_interval = None
-        self._isQuit = False
-        self._isRecording = False
+class ShardRecorder:
+    """
+    Stand-in of a CommentRecorder running in a shard worker process, kept by ShardedRoomMonitor
+    """
 
-        self.comment_output_func = comment_output_func
+    def __init__(self, room_url_key, room_data, shard):
+        self.room_url_key = room_url_key
+        self.room_name = room_data['main_name']
+        self.room_id = room_data['room_id']
+        self.live_id = room_data.get('live_id')
+        self.shard = shard
+        self._isRecording = True  # until the worker tells the recorder has finished
 
     @property
     def isRecording(self):
         return self._isRecording
 
-    def start(self):
-        self._thread_main = threading.Thread(target=self.record, name=self.room_url_key)
-        self._thread_main.start()
-
-    def record(self):
-        """
-        Record comments and save as niconico danmaku (弾幕 / bullets) subtitle ass file
-        """
+    @property
+    def isFinished(self):
+        return not self._isRecording
 
-        def ws_on_message(ws, message):
-            """ WebSocket callback """
-            # "created at" has no millisecond part, so we record the precise time here
-            now = int(time.time() * 1000)
+    def stop(self):
+        pass  # the worker stops its recorders when it quits
 
-            idx = message.find("{")
-            if idx < 0:
-                logging.error('no JSON message - {}'.format(message))
-                return
-            message = message[idx:]
-            try:
-                data = json.loads(message)
-            except JSONDecodeError as e:
-                # logging.debug('JSONDecodeError, broken message: {}'.format(message))
-                # try to fix
-                message += '","t":"1"}'
-                try:
-                    data = json.loads(message)
-                except JSONDecodeError:
-                    logging.error('JSONDecodeError, failed to fix broken message: {}'.format(message))
-                    return
-                logging.debug('broken message, JSONDecodeError is fixed: {}'.format(message))
-
-            # add current time
-            data['received_at'] = now
-
-            # Some useful info in the message:
-            # ['t']  message type, determine the message is comment, telop, or gift
-            # ['cm'] comment
-            # ['ac'] name
-            # ['u']  user_id
-            # ['av'] avatar_id
-            # ['g'] gift_id
-            # ['n'] gift_num
-
-            # type of the message
-            m_type = str(data['t'])  # could be integer or string
-
-            if m_type == '1':  # comment
-                comment = data['cm']
-
-                # skip counting for 50
-                if len(comment) < 3 and comment.isdecimal() and int(comment) <= 50:
-                    # s1 = '⑷'; s2 = u'²'; s3 = '❹'
-                    # print(s1.isdigit())  # True
-                    # print(s2.isdigit())  # True
-                    # print(s1.isdecimal())  # False
-                    # print(s2.isdecimal())  # False
-                    # int(s1)  # ValueError
-                    # int(s2)  # ValueError
-                    pass
-                else:
-                    comment = comment.replace('\n', ' ')  # replace line break to a space
-                    if self.settings['program_settings']['show_comments'] > 0:
-                        logging.info('{}: {}'.format(self.room_url_key, comment))
+    def quit(self):
+        pass
 
-                    if self.comment_output_func is not None:
-                        self.comment_output_func(comment)
 
-                    data['cm'] = comment
-                    self.comment_log.append(data)
-                    self.comment_count += 1
+def shardWorker(shard, settings, commands, events):
+    """
+    Main of a shard worker process: records the rooms dispatched by ShardedRoomMonitor
+    with CommentRecorder (or AsyncCommentRecorder), and answers the status requests
 
-            elif m_type == '2':  # gift
-                pass
+    Commands: ('start', room_url_key, room, seen_at), ('stop', room_url_key), ('snapshot', rooms),
+    ('settings', program_settings), ('status', seq), ('quit',)
+    Events: ('ended', shard, room_url_key), ('status', shard, seq, status)
+    """
+    # Ctrl-C reaches the whole process group, the monitor tells the workers to quit and save their files
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    log = logging.getLogger()
+    if not log.handlers:
+        # a spawned process (Windows) does not inherit the console handler
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(fmt='%(asctime)s %(message)s', datefmt='%H:%M:%S'))
+        log.addHandler(handler)
+        log.setLevel(logging.DEBUG if settings['program_settings']['show_debug_message'] > 0 else logging.INFO)
+    sr_client.timeout = settings['program_settings']['http_timeout']
+    sr_client.base_url = settings['program_settings']['api_base_url'].rstrip('/')
+    sr_client.setPoolSize(settings['program_settings']['http_pool_size'])  # resolved by main()
+
+    interval = settings['program_settings']['interval']
+    liveness = LivenessSnapshot(max_age=max(3 * interval, 60))
+    engine = None
+    if settings['program_settings']['async_engine'] > 0:
+        engine = AsyncRecorderEngine()
+        engine.start()
+    database = commentDatabase(settings)
+    cache = roomCache(settings)
+    recorders = {}
 
-            elif m_type == '3':  # voting start
-                self.comment_log.append(data)
+    while True:
+        try:
+            command = commands.get(timeout=1)
+        except queue.Empty:
+            command = None
+
+        for room_url_key, cr in list(recorders.items()):
+            if cr.isFinished:
+                del recorders[room_url_key]
+                events.put(('ended', shard, room_url_key))
+        if cache is not None:
+            cache.save()
+
+        if command is None:
+            continue
+        kind = command[0]
+        if kind == 'start':
+            room_url_key, room = command[1], command[2]
+            if engine is not None:
+                cr = AsyncCommentRecorder(room_url_key, room, settings, engine, liveness=liveness, database=database,
+                                          roomCache=cache)
+            else:
+                cr = CommentRecorder(room_url_key, room, settings, liveness=liveness, database=database,
+                                     roomCache=cache)
+            cr.seen_at = command[3]  # in the monitor process
+            cr.start()
+            recorders[room_url_key] = cr
+        elif kind == 'stop':
+            # the room was removed from rooms.ini, the recorder saves its files and is reported as ended
+            cr = recorders.get(command[1])
+            if cr is not None:
+                cr.stop()
+        elif kind == 'snapshot':
+            liveness.publish(command[1])
+        elif kind == 'settings':
+            # updated in place, the recorders read them from the same dict
+            settings['program_settings'].update(command[1])
+        elif kind == 'status':
+            rooms = {}
+            frames = dict.fromkeys(('messages', 'fragmented', 'fragments', 'reassembled_bytes', 'dropped'), 0)
+            for room_url_key, cr in list(recorders.items()):
+                rooms[room_url_key] = dict(cr.metrics(), room_name=cr.room_name)
+                for key, value in cr.assembler.stats().items():
+                    frames[key] += value
+            events.put(('status', shard, command[1], {
+                'pid': os.getpid(), 'rooms': rooms, 'frames': frames, 'http': sr_client.stats(),
+                'finalize_seconds': metrics.finalize_seconds.snapshot(),
+                'live_start_seconds': metrics.live_start_seconds.snapshot(),
+                'liveness': {'lives': len(liveness), 'hits': liveness.hit_count, 'misses': liveness.miss_count}}))
+        elif kind == 'quit':
+            break
 
-            elif m_type == '4':  # voting result
-                self.comment_log.append(data)
-                logging.debug('{}: has voting result'.format(self.room_url_key))
+    # quitting, tell all recorders to quit first, so that they finish in parallel
+    for cr in recorders.values():
+        cr.stop()
+    for room_url_key, cr in recorders.items():
+        if cr.isRecording:
+            logging.info('quitting ' + room_url_key + '... ')
+        cr.quit()
+    if engine is not None:
+        engine.stop()
+    if database is not None:
+        database.close()
+    if cache is not None:
+        cache.save()
+
+
+class ShardedRoomMonitor(RoomMonitor):
+    """
+    RoomMonitor which records in shard_processes worker processes, so that decoding and rendering
+    use more than one CPU core. The watched rooms are split by a consistent hash of room_url_key.
+    This process only polls onlives, and dispatches the start of the recordings and the snapshots
+    """
+    quitTimeout = 60  # seconds for the workers to save their files when quitting, before they are terminated
+
+    def __init__(self, room_url_keys, settings, roomsFile=None):
+        super().__init__(room_url_keys, settings, roomsFile)
+        self.engine = None  # the recorders run in the workers
+        self.roomCache = None  # and use the room cache there
+        self.shards = settings['program_settings']['shard_processes']
+        self.ring = HashRing(self.shards)
+        self._commands = []
+        self._events = None
+        self._workers = []
+        self._receiver = None
+        self._lock = threading.Lock()
+        self._statusSeq = 0
+        self._shardStatus = {}  # shard: (seq, status)
+        self._lastStatuses = {}
+        self._programSettings = dict(settings['program_settings'])
+
+    def startWorkers(self):
+        self._events = multiprocessing.Queue()
+        for shard in range(self.shards):
+            commands = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=shardWorker, name='shard {}'.format(shard),
+                                             args=(shard, self.settings, commands, self._events))
+            worker.start()
+            self._commands.append(commands)
+            self._workers.append(worker)
+        self._receiver = threading.Thread(target=self.receive, name='shard events')
+        self._receiver.start()
+        logging.info('Recording in {} processes'.format(self.shards))
+
+    def stopWorkers(self):
+        for commands in self._commands:
+            commands.put(('quit',))
+        deadline = time.monotonic() + self.quitTimeout
+        for worker in self._workers:
+            worker.join(max(deadline - time.monotonic(), 0))
+        for worker in self._workers:
+            if worker.is_alive():
+                logging.error('{} (pid {}) did not quit in {}s, terminated'.format(
+                    worker.name, worker.pid, self.quitTimeout))
+                worker.terminate()
+                worker.join()
+        self._receiver.join()
+
+    def receive(self):
+        """ handle the events from the workers, and send them the changed settings """
+        while any(worker.is_alive() for worker in self._workers) or not self._events.empty():
+            if self.settings['program_settings'] != self._programSettings:
+                self._programSettings = dict(self.settings['program_settings'])
+                for commands in self._commands:
+                    commands.put(('settings', self._programSettings))
+            try:
+                event = self._events.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if event[0] == 'ended':
+                cr = self.cRecords.get(event[2]) or self._stopping.get(event[2])
+                if isinstance(cr, ShardRecorder) and cr.shard == event[1]:
+                    cr._isRecording = False
+            elif event[0] == 'status':
+                with self._lock:
+                    self._shardStatus[event[1]] = (event[2], event[3])
 
-            elif m_type == '8':  # telop
-                self.comment_log.append(data)
-                if data['telop'] is not None:  # could be null
-                    # logging.info('{}: telop = {}'.format(self.room_url_key, data['telop']))
-                    pass
+    def start(self):
+        # the workers are forked from the calling (main) thread, not from the monitor thread:
+        # forked while the main thread waits in input() on a pipe, they would hang on the lock of stdin
+        self.startWorkers()
+        return super().start()
 
-            elif m_type == '11':  # cumulated gifts report
-                pass
+    def monitor(self):
+        try:
+            super().monitor()
+        finally:
+            self.stopWorkers()
+
+    def openDatabase(self):
+        return None  # each worker writes to the database
+
+    def stopRecorder(self, cr):
+        self._commands[cr.shard].put(('stop', cr.room_url_key))
+
+    def startRecorder(self, room_url_key, room):
+        shard = self.ring.shard(room_url_key)
+        self._commands[shard].put(('start', room_url_key, room, time.time()))
+        return ShardRecorder(room_url_key, room, shard)
+
+    def poll(self):
+        # the workers get the lives of their rooms before the recordings to start
+        snapshots = [[] for _ in range(self.shards)]
+        for room_url_key, room in self.liveness.rooms.items():
+            if room_url_key in self.cRecords:
+                snapshots[self.ring.shard(room_url_key)].append(room)
+        for shard, rooms in enumerate(snapshots):
+            self._commands[shard].put(('snapshot', rooms))
+        return super().poll()
+
+    def collect(self, timeout=3.0):
+        """ :return {shard: status} of the workers which answered within the timeout """
+        if not self._workers:
+            return {}
+        with self._lock:
+            self._statusSeq += 1
+            seq = self._statusSeq
+        for commands in self._commands:
+            commands.put(('status', seq))
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self._lock:
+                if all(self._shardStatus.get(shard, (0, None))[0] >= seq for shard in range(self.shards)):
+                    break
+            time.sleep(0.05)
+        with self._lock:
+            return {shard: status for shard, (_, status) in self._shardStatus.items()}
+
+    def recorderMetrics(self):
+        """ the recorders and their finalize_seconds and live_start_seconds histograms are in the workers """
+        self._lastStatuses = self.collect()
+        histograms = {}
+        rooms = {}
+        for shard, status in sorted(self._lastStatuses.items()):
+            for room_url_key, room in status['rooms'].items():
+                room = dict(room)
+                room.pop('room_name')
+                rooms[room_url_key] = room
+            for name in ('finalize_seconds', 'live_start_seconds'):
+                snapshot = status[name]
+                merged = histograms.get(name)
+                if merged is None:
+                    histograms[name] = dict(snapshot, buckets=list(snapshot['buckets']))
+                    continue
+                merged['buckets'] = [(bound, n + k) for (bound, n), (_, k) in zip(merged['buckets'],
+                                                                                snapshot['buckets'])]
+                merged['sum'] += snapshot['sum']
+                merged['count'] += snapshot['count']
+                if snapshot['last'] is not None:
+                    merged['last'] = snapshot['last']
+        histograms.setdefault('finalize_seconds', metrics.finalize_seconds.snapshot())
+        histograms.setdefault('live_start_seconds', metrics.live_start_seconds.snapshot())
+        return rooms, histograms
+
+    def metrics(self):
+        data = super().metrics()
+        data['shards'] = [{'shard': shard, 'pid': status['pid'], 'rooms': len(status['rooms']),
+                           'http': status['http']} for shard, status in sorted(self._lastStatuses.items())]
+        return data
 
-            elif m_type == '101':  # indicating live finished
-                self.comment_log.append(data)
-                self._isQuit = True
+    def view_status(self):
+        logging.info('Monitoring rooms: {}'.format(self.nRooms))
+        statuses = self.collect()
+        k = 0
+        s = ''
+        frames = dict.fromkeys(('messages', 'fragmented', 'fragments', 'reassembled_bytes', 'dropped'), 0)
+        queued = dict.fromkeys(('depth', 'longest', 'dropped'), 0)
+        shards = ''
+        for shard, status in sorted(statuses.items()):
+            n = 0
+            for room_url_key, room in status['rooms'].items():
+                if room['recording']:
+                    k += 1
+                    n += 1
+                    s += '  {}) {}: {}{}\n'.format(k, room_url_key, room['room_name'],
+                                                 repeatsText(room['repeats_suppressed']))
+                    queued['depth'] += room['queue_depth']
+                    queued['longest'] = max(queued['longest'], room['queue_depth'])
+                    queued['dropped'] += room['queue_dropped']
+            for key, value in status['frames'].items():
+                frames[key] += value
+            shards += '  shard {} (pid {}): {} recording, HTTP requests: {} (errors: {}), ' \
+                      'liveness: {} checks from snapshot, {} checks from is_live\n'.format(
+                        shard, status['pid'], n, status['http']['requests'], status['http']['errors'],
+                        status['liveness']['hits'], status['liveness']['misses'])
+        s = 'Recording rooms: {}\n'.format(k) + s
+        s += 'Shard processes: {} ({} answered)\n'.format(self.shards, len(statuses)) + shards
+        s += 'WebSocket messages: {}, fragmented: {} ({} frames, {} bytes), dropped as too large: {}\n'.format(
+            frames['messages'], frames['fragmented'], frames['fragments'], frames['reassembled_bytes'],
+            frames['dropped'])
+        s += 'Message queues: {} waiting (longest queue: {}), dropped when full: {}\n'.format(
+            queued['depth'], queued['longest'], queued['dropped'])
+        stats = sr_client.stats()
+        s += 'HTTP requests: {} (errors: {}), connections: {} new, {} reused, latency: {} ms avg, {} ms max\n'.format(
+            stats['requests'], stats['errors'], stats['new_connections'], stats['reused_connections'],
+            stats['latency_avg_ms'], stats['latency_max_ms'])
+        s += 'Liveness snapshot: {} lives\n'.format(len(self.liveness))
+        logging.info(s)
 
-            else:
-                self.comment_log.append(data)
 
-        def ws_on_error(ws, error):
-            """ WebSocket callback """
-            logging.error('websocket on error: {} - {}'.format(type(error).__name__, error))
+def prometheusText(data):
+    """
+    :param data: RoomMonitor.metrics()
+    :return the metrics in the Prometheus text exposition format
+    """
+    def label(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    lines = []
+
+    def metric(name, kind, helpText, samples):
+        lines.append('# HELP sr_danmaku_{} {}'.format(name, helpText))
+        lines.append('# TYPE sr_danmaku_{} {}'.format(name, kind))
+        for labels, value in samples:
+            lines.append('sr_danmaku_{}{} {}'.format(name, labels, value))
+
+    def histogram(name, helpText, snapshot):
+        samples = [('_bucket{{le="{}"}}'.format('+Inf' if bound == float('inf') else bound), n)
+                   for bound, n in snapshot['buckets']]
+        samples += [('_sum', snapshot['sum']), ('_count', snapshot['count'])]
+        lines.append('# HELP sr_danmaku_{} {}'.format(name, helpText))
+        lines.append('# TYPE sr_danmaku_{} histogram'.format(name))
+        for suffix, value in samples:
+            lines.append('sr_danmaku_{}{} {}'.format(name, suffix, value))
+
+    monitor = data['monitor']
+    metric('watched_rooms', 'gauge', 'Rooms in rooms.ini', [('', monitor['watched_rooms'])])
+    metric('active_recorders', 'gauge', 'Rooms being recorded', [('', monitor['active_recorders'])])
+    metric('lives', 'gauge', 'Lives in the last onlives snapshot', [('', monitor['lives'])])
+    histogram('poll_seconds', 'Time of an onlives poll, matching included', monitor['poll_seconds'])
+    histogram('onlives_bytes', 'Size of the onlives payload', monitor['onlives_bytes'])
+    onlives = monitor['onlives']
+    metric('onlives_polls_total', 'counter', 'Onlives requests', [('', onlives['polls'])])
+    metric('onlives_not_modified_total', 'counter', 'Onlives answered 304 Not Modified',
+           [('', onlives['not_modified'])])
+    metric('onlives_unchanged_total', 'counter', 'Onlives with the same payload as the last poll',
+           [('', onlives['unchanged'])])
+    metric('onlives_errors_total', 'counter', 'Failed onlives requests', [('', onlives['errors'])])
+    histogram('finalize_seconds', 'Time of saving the files of a finished live', monitor['finalize_seconds'])
+    histogram('live_start_seconds', 'Time from a room seen on live to the first frame of its broadcast server',
+              monitor['live_start_seconds'])
+    roomCacheStats = monitor.get('room_cache')
+    if roomCacheStats is not None:
+        metric('room_cache_hits_total', 'counter', 'Room cache lookups of a recording with a fresh entry',
+               [('', roomCacheStats['hits'])])
+        metric('room_cache_misses_total', 'counter', 'Room cache lookups of a recording without a fresh entry',
+               [('', roomCacheStats['misses'])])
+    database = monitor.get('database')
+    if database is not None:
+        metric('database_rows_total', 'counter', 'Messages inserted into the database', [('', database['rows'])])
+        metric('database_pending', 'gauge', 'Messages waiting to be inserted', [('', database['pending'])])
+        metric('database_errors_total', 'counter', 'Failed database transactions', [('', database['errors'])])
+
+    http = data['http']
+    metric('http_requests_total', 'counter', 'Requests to the Showroom API', [('', http['requests'])])
+    metric('http_errors_total', 'counter', 'Failed requests to the Showroom API', [('', http['errors'])])
+
+    rooms = data['rooms']
+    for name, key, kind, helpText in (
+            ('room_messages_total', 'messages', 'counter', 'Messages from the broadcast server'),
+            ('room_comments_total', 'comments', 'counter', 'Recorded comments'),
+            ('room_decode_errors_total', 'decode_errors', 'counter', 'Messages which failed to be decoded'),
+            ('room_broken_messages_total', 'broken_messages', 'counter', 'Broken messages, repaired or not'),
+            ('room_received_bytes_total', 'bytes_received', 'counter', 'Payload bytes of the received frames'),
+            ('room_messages_per_second', 'messages_per_second', 'gauge', 'Messages per second since the start'),
+            ('room_seconds_since_last_frame', 'seconds_since_last_frame', 'gauge', 'Seconds since the last frame'),
+            ('room_comment_log_size', 'comment_log_size', 'gauge', 'Messages kept for the ass file'),
+            ('room_queue_depth', 'queue_depth', 'gauge', 'Messages read and waiting to be processed'),
+            ('room_queue_dropped_total', 'queue_dropped', 'counter', 'Messages dropped by a full queue'),
+            ('room_repeats_suppressed_total', 'repeats_suppressed', 'counter',
+             'Repeated comments collapsed by the deduplicator'),
+            ('room_first_frame_seconds', 'first_frame_seconds', 'gauge',
+             'Time from the room seen on live to the first frame'),
+            ('room_finalize_seconds', 'finalize_seconds', 'gauge', 'Time of saving the files of the live')):
+        samples = [('{{room="{}"}}'.format(label(room_url_key)), room[key])
+                   for room_url_key, room in rooms.items() if room[key] is not None]
+        metric(name, kind, helpText, samples)
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    """
+    Local HTTP endpoint of the metrics for Prometheus: http://127.0.0.1:<metrics_port>/metrics
+    """
 
-        def ws_on_close(ws):
-            """ WebSocket callback """
-            # logging.debug('websocket closed')
-            self._isQuit = True
+    def __init__(self, monitor, port, host='127.0.0.1'):
+        self.monitor = monitor
 
-        def interval_send(ws):
-            """
-            interval thread to send message and to close WebSocket
-            """
-            count = 60
-            while True:
-                # check whether to quit every sec
-                if self._isQuit:
-                    break
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split('?')[0] not in ('/', '/metrics'):
+                    handler.send_error(404)
+                    return
+                body = prometheusText(self.monitor.metrics()).encode('utf-8')
+                handler.send_response(200)
+                handler.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, fmt, *args):
+                pass
 
-                # send bcsvr_key every 60 secs
-                if count >= 60:
-                    count = 0
-
-                    try:
-                        # logging.debug('sending {}'.format(self.ws_send_txt))
-                        ws.send(self.ws_send_txt)
-                    except WebSocketConnectionClosedException as e:
-                        logging.debug(
-                            'WebSocket closed before sending message. {} Closing interval thread now...'.format(e))
-                        break
-
-                    # also check if the room is still on live
-                    data = getRoomIsLive(self.room_url_key, self.room_id)
-                    if len(data) == 0:
-                        break
-                    if data["ok"] == 0:
-                        logging.debug('{} not on live, terminating interval thread and websocket...'.format(self.room_url_key))
-                        break
-                    else:
-                        # logging.debug('{} still on live, "ok" = {}'.format(self.room_url_key, data["ok"]))
-                        pass
-
-                time.sleep(1)
-                count += 1
+        self.httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
 
-            # close WebSocket
-            if ws is not None:
-                ws.close()
-                ws = None
-            # logging.debug('interval thread finished')
-
-        def ws_on_open(ws):
-            """ WebSocket callback """
-            self.ws_startTime = int(time.time() * 1000)
-            # logging.debug('websocket on open')
-
-            # keep sending bcsvr_key to the server to prevent disconnection
-            self._thread_interval = threading.Thread(target=interval_send,
-                                                     name='{} interval'.format(self.room_url_key), args=(ws,))
-            self._thread_interval.start()
-
-        def ws_start(ws_uri, on_open=ws_on_open, on_message=ws_on_message,
-                     on_error=ws_on_error, on_close=ws_on_close):
-            """ WebSocket main loop """
-            self.ws = websocket.WebSocket()
-            # connect
-            try:
-                self.ws.connect(ws_uri)
-            except Exception as e:
-                on_error(self.ws, e)
-                return
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='metrics', daemon=True)
+        self._thread.start()
 
-            on_open(self.ws)
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
 
-            buffer = b""
-            buffered_opcode = ABNF.OPCODE_TEXT
-            while not self._isQuit:
-                try:
-                    frame = self.ws.recv_frame()
-                except WebSocketConnectionClosedException as e:
-                    logging.debug('ws_start: WebSocket Closed')
-                    break
-                except Exception as e:
-                    on_error(self.ws, e)
-                    break
 
-                """
-                Fragmented frame example: For a text message sent as three fragments, 
-                the 1st fragment: opcode = 0x1 (OPCODE_TEXT) and FIN bit = 0, 
-                the 2nd fragment: opcode = 0x0 (OPCODE_CONT) and FIN bit = 0, 
-                the last fragment: opcode = 0x0 (OPCODE_CONT) and FIN bit = 1. 
-                """
-                if frame.opcode in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY, ABNF.OPCODE_CONT):
-                    buffer += frame.data
-                    if frame.opcode != ABNF.OPCODE_CONT:
-                        buffered_opcode = frame.opcode
-                    else:
-                        logging.debug('ws_start: fragment message: {}'.format(frame.data))
-
-                    # it's either a last fragmented frame, or a non-fragmented single message frame
-                    if frame.fin == 1:
-                        data = buffer
-                        buffer = b""
-                        if buffered_opcode == ABNF.OPCODE_TEXT:
-                            message = ""
-                            try:
-                                message = data.decode('utf-8')
-                                # if message.find('}') < 0:
-                                #     logging.debug('ws_start: broken message?: {}'.format(data))
-                                #     logging.debug('ws_start: fin bit = {}'.format(frame.fin))
-                            except UnicodeDecodeError as e:
-                                message = data.decode('latin-1')
-                                logging.debug('ws_start: UnicodeDecodeError, decoded as latin-1: {}'.format(message))
-                            except Exception as e:
-                                on_error(self.ws, e)
-
-                            on_message(self.ws, message)
-
-                        elif buffered_opcode == ABNF.OPCODE_BINARY:
-                            logging.debug('ws_start: received unknown binary data: {}'.format(data))
-
-                elif frame.opcode == ABNF.OPCODE_CLOSE:
-                    # logging.debug('ws_start: received close opcode')
-                    # self.ws.close() will try to send close frame, so we skip sending close frame here
-                    break
+def logStartTime(logfile):
+    """
+    The recording start time is only in the log file name 'ROOM_URL_KEY yymmdd HHMMSS ROOM_NAME.log',
+    in seconds, so a re-rendered ass file can be up to 1 second later than the one saved by the recorder
 
-                elif frame.opcode == ABNF.OPCODE_PING:
-                    logging.debug('ws_start: received ping, sending pong')
-                    if len(frame.data) < 126:
-                        self.ws.pong(frame.data)
-                    else:
-                        logging.debug('ws_start: ping message too big to send')
+    :return the recording start time (timestamp in milliseconds), or None if the file name has no time
+    """
+    parts = os.path.basename(logfile).split(' ')
+    if len(parts) < 3:
+        return None
+    try:
+        dt = datetime.datetime.strptime(parts[1] + ' ' + parts[2][:6], '%y%m%d %H%M%S')
+    except ValueError:
+        return None
+    dt_tokyo = pytz.timezone('Asia/Tokyo').localize(dt)
+    return int(dt_tokyo.timestamp() * 1000)
 
-                elif frame.opcode == ABNF.OPCODE_PONG:
-                    logging.debug('ws_start: received pong')
 
-                else:
-                    logging.error('ws_start: unknown frame opcode = {}'.format(frame.opcode))
+def isLogFile(filename):
+    """ :return True for a comment log saved by saveDanmaku(): JSON lines (.log) or CommentArchive (.logz) """
+    return filename.endswith('.log') or filename.endswith(CommentArchive.extension)
 
-            on_close(self.ws)
-            self.ws.close()
 
-        """
-        Get live info from https://www.showroom-live.com/api/live/live_info?room_id=xxx
-        If a room closes and then reopen on live within 30 seconds (approximately),
-        the broadcast_key from https://www.showroom-live.com/api/live/onlives
-        will not be updated with the new key. It's the same situation that when a
-        room live is finished, /api/live/onlives will not update its onlives list within
-        about 30 seconds. So here it's better to get accurate broadcast_key
-        from /api/live/live_info
-        """
-        info = getRoomLiveInfo(self.room_url_key, self.room_id)
-        if len(info) == 0:
-            return False
-        if len(info['bcsvr_key']) == 0:
-            # logging.debug('not on live, no bcsvr_key.')
-            return False
+def iterLog(logfile):
+    """
+    :return an iterator of the messages in a comment log file saved by saveDanmaku(), .log or .logz
+    """
+    if logfile.endswith(CommentArchive.extension):
+        yield from CommentArchiveReader(logfile)
+        return
+    with open(logfile, 'r', encoding='utf8') as fp:
+        for line in fp:
+            if len(line.strip()) == 0:
+                continue
+            try:
+                yield json.loads(line)
+            except JSONDecodeError:
+                logging.debug('{}: skipped broken log line: {}'.format(logfile, line))
 
-        logging.info('{}: is on live, start recording comments'.format(self.room_url_key))
 
-        # logging.debug(json.dumps(self.room_data, indent=2, ensure_ascii=False))
+def batchRender(assfile, startTime, messages, danmaku_settings):
+    """
+    Render messages to the ass files of all output profiles in one pass, through temporary files first,
+    so an interrupted batch never leaves a broken ass file
 
-        self._isRecording = True
-        self.ws_send_txt = 'SUB\t' + info['bcsvr_key']
-        if self.settings['program_settings']['show_debug_message'] > 0:
-            # websocket.enableTrace(True)  # False: disable trace outputs
-            websocket.enableTrace(False)
-        else:
-            websocket.enableTrace(False)
+    :return the delayed and dropped comments for max_bullets of the main ass file
+    """
+    multiWriter, assfiles = openDanmakuWriter(assfile[:-len('.ass')], startTime, danmaku_settings, '.tmp')
+    try:
+        multiWriter.writeHeader()
+        multiWriter.write(messages)
+    finally:
+        for writer in multiWriter.writers:
+            writer.fp.close()
+    for profileAssfile in assfiles:
+        os.replace(profileAssfile + '.tmp', profileAssfile)
+    return multiWriter.writers[0].densityText()
 
-        ws_start('ws://' + info['bcsvr_host'] + ':' + str(info['bcsvr_port']),
-                 on_open=ws_on_open, on_message=ws_on_message,
-                 on_error=ws_on_error, on_close=ws_on_close)
 
-        if self._thread_interval is not None:
-            self._thread_interval.join()
+def batchConvertOne(logfile, assfile, danmaku_settings):
+    """
+    Process pool worker of batchConvert(), render one comment log to an ass file
 
-        # sorting
-        self.comment_log = sorted(self.comment_log, key=lambda x: x['received_at'])
-
-        if len(self.comment_log) > 0:
-            # convert comments to danmaku
-            alpha = self.settings['danmaku_settings']['alpha']
-            alpha = int(round(alpha * 255.0 / 100.0))
-            if alpha > 255:
-                alpha = 255
-            elif alpha < 0:
-                alpha = 0
-            alphaHex = '00' + hex(alpha).upper()[2:]
-            alphaHex = alphaHex[-2:]
-
-            assTxt = convert_comments_to_danmaku(self.ws_startTime, self.comment_log,
-                                                 fontsize=self.settings['danmaku_settings']['font_size'],
-                                                 fontname=self.settings['danmaku_settings']['font_name'],
-                                                 alpha=alphaHex,
-                                                 width=self.settings['danmaku_settings']['width'],
-                                                 height=self.settings['danmaku_settings']['height']
-                                                 )
+    :return (logfile, number of messages, error message or None, delayed and dropped comments for max_bullets)
+    """
+    try:
+        if logfile.endswith(CommentArchive.extension):
+            # the archive has the exact start time and the number of messages in its footer
+            archive = CommentArchiveReader(logfile)
+            startTime = archive.meta.get('ws_startTime') or logStartTime(logfile)
+            count = archive.count
+            if startTime is None and count > 0:
+                startTime = next(iter(archive))['received_at']
         else:
-            logging.info('{}: no comments to save'.format(self.room_url_key))
-
-        # change time zone to Tokyo time
-        tokyo_timezone = pytz.timezone('Asia/Tokyo')
-        dt = datetime.datetime.fromtimestamp(self.ws_startTime / 1000.0)
-        dt_tokyo = dt.astimezone(tokyo_timezone)
-        time_string = dt_tokyo.strftime('%y%m%d %H%M%S')
-
-        # create subfolder 'comments'
-        path = os.getcwd()
-        path = os.path.join(path, "comments")
-        if not os.path.isdir(path):
-            try:
-                os.mkdir(path)
-            except OSError:
-                path = os.getcwd()
+            startTime = logStartTime(logfile)
+            count = 0
+            for data in iterLog(logfile):
+                if startTime is None:
+                    startTime = data['received_at']
+                count += 1
+        if count == 0:
+            return logfile, 0, None, ''
+        return logfile, count, None, batchRender(assfile, startTime, iterLog(logfile), danmaku_settings)
+    except Exception as e:
+        return logfile, 0, '{} - {}'.format(type(e).__name__, e), ''
 
-        # remove invalid file name characters \ / : * ? " < > |
-        invalidChar = ['\\', '/', ':', '*', '?', '"', '<', '>', '|']
-        for c in invalidChar:
-            self.room_name = self.room_name.replace(c, '_')
 
-        filename = os.path.join(path, self.room_url_key + ' ' + time_string + ' ' + self.room_name)
-        logfile = filename + '.log'
-        assfile = filename + '.ass'
+def batchConvertLive(dbfile, live, assfile, danmaku_settings):
+    """
+    Process pool worker of batchConvertDatabase(), render one live of a CommentDatabase to an ass file
 
-        # in case that room_name is still invalid
-        filename2 = os.path.join(path, self.room_url_key + ' ' + time_string)
-        logfile2 = filename2 + '.log'
-        assfile2 = filename2 + '.ass'
+    :param live: dict of databaseLives()
+    :return (name of the live, number of messages, error message or None,
+        delayed and dropped comments for max_bullets)
+    """
+    name = '{} {}'.format(live['room_url_key'], timeString(live['ws_startTime']))
+    try:
+        density = batchRender(assfile, live['ws_startTime'], iterDatabaseLive(dbfile, live['room_id'], live['live_id']),
+                              danmaku_settings)
+        return name, live['count'], None, density
+    except Exception as e:
+        return name, 0, '{} - {}'.format(type(e).__name__, e), ''
 
-        def saveLog(_logfile):
-            with open(_logfile, 'w', encoding='utf8') as logfp:
-                for item in self.comment_log:
-                    logfp.write('{}{}'.format(json.dumps(item, ensure_ascii=False), '\n'))
-            logging.info(self.room_url_key + ': recording finished, saved to ' + _logfile)
-
-        def saveAss(_assfile):
-            with open(_assfile, 'w', encoding='utf8') as assfp:
-                assfp.write(assTxt)
-            logging.info(self.room_url_key + ': recording finished, saved to ' + _assfile)
-
-        try:
-            if self.save_comments_debug_log > 0:
-                saveLog(logfile)
-            if len(self.comment_log) > 0:
-                saveAss(assfile)
-        except FileNotFoundError as e:
-            logging.error('FileNotFoundError: {}'.format(e))
-            logging.error('--> try to use {} as filename'.format(self.room_url_key))
-            if self.save_comments_debug_log > 0:
-                saveLog(logfile2)
-            if self.comment_count > 0:
-                saveAss(assfile2)
-        except OSError as e:
-            logging.error('OSError: {}'.format(e))
-            logging.error('--> try to use {} as filename'.format(self.room_url_key))
-            if self.save_comments_debug_log > 0:
-                saveLog(logfile2)
-            if self.comment_count > 0:
-                saveAss(assfile2)
 
-        self._isRecording = False
-        return True
+def batchManifest(outFolder, danmaku_settings):
+    """
+    :return (manifest file, manifest {relative ass file: fingerprint}, fingerprint of danmaku_settings)
+    """
+    manifestFile = os.path.join(outFolder, '.sr_danmaku_batch.json')
+    manifest = {}
+    if os.path.isfile(manifestFile):
+        try:
+            with open(manifestFile, 'r', encoding='utf8') as fp:
+                manifest = json.load(fp)
+        except (OSError, JSONDecodeError) as e:
+            logging.error('Failed to read {}, all ass files will be rendered: {}'.format(manifestFile, e))
+    fingerprint = hashlib.sha1(json.dumps(danmaku_settings, sort_keys=True).encode('utf-8')).hexdigest()
+    return manifestFile, manifest, fingerprint
 
-    def quit(self):
-        """
-        To quit comment logger anytime (to close WebSocket, save file and finish job)
-        """
-        self._isQuit = True
-        self._thread_main.join()
-        if self._thread_interval is not None:
-            self._thread_interval.join()
 
+def runBatch(tasks, skipped, manifestFile, manifest, workers=None):
+    """
+    Run the render tasks of a batch on a process pool, and save the manifest of the rendered ass files
 
-class RoomMonitor:
-    def __init__(self, room_url_keys, settings):
-        self.room_url_keys = room_url_keys
-        self.nRooms = 0
-        self.cRecords = []
-        self._isQuit = False
-        self.t = None
-        self.settings = settings
-        self.interval = settings['program_settings']['interval']
+    :param tasks: list of (worker function, arguments, relative ass file, fingerprint for the manifest)
+    :param skipped: number of up-to-date ass files
+    :return (converted, skipped, failed) numbers of files
+    """
+    logging.info('Batch: {} ass files to render, {} up to date'.format(len(tasks), skipped))
+    converted = 0
+    failed = 0
+    startTime = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = {}
+        for func, args, relative, fingerprint in tasks:
+            futures[executor.submit(func, *args)] = (relative, fingerprint)
+        for future in as_completed(futures):
+            name, count, error, density = future.result()
+            if error is not None:
+                failed += 1
+                logging.error('Batch: failed to render {}: {}'.format(name, error))
+                continue
+            converted += 1
+            relative, fingerprint = futures[future]
+            if count > 0:
+                manifest[relative] = fingerprint
+            logging.debug('Batch: rendered {} messages of {}{}'.format(count, name,
+                                                                      ', ' + density if density else ''))
+
+    elapsed = time.perf_counter() - startTime
+    try:
+        with open(manifestFile, 'w', encoding='utf8') as fp:
+            json.dump(manifest, fp, ensure_ascii=False, indent=1)
+    except OSError as e:
+        logging.error('Failed to save {}: {}'.format(manifestFile, e))
 
-    def quit(self):
-        self._isQuit = True
-        self.t.join()
+    logging.info('Batch: {} rendered, {} up to date, {} failed in {:.1f}s ({:.1f} files/s)'.format(
+        converted, skipped, failed, elapsed, converted / elapsed if elapsed > 0 else 0.0))
+    return converted, skipped, failed
 
-    def start(self):
-        self.t = threading.Thread(target=self.monitor)
-        self.t.start()
-        return self.t
 
-    def monitor(self):
+def batchConvert(folder, settings, outFolder=None, workers=None, force=False):
+    """
+    Re-render the comment logs (.log and .logz) under a folder to danmaku ass files with the current danmaku_settings,
+    on a process pool. An ass file is up to date, and skipped, when it is newer than its log and
+    was rendered with the same danmaku_settings, as recorded in the manifest file of the output folder
 
-        self.nRooms = len(self.room_url_keys)
+    :param folder: folder of the comment logs, searched recursively
+    :param settings
+    :param outFolder: folder of the ass files, default: next to the logs
+    :param workers: number of processes, default: number of CPU cores
+    :param force: re-render up-to-date ass files too
 
-        self.cRecords = [None] * self.nRooms
+    :return (converted, skipped, failed) numbers of files
+    """
+    if outFolder is None:
+        outFolder = folder
+    danmaku_settings = settings['danmaku_settings']
+    manifestFile, manifest, fingerprint = batchManifest(outFolder, danmaku_settings)
+
+    tasks = []
+    skipped = 0
+    for root, dirs, files in os.walk(folder):
+        for f in sorted(files):
+            if not isLogFile(f):
+                continue
+            logfile = os.path.join(root, f)
+            relative = os.path.splitext(os.path.relpath(logfile, folder))[0] + '.ass'
+            assfile = os.path.join(outFolder, relative)
+            if not force and manifest.get(relative) == fingerprint and os.path.isfile(assfile) \
+                    and os.path.getmtime(assfile) >= os.path.getmtime(logfile):
+                skipped += 1
+                continue
+            os.makedirs(os.path.dirname(assfile) or '.', exist_ok=True)
+            tasks.append((batchConvertOne, (logfile, assfile, danmaku_settings), relative, fingerprint))
 
-        count = self.interval
-        # logging.debug('interval = {}, {} rooms = {}'.format(self.interval, self.nRooms, self.room_url_keys))
-        while True:
-            if count >= self.interval:
-                count = 0
-                room_all, pop_room = getOnLives()
-                for i in range(self.nRooms):
-                    if self.cRecords[i] is not None:
-                        if self.cRecords[i].isRecording:
-                            # logging.debug('already recording...')
-                            continue
-                        else:
-                            self.cRecords[i] = None
-
-                    for room in room_all:
-                        if self.room_url_keys[i] == room['room_url_key']:
-                            # logging.debug('{}: is on main site live list.'.format(self.room_url_keys[i]))
-                            cr = CommentRecorder(self.room_url_keys[i], room, self.settings)
-                            cr.start()
-                            self.cRecords[i] = cr
-                            continue
+    return runBatch(tasks, skipped, manifestFile, manifest, workers)
 
-            if self._isQuit:
-                break
-            count += 1
-            time.sleep(1)
-            # end while
 
-        # quitting
-        for i in range(self.nRooms):
-            if self.cRecords[i] is not None:
-                if self.cRecords[i].isRecording:
-                    logging.info('quitting ' + self.cRecords[i].room_url_key + '... ')
-                    self.cRecords[i].quit()
-                    self.cRecords[i] = None
+def batchConvertDatabase(dbfile, settings, outFolder, room_url_key=None, workers=None, force=False):
+    """
+    Render the lives of a CommentDatabase to danmaku ass files with the current danmaku_settings, on a process pool.
+    An ass file is up to date, and skipped, when it was rendered with the same danmaku_settings
+    and the same number of messages, as recorded in the manifest file of the output folder
+
+    :param dbfile: database_file
+    :param settings
+    :param outFolder: folder of the ass files
+    :param room_url_key: only the lives of this room, default: all lives
+    :param workers: number of processes, default: number of CPU cores
+    :param force: re-render up-to-date ass files too
+
+    :return (converted, skipped, failed) numbers of files
+    """
+    if not os.path.isfile(dbfile):
+        logging.error('Batch: database {} not found'.format(dbfile))
+        return 0, 0, 0
+    try:
+        lives = databaseLives(dbfile, room_url_key)
+    except sqlite3.Error as e:
+        logging.error('Batch: failed to read database {}: {}'.format(dbfile, e))
+        return 0, 0, 0
+
+    danmaku_settings = settings['danmaku_settings']
+    os.makedirs(outFolder, exist_ok=True)
+    manifestFile, manifest, fingerprint = batchManifest(outFolder, danmaku_settings)
+
+    tasks = []
+    skipped = 0
+    for live in lives:
+        if live['count'] == 0:
+            continue
+        filename = danmakuFilenames(live['room_url_key'], live['room_name'], live['ws_startTime'], outFolder)[0]
+        assfile = filename + '.ass'
+        relative = os.path.relpath(assfile, outFolder)
+        liveFingerprint = '{} {}'.format(fingerprint, live['count'])
+        if not force and manifest.get(relative) == liveFingerprint and os.path.isfile(assfile):
+            skipped += 1
+            continue
+        tasks.append((batchConvertLive, (dbfile, live, assfile, danmaku_settings), relative, liveFingerprint))
 
-    def view_status(self):
-        logging.info('Monitoring rooms: {}'.format(self.nRooms))
-        k = 0
-        s = ''
-        for i in range(self.nRooms):
-            if self.cRecords[i] is not None:
-                if self.cRecords[i].isRecording:
-                    k += 1
-                    s += '  {}) {}: {}\n'.format(k, self.cRecords[i].room_url_key, self.cRecords[i].room_name)
-        s = 'Recording rooms: {}\n'.format(k) + s
-        logging.info(s)
-        return
+    return runBatch(tasks, skipped, manifestFile, manifest, workers)
 
 
 def readRoomsFile(filename):
@@ -836,13 +4260,76 @@ def readRoomsFile(filename):
     return room_url_keys
 
 
-def readSettingsFile(filename):
-    settingsTxt = """[program_settings]
+class RoomsFileWatcher:
+    """
+    Polls the modification time of rooms.ini, and reads the rooms again when it has changed
+    """
+
+    def __init__(self, filename, settle=1.0):
+        """
+        :param filename
+        :param settle: seconds since the last modification before the file is read, so a file
+            which is still being saved by an editor is not read half written
+        """
+        self.filename = filename
+        self.settle = settle
+        self._stat = self.stat()
+
+    def stat(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def check(self):
+        """
+        :return the room_url_keys of the file without duplicates, or None when it has not changed
+        """
+        stat = self.stat()
+        if stat is None or stat == self._stat or time.time() - stat[0] / 1e9 < self.settle:
+            return None
+        try:
+            room_url_keys = readRoomsFile(self.filename)
+        except OSError as e:
+            logging.error('Failed to read {}: {}'.format(self.filename, e))
+            return None
+        if self.stat() != stat:
+            return None  # changed while reading, read it again on the next check
+        self._stat = stat
+        return list(dict.fromkeys(room_url_keys))
+
+
+settingsTxt = """[program_settings]
 interval = 10                    # seconds, time interval to check rooms are on live or not
 show_comments = 0                # 1: enable, 0: disable
 show_debug_message = 0           # 1: enable, 0: disable
 save_program_debug_log = 0       # 1: enable, 0: disable
 save_comments_debug_log = 0      # 1: enable, 0: disable
+log_format = 0                   # comment log of save_comments_debug_log, 0: JSON lines (.log), 1: compressed archive (.logz)
+async_engine = 0                 # 1: record all rooms on one asyncio event loop, 0: two threads per room
+http_timeout = 10                # seconds, timeout of each request to the Showroom API
+http_pool_size = 0               # connections kept open to the Showroom API, 0: one per watched room, at least 32
+onlives_fast_interval = 5        # seconds, interval when a watched room usually goes on live around this time of day, 0: disable
+onlives_max_backoff = 300        # seconds, the longest wait before polling onlives again after errors
+journal_mode = 0                 # 1: write comments to a journal file while recording, instead of keeping them in memory
+journal_fsync_interval = 10      # seconds, how often the journal is flushed to disk, 0: only when the live ends
+rolling_output_minutes = 0       # minutes, append to the ass file every N minutes while recording, 0: only when the live ends
+compact_comment_store = 0        # 1: keep only what the danmaku needs of each comment in memory (less memory, more CPU), 0: keep whole messages
+dedup_window = 0                 # seconds, the same comment repeated within N seconds is recorded once, 0: disable
+dedup_count_suffix = 0           # 1: record a comment repeated k times as "comment ×k", 0: only the first one
+dedup_max_entries = 5000         # distinct comments remembered per room for dedup_window, the oldest are forgotten first
+ws_max_message_size = 1048576    # bytes, larger messages from the broadcast server are dropped, 0: no limit
+message_queue_size = 0           # messages read and waiting to be processed per room, 0: process them while reading
+message_queue_policy = 0         # when the queue is full, 0: wait before reading more, 1: drop the oldest, 2: drop every second waiting message
+api_base_url = https://www.showroom-live.com    # Showroom site, or a local mock server for load testing
+metrics_port = 0                 # port of the Prometheus metrics endpoint on 127.0.0.1, 0: disable
+shard_processes = 0              # record in N worker processes, rooms split by room_url_key, 0: in this process
+room_cache_file = room_cache.json    # room ids, names and broadcast servers, kept across restarts
+room_cache_ttl = 86400           # seconds, connect to the cached broadcast server of a room while live_info confirms it, 0: disable
+database_file =                  # SQLite database of the messages of all lives, e.g. comments/comments.db, empty: disable
+database_batch_rows = 500        # messages of a live inserted into the database at once
+database_flush_interval = 2      # seconds, the longest a message waits to be inserted into the database
 
 [danmaku_settings]
 width = 640
@@ -850,8 +4337,19 @@ height = 360
 font_name = MS PGothic
 font_size = 18
 alpha = 10                       # transparency percentage, a number between 0 and 100
+max_bullets = 0                  # most comments on screen at the same time, 0: no limit, they overlap when all lines are busy
+max_delay = 2                    # seconds, a comment waits this long at most for room when max_bullets are on screen, or is dropped
+profiles =                       # more ass files rendered in the same pass, WIDTHxHEIGHT:FONT_SIZE, e.g. 1280x720:36, 1920x1080:54
 
 """
+
+
+def defaultSettings():
+    """ :return the settings of a new sr_danmaku.ini """
+    return parseSettings(settingsTxt.splitlines())
+
+
+def readSettingsFile(filename):
     # create file if not present
     path = os.getcwd()
     filenamepath = os.path.join(path, filename)
@@ -863,6 +4361,15 @@ alpha = 10                       # transparency percentage, a number between 0 a
     with open(filenamepath, 'r', encoding='utf8') as fp:
         lines = fp.readlines()
 
+    # start from the default settings, so that a settings file created by an older version still works
+    settings = defaultSettings()
+    userSettings = parseSettings(lines)
+    settings['program_settings'].update(userSettings['program_settings'])
+    settings['danmaku_settings'].update(userSettings['danmaku_settings'])
+    return settings
+
+
+def parseSettings(lines):
     foundProgSettings = False
     foundDanmakuSettings = False
     program_settings = {}
@@ -887,14 +4394,18 @@ alpha = 10                       # transparency percentage, a number between 0 a
 
         if foundProgSettings:
             s1, s2 = line.split("=", 1)
-            program_settings.update({s1.lower().strip(): int(s2.lower().strip())})
+            s1 = s1.lower().strip()
+            s2 = s2.strip()
+            if not s1.endswith('_url') and not s1.endswith('_file'):
+                s2 = int(s2)
+            program_settings.update({s1: s2})
             continue
 
         if foundDanmakuSettings:
             s1, s2 = line.split("=", 1)
             s1 = s1.lower().strip()
             s2 = s2.strip()
-            if s1.find('font_name') < 0:
+            if s1.find('font_name') < 0 and s1 != 'profiles':
                 s2 = int(s2)
             danmaku_settings.update({s1: s2})
             continue
@@ -904,9 +4415,8 @@ alpha = 10                       # transparency percentage, a number between 0 a
 
 
 def main():
-    # read settings and room_url_keys
+    # read settings
     settings = readSettingsFile('sr_danmaku.ini')
-    room_url_keys = readRoomsFile('rooms.ini')
 
     # build logging
     log = logging.getLogger()
@@ -933,10 +4443,27 @@ def main():
         fileHandler.setLevel(logging.DEBUG)
         log.addHandler(fileHandler)
 
+    sr_client.timeout = settings['program_settings']['http_timeout']
+    sr_client.base_url = settings['program_settings']['api_base_url'].rstrip('/')
+
     # build ArgumentParser
     parser = ArgumentParser(description='Monitoring showroom and download comments to danmaku ass')
     parser.add_argument('-u', '--url', help='Only monitor this one SHOWROOM_URL. \
                 For more rooms, please edit file "sr_danmaku.ini".', metavar='SHOWROOM_URL', dest='sr_url')
+    parser.add_argument('--recover', action='store_true', help='Convert the journals left in the folder "comments" \
+                by a crashed program to ass files before monitoring. Do not use it while another instance is running.')
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    batchParser = subparsers.add_parser('batch', help='Re-render saved comment logs to ass files \
+                with the current danmaku_settings.')
+    batchParser.add_argument('folder', nargs='?', default='comments', help='Folder of the comment logs (.log, .logz), \
+                searched recursively. Default: comments')
+    batchParser.add_argument('-o', '--output', help='Folder of the ass files. Default: next to the logs.', metavar='FOLDER')
+    batchParser.add_argument('-j', '--jobs', type=int, help='Number of processes. Default: number of CPU cores.')
+    batchParser.add_argument('-f', '--force', action='store_true', help='Also re-render up-to-date ass files.')
+    batchParser.add_argument('--database', help='Render the lives of this database (database_file) instead of \
+                the logs of the folder, to the folder given by -o.', metavar='FILE')
+    batchParser.add_argument('--room', help='Only render the lives of this room from the database.',
+                             metavar='ROOM_URL_KEY')
 
     log.debug('program_settings = {}'.format(settings['program_settings']))
     log.debug('danmaku_settings = {}'.format(settings['danmaku_settings']))
@@ -944,6 +4471,20 @@ def main():
     # handle args
     args = parser.parse_args()
 
+    if args.command == 'batch':
+        if args.database:
+            batchConvertDatabase(args.database, settings, args.output or args.folder, room_url_key=args.room,
+                                 workers=args.jobs, force=args.force)
+        else:
+            batchConvert(args.folder, settings, outFolder=args.output, workers=args.jobs, force=args.force)
+        return
+
+    if args.recover:
+        recoverJournals(settings)
+
+    # read room_url_keys
+    room_url_keys = readRoomsFile('rooms.ini')
+
     nRoom = len(room_url_keys)
     if args.sr_url:
         idx = args.sr_url.find('https://www.showroom-live.com/')
@@ -967,6 +4508,11 @@ def main():
         log.info('No rooms to monitor')
         return
 
+    if settings['program_settings']['http_pool_size'] <= 0:
+        # a connection for each recorder of the threaded engine, which could all check their rooms at once
+        settings['program_settings']['http_pool_size'] = max(32, len(room_url_keys))
+    sr_client.setPoolSize(settings['program_settings']['http_pool_size'])
+
     if settings['program_settings']['show_comments'] > 0:
         log.info('Comments on')
     else:
@@ -977,25 +4523,50 @@ def main():
 - Type "q" or "quit" to quit.
 - Type "s" or "status" to view status.
 - Type "c" or "comment" to turn on/off showing comments.
+- Type "m" or "metrics" to view metrics as JSON.
 '''
     log.info(helptxt)
 
-    # start monitoring room
-    rm = RoomMonitor(room_url_keys, settings)
+    # start monitoring room, rooms.ini is reloaded when it is edited
+    roomsFile = None if args.sr_url else 'rooms.ini'
+    if settings['program_settings']['shard_processes'] > 0:
+        rm = ShardedRoomMonitor(room_url_keys, settings, roomsFile)
+    else:
+        rm = RoomMonitor(room_url_keys, settings, roomsFile)
     rm.start()
 
+    metricsServer = None
+    if settings['program_settings']['metrics_port'] > 0:
+        try:
+            metricsServer = MetricsServer(rm, settings['program_settings']['metrics_port'])
+        except OSError as e:
+            log.error('Failed to start the metrics endpoint: {}'.format(e))
+        else:
+            metricsServer.start()
+            log.info('Metrics on http://127.0.0.1:{}/metrics'.format(settings['program_settings']['metrics_port']))
+
     while True:
         try:
             line = input().strip().lower()
         except KeyboardInterrupt:  # Ctrl-C is pressed
             log.info('KeyboardInterrupt')
             break
+        except EOFError:  # stdin is closed or not a terminal, e.g. run as a service
+            log.info('No commands can be entered, recording until Ctrl-C')
+            try:
+                while rm.t.is_alive():
+                    rm.t.join(1)
+            except KeyboardInterrupt:
+                log.info('KeyboardInterrupt')
+            break
         if line == 'q' or line == 'quit' or line == 'exit':
             break
         elif line == 'h' or line == 'help':
             log.info(helptxt)
         elif line == 's' or line == 'status':
             rm.view_status()
+        elif line == 'm' or line == 'metrics':
+            rm.view_metrics()
         elif line == 'c' or line == 'comment' or line == 'comments':
             if settings['program_settings']['show_comments'] > 0:
                 settings['program_settings']['show_comments'] = 0
@@ -1008,9 +4579,12 @@ def main():
         time.sleep(0.1)
 
     log.info('quitting jobs...')
+    if metricsServer is not None:
+        metricsServer.stop()
     rm.quit()
     log.info("bye")
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()  # the worker processes of a Windows executable
     main()